@@ -10,8 +10,10 @@ from flask_login import LoginManager
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from flask import Response, request
 
+from .sharding import RoutingSession
 
-db = SQLAlchemy()
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 login_manager = LoginManager()
 
 
@@ -34,6 +36,9 @@ class SseBroker:
                 self._clients.remove(q)
 
     def publish(self, event: Dict) -> None:
+        from .sharding import current_site
+
+        event.setdefault("site", current_site())
         with self._lock:
             for q in list(self._clients):
                 try:
@@ -49,7 +54,8 @@ class SseBroker:
             from flask import current_app
             if 'type' in event and hasattr(current_app, 'metrics'):
                 if event['type'] == 'stock':
-                    current_app.metrics['STOCK_EVENTS'].labels('any').inc()
+                    # Batched ticks publish one event for many materials
+                    current_app.metrics['STOCK_EVENTS'].labels('any').inc(len(event.get('material_ids') or [0]))
                 elif event['type'] == 'alert':
                     current_app.metrics['ALERTS_COUNT'].labels('warning', 'threshold').inc()
         except Exception:
@@ -74,9 +80,25 @@ def create_app() -> Flask:
     app.config.from_object("app.config.Config")
 
     # Extensions
+    from . import sharding
+    sharding.configure(app)
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = "auth.login"
+    sharding.init_app(app)
+
+    from .alerting import alert_engine
+    alert_engine.init_app(app)
+
+    from . import tokens, versioning
+    versioning.init_app(app)
+    tokens.init_app(app)
+
+    from .series import series_store
+    series_store.init_app(app)
+
+    from . import business_metrics
+    business_metrics.init_app(app)
 
     # Blueprints / routes
     from .auth import auth_bp
@@ -116,6 +138,14 @@ def create_app() -> Flask:
 
     @app.route('/metrics')
     def metrics():
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            # `serve` runs several worker processes; aggregate their metric files
+            from prometheus_client import CollectorRegistry, multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            # Business gauges come from this worker's in-memory snapshot
+            registry.register(app.extensions["business_metrics"])
+            return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
         return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
     # Expose counters to other modules
@@ -126,8 +156,12 @@ def create_app() -> Flask:
 
     # DB create on first run
     with app.app_context():
-        from . import models  # noqa: F401
+        from . import models, schema  # noqa: F401
         db.create_all()
+        sharding.create_shards(db)
+        added = schema.upgrade(db)
+        if added:
+            app.logger.info(f"Esquema atualizado: {', '.join(added)}")
 
     return app
 
@@ -0,0 +1,251 @@
+import atexit
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
+
+from flask import Flask
+
+from . import db, sse_broker
+from .sharding import current_site, use_site
+
+
+AlertKey = Tuple[str, Optional[int], str]  # (site, material_id, type)
+
+
+@dataclass
+class _PendingAlert:
+    level: str
+    message: str
+    count: int
+    first_seen: datetime
+    last_seen: datetime
+
+
+class AlertEngine:
+    """Buffered alert writer that deduplicates on (site, material_id, type).
+
+    Callers only touch an in-memory buffer; a scheduled job folds repeated
+    alerts into a single row (occurrences + last_seen_at) and commits them in
+    one transaction per site, so alerting never adds a commit to the stock
+    write path. A site whose write fails keeps its buffer for the next flush.
+
+    Open alert keys per site are cached (reloaded at most every flush
+    interval, so alerts opened by other processes are seen) so that stock
+    recovering above the threshold only queues a resolve when there is
+    something to resolve.
+    """
+
+    def __init__(self) -> None:
+        self._app: Optional[Flask] = None
+        self._pending: Dict[AlertKey, _PendingAlert] = {}
+        self._resolves: Set[AlertKey] = set()
+        self._open: Dict[str, Set[Tuple[Optional[int], str]]] = {}
+        self._open_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self.dedup_window = 3600
+        self.flush_interval = 2.0
+
+    def init_app(self, app: Flask) -> None:
+        self._app = app
+        self.dedup_window = int(app.config.get("ALERT_DEDUP_WINDOW_SEC", 3600))
+        self.flush_interval = float(app.config.get("ALERT_FLUSH_SEC", 2.0))
+        app.extensions["alert_engine"] = self
+
+    def raise_alert(self, material_id: Optional[int], type: str, message: str, level: str = "warning") -> None:
+        key = (current_site(), material_id, type)
+        now = datetime.utcnow()
+        with self._lock:
+            self._resolves.discard(key)
+            p = self._pending.get(key)
+            if p is None:
+                self._pending[key] = _PendingAlert(level, message, 1, now, now)
+            else:
+                p.level, p.message, p.last_seen = level, message, now
+                p.count += 1
+        self._ensure_thread()
+
+    def resolve(self, material_id: Optional[int], type: str) -> None:
+        key = (current_site(), material_id, type)
+        with self._lock:
+            self._pending.pop(key, None)
+            self._resolves.add(key)
+        self._ensure_thread()
+
+    def check_threshold(self, material, stock: float, threshold: float) -> None:
+        """Raise a low-stock alert or auto-resolve it once stock recovers."""
+        if stock < threshold:
+            self.raise_alert(material.id, "threshold", f"Estoque baixo: {material.name}")
+        elif self._is_open((current_site(), material.id, "threshold")):
+            self.resolve(material.id, "threshold")
+
+    def _is_open(self, key: AlertKey) -> bool:
+        """Whether ``key`` has a buffered or an open (unresolved) alert."""
+        site = key[0]
+        with self._lock:
+            if key in self._pending:
+                return True
+            if time.monotonic() - self._open_at.get(site, float("-inf")) < self.flush_interval:
+                return key[1:] in self._open.get(site, ())
+        from .models import Alert
+
+        keys = set(db.session.query(Alert.material_id, Alert.type).filter(Alert.resolved.is_(False)).distinct())
+        with self._lock:
+            self._open[site] = keys
+            self._open_at[site] = time.monotonic()
+        return key[1:] in keys
+
+    def _restore(
+        self,
+        site: str,
+        pending: Dict[Tuple[Optional[int], str], _PendingAlert],
+        resolves: Set[Tuple[Optional[int], str]],
+    ) -> None:
+        """Put back a site's buffer after a failed write, merged with what arrived since."""
+        with self._lock:
+            for (material_id, type_), p in pending.items():
+                key = (site, material_id, type_)
+                if key in self._resolves:
+                    continue  # resolved after this alert was buffered
+                newer = self._pending.get(key)
+                if newer is None:
+                    self._pending[key] = p
+                else:
+                    newer.count += p.count
+                    newer.first_seen = min(newer.first_seen, p.first_seen)
+                    newer.last_seen = max(newer.last_seen, p.last_seen)
+            # Resolves are written before inserts, so they can sit next to a newer alert
+            self._resolves.update((site, material_id, type_) for material_id, type_ in resolves)
+
+    def flush(self) -> int:
+        """Write buffered alerts; returns how many new rows were inserted."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            resolves, self._resolves = self._resolves, set()
+        if not pending and not resolves:
+            return 0
+        by_site: Dict[str, tuple] = {}
+        for (site, material_id, type_), p in pending.items():
+            by_site.setdefault(site, ({}, set()))[0][(material_id, type_)] = p
+        for site, material_id, type_ in resolves:
+            by_site.setdefault(site, ({}, set()))[1].add((material_id, type_))
+        created = 0
+        error: Optional[Exception] = None
+        with self._flush_lock:
+            for site, (site_pending, site_resolves) in by_site.items():
+                with use_site(site):
+                    try:
+                        created += self._write(site_pending, site_resolves)
+                    except Exception as e:
+                        db.session.rollback()
+                        self._restore(site, site_pending, site_resolves)
+                        error = error or e
+                        continue
+                    finally:
+                        db.session.remove()
+                with self._lock:
+                    open_keys = self._open.setdefault(site, set())
+                    open_keys.difference_update(site_resolves)
+                    open_keys.update(site_pending)
+        if error is not None:
+            self._ensure_thread()  # retry with the restored buffer
+            raise error
+        return created
+
+    def _write(
+        self,
+        pending: Dict[Tuple[Optional[int], str], _PendingAlert],
+        resolves: Set[Tuple[Optional[int], str]],
+    ) -> int:
+        """Write one site's alerts, keyed by (material_id, type), in one transaction."""
+        from .models import Alert
+
+        now = datetime.utcnow()
+        created = 0
+        for material_id, type_ in resolves:
+            Alert.query.filter_by(material_id=material_id, type=type_, resolved=False).update(
+                {"resolved": True, "resolved_at": now}, synchronize_session=False
+            )
+
+        if pending:
+            cutoff = now - timedelta(seconds=self.dedup_window)
+            open_alerts: Dict[Tuple[Optional[int], str], Alert] = {}
+            q = Alert.query.filter(
+                Alert.resolved.is_(False),
+                Alert.last_seen_at >= cutoff,
+                Alert.type.in_({k[1] for k in pending}),
+            ).order_by(Alert.id.desc())
+            for a in q:
+                open_alerts.setdefault((a.material_id, a.type), a)
+
+            for key, p in pending.items():
+                a = open_alerts.get(key)
+                if a is not None:
+                    a.occurrences = (a.occurrences or 1) + p.count
+                    a.last_seen_at = p.last_seen
+                    a.level = p.level
+                    a.message = p.message
+                else:
+                    db.session.add(
+                        Alert(
+                            level=p.level,
+                            type=key[1],
+                            message=p.message,
+                            material_id=key[0],
+                            created_at=p.first_seen,
+                            last_seen_at=p.last_seen,
+                            occurrences=p.count,
+                        )
+                    )
+                    created += 1
+        db.session.commit()
+
+        for _ in range(created):
+            sse_broker.publish({"type": "alert"})
+        return created
+
+    def _ensure_thread(self) -> None:
+        if self._app is None:
+            return
+        from .scheduler import scheduler
+
+        # One pending flush job at a time; nothing runs while the buffer is empty
+        if scheduler.once("alerts.flush", self.flush, self.flush_interval, "Alertas: gravação do buffer"):
+            return
+        # No scheduler in this process (CLI commands): periodic flush thread
+        if self._thread and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(self._app,), daemon=True)
+            self._thread.start()
+
+    def _run(self, app: Flask) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.warning(f"Falha ao gravar alertas: {e}")
+                finally:
+                    db.session.remove()
+
+    def shutdown(self) -> None:
+        if self._app is None:
+            return
+        with self._app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                db.session.rollback()
+
+
+alert_engine = AlertEngine()
+atexit.register(alert_engine.shutdown)
@@ -0,0 +1,138 @@
+"""Offline re-scoring of stock removals with the anomaly guard's z-score rule.
+
+Mirrors ``routes._anomaly_check``: a removal is anomalous when its quantity
+is more than ``zscore`` sample standard deviations above the mean of the
+previous ``window`` removals of the same material (at least 10 of them).
+Rolling statistics come from cumulative sums, so each material is scored in
+O(n) NumPy operations; materials are split into chunks scored in a process
+pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+
+MIN_HISTORY = 10
+
+
+@dataclass
+class ScoredRemoval:
+    event_id: int
+    material_id: int
+    created_at: datetime
+    qty: float
+    mean: float
+    std: float
+    z: float
+
+
+def rolling_zscores(qty: np.ndarray, window: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(mean, std, z) of each value against the ``window`` values before it.
+
+    Positions with fewer than MIN_HISTORY predecessors or zero deviation get NaN.
+    """
+    n = qty.shape[0]
+    if n == 0:
+        empty = np.empty(0)
+        return empty, empty, empty
+    # z is shift-invariant; centering keeps the cumulative sums well conditioned
+    offset = qty.mean()
+    x = qty - offset
+    s1 = np.concatenate(([0.0], np.cumsum(x)))
+    s2 = np.concatenate(([0.0], np.cumsum(x * x)))
+    idx = np.arange(n)
+    k = np.minimum(idx, window)  # number of previous values in the window
+    lo = idx - k
+    total = s1[idx] - s1[lo]
+    total_sq = s2[idx] - s2[lo]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / k
+        var = (total_sq - total * mean) / (k - 1)
+        std = np.sqrt(np.clip(var, 0.0, None))
+        z = (x - mean) / std
+        mean = mean + offset
+    invalid = (k < MIN_HISTORY) | ~(std > 1e-12)
+    mean[invalid] = np.nan
+    std[invalid] = np.nan
+    z[invalid] = np.nan
+    return mean, std, z
+
+
+def _score_chunk(
+    db_url: str,
+    material_ids: Sequence[int],
+    window: int,
+    zcut: float,
+    since: Optional[datetime],
+    fetch_size: int,
+) -> List[ScoredRemoval]:
+    """Worker: load removals for a few materials and return the flagged ones."""
+    engine = create_engine(db_url)
+    flagged: List[ScoredRemoval] = []
+    sql = text(
+        "SELECT id, created_at, qty FROM stock_event "
+        "WHERE material_id = :mid AND qty < 0 ORDER BY created_at, id"
+    )
+    with engine.connect() as conn:
+        for mid in material_ids:
+            result = conn.execution_options(stream_results=True).execute(sql, {"mid": mid})
+            ids: List[int] = []
+            stamps: List = []
+            qtys: List[float] = []
+            while True:
+                rows = result.fetchmany(fetch_size)
+                if not rows:
+                    break
+                cols = list(zip(*rows))
+                ids.extend(cols[0])
+                stamps.extend(cols[1])
+                qtys.extend(cols[2])
+            if not qtys:
+                continue
+            q = np.abs(np.asarray(qtys, dtype=np.float64))
+            mean, std, z = rolling_zscores(q, window)
+            for i in np.flatnonzero(z > zcut):
+                ts = stamps[i]
+                if isinstance(ts, str):
+                    ts = datetime.fromisoformat(ts)
+                if since is not None and ts < since:
+                    continue
+                flagged.append(ScoredRemoval(ids[i], mid, ts, float(q[i]), float(mean[i]), float(std[i]), float(z[i])))
+    engine.dispose()
+    return flagged
+
+
+def _chunks(ids: Sequence[int], size: int) -> Iterator[Sequence[int]]:
+    for i in range(0, len(ids), size):
+        yield ids[i : i + size]
+
+
+def rescore(
+    db_url: str,
+    material_ids: Iterable[int],
+    window: int,
+    zcut: float,
+    since: Optional[datetime] = None,
+    workers: Optional[int] = None,
+    chunk: int = 50,
+    fetch_size: int = 50_000,
+) -> List[ScoredRemoval]:
+    """Score every removal of ``material_ids``; returns the flagged ones."""
+    ids = sorted(set(material_ids))
+    tasks = list(_chunks(ids, max(1, chunk)))
+    if not tasks:
+        return []
+    if workers == 1 or len(tasks) == 1:
+        results = [_score_chunk(db_url, t, window, zcut, since, fetch_size) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_score_chunk, db_url, t, window, zcut, since, fetch_size) for t in tasks]
+            results = [f.result() for f in futures]
+    flagged = [r for part in results for r in part]
+    flagged.sort(key=lambda r: (r.created_at, r.event_id))
+    return flagged
@@ -1,14 +1,50 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from typing import Optional
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for
+from flask import Blueprint, current_app, flash, jsonify, redirect, render_template, request, url_for
 from flask_login import current_user, login_required, login_user, logout_user
 
 from . import db
-from .models import User
+from .models import User, forget_user
+from .sharding import DEFAULT_SITE, is_site
+from .tokens import SCOPES, issue_token, revoke_token
 
 
 auth_bp = Blueprint("auth", __name__, url_prefix="/auth")
 
+# Password hashing (scrypt/pbkdf2) runs on a small dedicated pool, outside the
+# gthread request pool, so only PASSWORD_HASH_WORKERS hashes burn CPU at once.
+# A login waits up to PASSWORD_HASH_WAIT_SEC for a free hashing slot (bursts
+# queue instead of failing) and gets a 503 only when that wait runs out.
+_pw_pool: Optional[ThreadPoolExecutor] = None
+_pw_slots: Optional[threading.BoundedSemaphore] = None
+_pw_init_lock = threading.Lock()
+
+
+def _password_pool() -> tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+    global _pw_pool, _pw_slots
+    if _pw_pool is None:
+        with _pw_init_lock:
+            if _pw_pool is None:
+                workers = max(1, int(current_app.config.get("PASSWORD_HASH_WORKERS", 2)))
+                _pw_slots = threading.BoundedSemaphore(workers)
+                _pw_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pwcheck")
+    return _pw_pool, _pw_slots
+
+
+def verify_password(user: User, password: str) -> Optional[bool]:
+    """Check a password on the hashing pool; None if no slot freed up in time."""
+    pool, slots = _password_pool()
+    if not slots.acquire(timeout=float(current_app.config.get("PASSWORD_HASH_WAIT_SEC", 5))):
+        return None
+    try:
+        # One slot per pool thread: the hash starts right away
+        return pool.submit(user.check_password, password).result()
+    finally:
+        slots.release()
+
 
 def role_required(role: str):
     def decorator(fn):
@@ -32,7 +68,11 @@ def login():
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
         user = User.query.filter_by(email=email).first()
-        if user and user.check_password(password):
+        ok = verify_password(user, password) if user else False
+        if ok is None:
+            flash("Muitas tentativas de login simultâneas, tente novamente", "error")
+            return render_template("login.html"), 503
+        if ok:
             login_user(user)
             return redirect(url_for("main.dashboard"))
         flash("Credenciais inválidas", "error")
@@ -42,6 +82,7 @@ def login():
 @auth_bp.route("/logout")
 @login_required
 def logout():
+    forget_user(current_user.get_id())
     logout_user()
     return redirect(url_for("auth.login"))
 
@@ -54,15 +95,45 @@ def register():
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
         role = request.form.get("role", "user")
+        site = request.form.get("site") or DEFAULT_SITE
+        if not is_site(site):
+            flash("Site inválido", "error")
+            return render_template("register.html")
         if not email or not password:
             flash("Informe email e senha", "error")
             return render_template("register.html")
         if User.query.filter_by(email=email).first():
             flash("Email já cadastrado", "error")
             return render_template("register.html")
-        User.create_user(email=email, password=password, role=role)
+        User.create_user(email=email, password=password, role=role, site=site)
         flash("Usuário criado", "success")
         return redirect(url_for("main.users"))
     return render_template("register.html")
 
 
+@auth_bp.route("/tokens", methods=["POST"])
+@login_required
+@role_required("admin")
+def create_token():
+    device_id = (request.form.get("device_id") or "").strip()
+    scopes = request.form.getlist("scope") or list(SCOPES)
+    site = request.form.get("site") or DEFAULT_SITE
+    if not device_id:
+        return jsonify(error="device_id obrigatório"), 400
+    if not is_site(site):
+        return jsonify(error="site inválido"), 400
+    try:
+        token = issue_token(device_id, scopes, site)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(device_id=device_id, scopes=sorted(set(scopes)), site=site, token=token)
+
+
+@auth_bp.route("/tokens/revoke", methods=["POST"])
+@login_required
+@role_required("admin")
+def revoke_device_token():
+    jti = revoke_token((request.form.get("token") or request.form.get("jti") or "").strip())
+    if not jti:
+        return jsonify(error="token inválido"), 400
+    return jsonify(revoked=jti)
@@ -0,0 +1,205 @@
+"""Prometheus collector for business state: stock, prices, removals, alerts.
+
+Scrapes are served from memory. Balances, latest prices and today's removals
+come from the series store, which the write paths already feed row by row;
+material names come from a catalog map rebuilt only when the ``catalog`` data
+version moves; unresolved alerts are recounted only after a local alert
+commit or once ``COUNT_CACHE_TTL_SEC`` has passed (alerts written by other
+``serve`` workers).
+
+Per-material series are bounded by ``METRICS_MATERIAL_POLICY``:
+
+- ``top`` (default): the ``METRICS_MAX_MATERIALS`` materials with the highest
+  stock value per site get their own series; the rest are summed per category
+  under ``material="_outros"`` (stock value only: their units differ).
+- ``category``: only the per-category sums.
+- ``all``: every material (small catalogs).
+"""
+
+import heapq
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from flask import Flask, current_app
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from . import db
+from .series import series_store
+from .sharding import current_site, site_names, use_site
+from .versioning import data_version
+
+
+OTHER = "_outros"
+POLICIES = ("top", "category", "all")
+
+# site -> (catalog version, {material_id: (name, category, unit)})
+_catalogs: Dict[str, Tuple[object, Dict[int, Tuple[str, str, str]]]] = {}
+# site -> (monotonic time, {level: count})
+_alert_counts: Dict[str, Tuple[float, Dict[str, int]]] = {}
+_lock = threading.Lock()
+
+
+def _catalog() -> Dict[int, Tuple[str, str, str]]:
+    from .models import Material
+
+    site = current_site()
+    version = data_version.get("catalog")
+    cached = _catalogs.get(site)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    rows = db.session.query(Material.id, Material.name, Material.category, Material.unit).all()
+    catalog = {mid: (name, category, unit) for mid, name, category, unit in rows}
+    with _lock:
+        _catalogs[site] = (version, catalog)
+    return catalog
+
+
+def _unresolved_alerts(max_age: float) -> Dict[str, int]:
+    from .models import Alert
+
+    site = current_site()
+    cached = _alert_counts.get(site)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+    counts = dict(
+        db.session.query(Alert.level, func.count(Alert.id)).filter(Alert.resolved.is_(False)).group_by(Alert.level)
+    )
+    with _lock:
+        _alert_counts[site] = (time.monotonic(), counts)
+    return counts
+
+
+def unresolved_alert_count() -> int:
+    """Unresolved alerts of the active site, from the same cache as the gauge."""
+    return sum(_unresolved_alerts(float(current_app.config.get("COUNT_CACHE_TTL_SEC", 30))).values())
+
+
+def _alerts_changed(site: str) -> None:
+    with _lock:
+        _alert_counts.pop(site, None)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_alert_writes(sess, flush_context) -> None:
+    from .models import Alert
+
+    if any(isinstance(o, Alert) for o in list(sess.new) + list(sess.dirty) + list(sess.deleted)):
+        sess.info["_alerts_written"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _recount_alerts_on_commit(sess) -> None:
+    if sess.info.pop("_alerts_written", False):
+        _alerts_changed(current_site())
+
+
+@event.listens_for(Session, "after_bulk_update")
+def _collect_bulk_alert_update(update_context) -> None:
+    # AlertEngine resolves with Query.update(), which skips the flush
+    from .models import Alert
+
+    if update_context.mapper.class_ is Alert:
+        update_context.session.info["_alerts_written"] = True
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_alert_writes(sess) -> None:
+    sess.info.pop("_alerts_written", None)
+
+
+class BusinessCollector:
+    def __init__(self, app: Flask) -> None:
+        self.app = app
+        self.policy = app.config.get("METRICS_MATERIAL_POLICY", "top")
+        if self.policy not in POLICIES:
+            raise ValueError(f"METRICS_MATERIAL_POLICY deve ser um de {POLICIES}")
+        self.max_materials = int(app.config.get("METRICS_MAX_MATERIALS", 100))
+        self.alert_max_age = float(app.config.get("COUNT_CACHE_TTL_SEC", 30))
+
+    def describe(self) -> List:
+        # Nothing up front: registering must not touch the database
+        return []
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        stock = GaugeMetricFamily(
+            "iot_material_stock", "Saldo atual do material", labels=["site", "category", "material", "unit"]
+        )
+        price = GaugeMetricFamily("iot_material_price", "Preço mais recente", labels=["site", "category", "material"])
+        value = GaugeMetricFamily(
+            "iot_material_stock_value", "Saldo x preço mais recente", labels=["site", "category", "material"]
+        )
+        removed = GaugeMetricFamily(
+            "iot_removals_today", "Quantidade removida hoje (UTC)", labels=["site", "category", "material", "unit"]
+        )
+        removals = GaugeMetricFamily("iot_removal_events_today", "Remoções registradas hoje (UTC)", labels=["site"])
+        folded = GaugeMetricFamily(
+            "iot_materials_folded", "Materiais agregados em _outros pela política de labels", labels=["site"]
+        )
+        alerts = GaugeMetricFamily("iot_alerts_unresolved", "Alertas não resolvidos", labels=["site", "level"])
+
+        for site in site_names(self.app):
+            with self.app.app_context(), use_site(site):
+                try:
+                    series_store.ensure_warm()  # DB only when cold or after a bulk import
+                    totals, n_removals = series_store.totals()
+                    catalog = _catalog()
+                    by_level = _unresolved_alerts(self.alert_max_age)
+                except Exception as e:
+                    self.app.logger.warning(f"Falha ao coletar métricas de negócio ({site}): {e}")
+                    continue
+                finally:
+                    db.session.remove()
+
+            rows = []
+            for mid, (name, category, unit) in catalog.items():
+                bal, last_price, rem = totals.get(mid, (0.0, None, 0.0))
+                rows.append((bal * (last_price or 0.0), name, category, unit, bal, last_price, rem))
+            shown = self._shown(rows)
+            other: Dict[str, float] = {}
+            for i, (stock_value, name, category, unit, bal, last_price, rem) in enumerate(rows):
+                if i not in shown:
+                    other[category] = other.get(category, 0.0) + stock_value
+                    continue
+                stock.add_metric([site, category, name, unit], bal)
+                value.add_metric([site, category, name], stock_value)
+                removed.add_metric([site, category, name, unit], rem)
+                if last_price is not None:
+                    price.add_metric([site, category, name], last_price)
+            for category, total in sorted(other.items()):
+                value.add_metric([site, category, OTHER], total)
+            folded.add_metric([site], len(rows) - len(shown))
+            removals.add_metric([site], n_removals)
+            for level, n in sorted(by_level.items()):
+                alerts.add_metric([site, level], n)
+
+        yield from (stock, price, value, removed, removals, folded, alerts)
+
+    def _shown(self, rows: List[tuple]) -> Set[int]:
+        """Indexes of the rows that get their own series under the label policy."""
+        if self.policy == "all":
+            return set(range(len(rows)))
+        if self.policy == "category":
+            return set()
+        return set(heapq.nlargest(self.max_materials, range(len(rows)), key=lambda i: rows[i][0]))
+
+
+_registered: Optional[BusinessCollector] = None
+
+
+def init_app(app: Flask) -> BusinessCollector:
+    """Create the app's collector; outside multiprocess mode it joins the default registry."""
+    global _registered
+    collector = BusinessCollector(app)
+    app.extensions["business_metrics"] = collector
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Register once per process, like the module-level counters; a later app replaces it
+        if _registered is not None:
+            REGISTRY.unregister(_registered)
+        REGISTRY.register(collector)
+        _registered = collector
+    return collector
@@ -0,0 +1,219 @@
+"""Periodic per-material balance snapshots for point-in-time stock queries.
+
+A checkpoint stores the balance of every event with ``created_at < as_of``.
+``stock_as_of`` starts from the nearest checkpoint at or before the requested
+time and only sums the events in between, so the cost is bounded by the
+checkpoint interval instead of the age of the ledger.
+"""
+
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Dict, Iterable, Optional
+
+from apscheduler.triggers.cron import CronTrigger
+from flask import Flask, current_app
+from sqlalchemy import and_, bindparam, delete, event, func, or_, select
+from sqlalchemy.orm import Session, aliased
+
+from . import db
+from .models import Material, StockCheckpoint, StockEvent
+from .scheduler import scheduler
+from .sharding import current_site
+
+
+# Lower bound for events of a material without checkpoints
+_BEGINNING = datetime(1970, 1, 1)
+
+
+def day_start(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _latest_checkpoints(at: datetime, material_ids: Optional[Iterable[int]] = None):
+    """Subquery of (material_id, as_of) for each material's newest checkpoint <= at."""
+    q = db.session.query(
+        StockCheckpoint.material_id.label("material_id"),
+        func.max(StockCheckpoint.as_of).label("as_of"),
+    ).filter(StockCheckpoint.as_of <= at)
+    if material_ids is not None:
+        q = q.filter(StockCheckpoint.material_id.in_(list(material_ids)))
+    return q.group_by(StockCheckpoint.material_id).subquery()
+
+
+def _balances_from(latest, event_filter, material_ids: Optional[list]) -> Dict[int, float]:
+    # Checkpoint balance plus the events after it that pass ``event_filter``
+    base_q = db.session.query(StockCheckpoint.material_id, StockCheckpoint.balance).join(
+        latest,
+        and_(StockCheckpoint.material_id == latest.c.material_id, StockCheckpoint.as_of == latest.c.as_of),
+    )
+    balances: Dict[int, float] = {mid: float(bal) for mid, bal in base_q}
+
+    delta_q = (
+        db.session.query(StockEvent.material_id, func.coalesce(func.sum(StockEvent.qty), 0.0))
+        .outerjoin(latest, latest.c.material_id == StockEvent.material_id)
+        .filter(event_filter)
+        .filter(or_(latest.c.as_of.is_(None), StockEvent.created_at >= latest.c.as_of))
+    )
+    if material_ids is not None:
+        delta_q = delta_q.filter(StockEvent.material_id.in_(material_ids))
+    for mid, delta in delta_q.group_by(StockEvent.material_id):
+        balances[mid] = balances.get(mid, 0.0) + float(delta)
+    return balances
+
+
+def stock_as_of(at: datetime, material_ids: Optional[Iterable[int]] = None) -> Dict[int, float]:
+    """Balance per material of all events with created_at < at."""
+    ids = None if material_ids is None else list(material_ids)
+    balances = _balances_from(_latest_checkpoints(at, ids), StockEvent.created_at < at, ids)
+    if ids is not None:
+        for mid in ids:
+            balances.setdefault(mid, 0.0)
+    return balances
+
+
+def stock_through(max_event_id: int) -> Dict[int, float]:
+    """Balance per material of all events with id <= max_event_id (materials with events only)."""
+    return _balances_from(_latest_checkpoints(datetime.utcnow()), StockEvent.id <= max_event_id, None)
+
+
+def balance_of(material_id: int):
+    """SQL expression for one material's current balance: its newest checkpoint
+    plus the events since, a range seek on (material_id, created_at) whose cost
+    is bounded by the checkpoint interval rather than the ledger's age."""
+    latest_cp = aliased(StockCheckpoint)
+    cp_at = select(func.max(latest_cp.as_of)).where(latest_cp.material_id == material_id).scalar_subquery()
+    cp_balance = (
+        select(StockCheckpoint.balance)
+        .where(StockCheckpoint.material_id == material_id, StockCheckpoint.as_of == cp_at)
+        .scalar_subquery()
+    )
+    delta = (
+        select(func.coalesce(func.sum(StockEvent.qty), 0.0))
+        .where(StockEvent.material_id == material_id, StockEvent.created_at >= func.coalesce(cp_at, _BEGINNING))
+        .scalar_subquery()
+    )
+    return func.coalesce(cp_balance, 0.0) + delta
+
+
+def material_snapshot() -> list:
+    """(id, unit, latest price, current balance) for every material in one query.
+
+    Price and balance are correlated subqueries that seek the price index and
+    sum only the events after each material's latest checkpoint.
+    """
+    from .models import Price
+
+    price = (
+        select(Price.value)
+        .where(Price.material_id == Material.id)
+        .order_by(Price.created_at.desc(), Price.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    latest_cp = aliased(StockCheckpoint)
+    cp_at = (
+        select(func.max(latest_cp.as_of))
+        .where(latest_cp.material_id == Material.id)
+        .correlate(Material)
+        .scalar_subquery()
+    )
+    cp_balance = (
+        select(StockCheckpoint.balance)
+        .where(StockCheckpoint.material_id == Material.id, StockCheckpoint.as_of == cp_at)
+        .scalar_subquery()
+    )
+    delta = (
+        select(func.coalesce(func.sum(StockEvent.qty), 0.0))
+        .where(StockEvent.material_id == Material.id)
+        .where(or_(cp_at.is_(None), StockEvent.created_at >= cp_at))
+        .scalar_subquery()
+    )
+    q = select(Material.id, Material.unit, price, func.coalesce(cp_balance, 0.0) + delta).order_by(Material.id)
+    return db.session.execute(q).all()
+
+
+def create_checkpoint(as_of: datetime) -> int:
+    """Snapshot every material's balance at ``as_of``; returns rows written."""
+    existing = {
+        mid for (mid,) in db.session.query(StockCheckpoint.material_id).filter(StockCheckpoint.as_of == as_of)
+    }
+    material_ids = [mid for (mid,) in db.session.query(Material.id) if mid not in existing]
+    if not material_ids:
+        return 0
+    balances = stock_as_of(as_of, material_ids)
+    db.session.add_all(
+        StockCheckpoint(material_id=mid, as_of=as_of, balance=round(bal, 6)) for mid, bal in balances.items()
+    )
+    db.session.commit()
+    return len(balances)
+
+
+def backfill(until: Optional[datetime] = None, step: timedelta = timedelta(days=1)) -> int:
+    """Create daily checkpoints from the first event up to ``until`` (default: today)."""
+    first = db.session.query(func.min(StockEvent.created_at)).scalar()
+    if first is None:
+        return 0
+    until = day_start(until or datetime.utcnow())
+    at = day_start(first) + step
+    written = 0
+    while at <= until:
+        written += create_checkpoint(at)
+        at += step
+    return written
+
+
+def invalidate_after(material_id: int, ts: datetime, sess=None) -> None:
+    """Drop checkpoints that a back-dated event at ``ts`` made stale."""
+    table = StockCheckpoint.__table__
+    (sess or db.session).connection(bind_arguments={"mapper": StockCheckpoint}).execute(
+        delete(table).where(table.c.material_id == material_id, table.c.as_of > ts)
+    )
+
+
+def invalidate_many(oldest: Dict[int, datetime], sess=None) -> None:
+    """``invalidate_after`` for many materials in one executemany (bulk imports)."""
+    if not oldest:
+        return
+    table = StockCheckpoint.__table__
+    (sess or db.session).connection(bind_arguments={"mapper": StockCheckpoint}).execute(
+        delete(table).where(table.c.material_id == bindparam("mid"), table.c.as_of > bindparam("ts")),
+        [{"mid": mid, "ts": ts} for mid, ts in oldest.items()],
+    )
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_backdated(sess, flush_context) -> None:
+    # Live events are stamped "now"; anything older than today's boundary is back-dated
+    boundary = day_start(datetime.utcnow())
+    for obj in sess.new:
+        if isinstance(obj, StockEvent) and obj.created_at is not None and obj.created_at < boundary:
+            invalidate_after(obj.material_id, obj.created_at, sess)
+
+
+def _daily_checkpoint(delay: timedelta) -> None:
+    boundary = day_start(datetime.utcnow() - delay)
+    n = create_checkpoint(boundary)
+    if n:
+        current_app.logger.info(f"Checkpoint de estoque em {boundary:%Y-%m-%d} ({current_site()}): {n} materiais")
+
+
+def start_checkpointer(app: Flask) -> None:
+    """Snapshot yesterday's closing balances daily at 00:00 UTC + ``CHECKPOINT_DELAY_SEC``.
+
+    The delay lets late-flushed events land before the snapshot. One run also
+    happens at startup to cover days the app was down.
+    """
+    delay = int(app.config.get("CHECKPOINT_DELAY_SEC", 300))
+    hour, rest = divmod(delay, 3600)
+    scheduler.add(
+        "checkpoints.daily",
+        partial(_daily_checkpoint, timedelta(seconds=delay)),
+        CronTrigger(hour=hour % 24, minute=rest // 60, second=rest % 60, timezone=timezone.utc),
+        "Checkpoint diário de estoque",
+        per_site=True,
+        run_now=True,
+    )
+
+
+def stop_checkpointer(timeout: Optional[float] = None) -> None:
+    scheduler.remove("checkpoints.daily", timeout)
@@ -1,4 +1,6 @@
+import hashlib
 import os
+import tempfile
 
 
 class Config:
@@ -9,15 +11,76 @@ class Config:
     )
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Multi-site shards: "default" is the main database; every other site in
+    # SITES gets its own file in SHARD_DIR (or SITE_<NAME>_DATABASE_URL)
+    SITES = os.environ.get("SITES", "")
+    SHARD_DIR = os.environ.get("SHARD_DIR", os.path.dirname(os.path.dirname(__file__)))
+
     # Simulator intervals (seconds)
     SIM_PRICE_JITTER_SEC = int(os.environ.get("SIM_PRICE_JITTER_SEC", "10"))
     SIM_STOCK_EVENT_SEC = int(os.environ.get("SIM_STOCK_EVENT_SEC", "8"))
+    SIM_STOCK_BATCH = int(os.environ.get("SIM_STOCK_BATCH", "1"))  # materials moved per stock tick
 
     # Industry 4.0 toggles
     ENABLE_ANOMALY_GUARD = os.environ.get("ENABLE_ANOMALY_GUARD", "1") == "1"
     ANOMALY_WINDOW = int(os.environ.get("ANOMALY_WINDOW", "50"))
     ANOMALY_ZSCORE = float(os.environ.get("ANOMALY_ZSCORE", "3.0"))
 
+    # Alerting: repeated (material, type) alerts within the window are merged
+    ALERT_DEDUP_WINDOW_SEC = int(os.environ.get("ALERT_DEDUP_WINDOW_SEC", "3600"))
+    ALERT_FLUSH_SEC = float(os.environ.get("ALERT_FLUSH_SEC", "2"))
+
+    # Unresolved alert count (nav badge, /metrics): recount interval for other workers' writes
+    COUNT_CACHE_TTL_SEC = float(os.environ.get("COUNT_CACHE_TTL_SEC", "30"))
+
+    # Device API tokens (signed, stateless) and login hashing pool
+    DEVICE_TOKEN_MAX_AGE = int(os.environ.get("DEVICE_TOKEN_MAX_AGE", str(365 * 24 * 3600)))
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+    PASSWORD_HASH_WAIT_SEC = float(os.environ.get("PASSWORD_HASH_WAIT_SEC", "5"))
+
+    # Versioned response cache (entries, LRU)
+    RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+
+    # Dashboard sparklines: points kept in memory per material and series
+    SERIES_POINTS = int(os.environ.get("SERIES_POINTS", "256"))
+
+    # Business gauges on /metrics: per-material series for the top
+    # METRICS_MAX_MATERIALS by stock value ("top"), "category" sums only, or "all"
+    METRICS_MATERIAL_POLICY = os.environ.get("METRICS_MATERIAL_POLICY", "top")
+    METRICS_MAX_MATERIALS = int(os.environ.get("METRICS_MAX_MATERIALS", "100"))
+
+    # Bulk CSV import: rows per transaction
+    IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "20000"))
+
+    # Daily stock balance checkpoints (point-in-time queries)
+    CHECKPOINT_DELAY_SEC = int(os.environ.get("CHECKPOINT_DELAY_SEC", "300"))
+
+    # Background jobs (app/scheduler.py): bounded pools, one run in flight per job
+    SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", "4"))
+    SCHEDULER_IO_WORKERS = int(os.environ.get("SCHEDULER_IO_WORKERS", "2"))  # ERP HTTP calls
+    SCHEDULER_MISFIRE_GRACE_SEC = int(os.environ.get("SCHEDULER_MISFIRE_GRACE_SEC", "60"))
+    SCHEDULER_JITTER_SEC = float(os.environ.get("SCHEDULER_JITTER_SEC", "1"))
+    # Set by `serve` so /jobs shows every worker's jobs
+    SCHEDULER_STATUS_DIR = os.environ.get("SCHEDULER_STATUS_DIR")
+
+    # Production server (manage.py serve): gunicorn gthread workers; one worker,
+    # elected through a file lock in RUNTIME_DIR, owns the background jobs
+    SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", str(os.cpu_count() or 1)))
+    SERVE_THREADS = int(os.environ.get("SERVE_THREADS", "8"))
+    SERVE_GRACEFUL_SEC = int(os.environ.get("SERVE_GRACEFUL_SEC", "30"))
+    SERVE_MAX_REQUESTS = int(os.environ.get("SERVE_MAX_REQUESTS", "0"))  # recycle workers (0 = never)
+    RUNTIME_DIR = os.environ.get(
+        "RUNTIME_DIR",
+        os.path.join(
+            tempfile.gettempdir(),
+            "iot-sheet-" + hashlib.sha1(SQLALCHEMY_DATABASE_URI.encode("utf-8")).hexdigest()[:8],
+        ),
+    )
+    LEADER_POLL_SEC = float(os.environ.get("LEADER_POLL_SEC", "5"))
+    # Set by `serve` so workers share cache invalidations and token revocations
+    VERSION_SYNC_FILE = os.environ.get("VERSION_SYNC_FILE")
+    TOKEN_DENYLIST_FILE = os.environ.get("TOKEN_DENYLIST_FILE")
+
     # MQTT (optional)
     MQTT_ENABLED = os.environ.get("MQTT_ENABLED", "0") == "1"
     MQTT_BROKER = os.environ.get("MQTT_BROKER", "broker.hivemq.com")
@@ -28,5 +91,10 @@ class Config:
 
     # ERP webhook (optional)
     ERP_WEBHOOK_URL = os.environ.get("ERP_WEBHOOK_URL")
+    # Outbox dispatcher: ERP_BATCH_SIZE > 1 sends JSON arrays (ERP must accept them)
+    ERP_BATCH_SIZE = int(os.environ.get("ERP_BATCH_SIZE", "1"))
+    ERP_TIMEOUT_SEC = float(os.environ.get("ERP_TIMEOUT_SEC", "5"))
+    ERP_MAX_ATTEMPTS = int(os.environ.get("ERP_MAX_ATTEMPTS", "8"))
+    ERP_POLL_SEC = float(os.environ.get("ERP_POLL_SEC", "5"))
 
 
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import random
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import requests
+from flask import Flask
+from prometheus_client import Counter, Gauge, Histogram
+
+from . import db
+from .models import ErpOutbox, Material
+from .scheduler import scheduler
+from .sharding import current_site
+
+
+_dispatcher: Optional["ErpDispatcher"] = None
+
+
+ERP_SENT = Counter("erp_dispatch_total", "ERP outbox deliveries", ["result"])
+ERP_LAG = Histogram("erp_dispatch_lag_seconds", "Time from enqueue to ERP acknowledgement")
+# Only the leader process updates these; "livemax" drops dead workers' values under `serve`
+ERP_PENDING = Gauge(
+    "erp_outbox_pending", "ERP outbox rows waiting for delivery", ["site"], multiprocess_mode="livemax"
+)
+ERP_OLDEST = Gauge(
+    "erp_outbox_oldest_pending_seconds",
+    "Age of the oldest pending ERP outbox row",
+    ["site"],
+    multiprocess_mode="livemax",
+)
+
+
+def enqueue_suggestion(material: Material, qty: float) -> ErpOutbox:
+    """Add a purchase suggestion to the outbox; the caller commits, then calls wake_dispatcher()."""
+    key = uuid.uuid4().hex
+    payload = {
+        "materialId": material.id,
+        "materialName": material.name,
+        "unit": material.unit,
+        "site": current_site(),
+        "qty": qty,
+        "ts": datetime.utcnow().isoformat() + "Z",
+        "idempotencyKey": key,
+    }
+    row = ErpOutbox(material_id=material.id, payload=json.dumps(payload), idempotency_key=key)
+    db.session.add(row)
+    return row
+
+
+def wake_dispatcher() -> None:
+    if _dispatcher is not None:
+        _dispatcher.wake()
+
+
+class ErpDispatcher:
+    """Delivers pending outbox rows to the ERP webhook in the background.
+
+    Uses one pooled ``requests.Session``; with ``ERP_BATCH_SIZE > 1`` several
+    suggestions go out as a JSON array in one POST. Failures are retried with
+    exponential backoff and jitter; every request carries an ``Idempotency-Key``
+    so the ERP can drop duplicates after a retry.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        cfg = app.config
+        self.app = app
+        self.url = cfg.get("ERP_WEBHOOK_URL")
+        self.batch_size = max(1, int(cfg.get("ERP_BATCH_SIZE", 1)))
+        self.timeout = float(cfg.get("ERP_TIMEOUT_SEC", 5))
+        self.max_attempts = int(cfg.get("ERP_MAX_ATTEMPTS", 8))
+        self.poll_interval = float(cfg.get("ERP_POLL_SEC", 5))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def wake(self) -> None:
+        scheduler.run_soon("erp.dispatch")
+
+    def _backoff(self, attempts: int) -> timedelta:
+        base = min(300.0, 2.0 ** attempts)
+        return timedelta(seconds=base * random.uniform(0.5, 1.5))
+
+    def _post(self, items: List[Dict]) -> tuple[bool, bool, str]:
+        """Return (ok, retryable, error)."""
+        body = items if self.batch_size > 1 else items[0]
+        key = items[0]["idempotencyKey"] if len(items) == 1 else hashlib.sha1(
+            ",".join(i["idempotencyKey"] for i in items).encode("utf-8")
+        ).hexdigest()
+        try:
+            resp = self.session.post(self.url, json=body, timeout=self.timeout, headers={"Idempotency-Key": key})
+        except Exception as e:
+            return False, True, str(e)[:500]
+        if 200 <= resp.status_code < 300:
+            return True, False, ""
+        retryable = resp.status_code >= 500 or resp.status_code in (408, 429)
+        return False, retryable, f"HTTP {resp.status_code}"
+
+    def dispatch_once(self) -> int:
+        """Send every due row once; returns how many were acknowledged."""
+        if not self.url:
+            return 0
+        now = datetime.utcnow()
+        due = (
+            ErpOutbox.query.filter(ErpOutbox.status == "pending", ErpOutbox.next_attempt_at <= now)
+            .order_by(ErpOutbox.id)
+            .limit(self.batch_size * 10)
+            .all()
+        )
+        sent = 0
+        for i in range(0, len(due), self.batch_size):
+            batch = due[i : i + self.batch_size]
+            ok, retryable, err = self._post([json.loads(r.payload) for r in batch])
+            done = datetime.utcnow()
+            for r in batch:
+                r.attempts += 1
+                if ok:
+                    r.status, r.sent_at, r.last_error = "sent", done, None
+                    ERP_LAG.observe((done - r.created_at).total_seconds())
+                elif retryable and r.attempts < self.max_attempts:
+                    r.next_attempt_at = done + self._backoff(r.attempts)
+                    r.last_error = err
+                else:
+                    r.status, r.last_error = "failed", err
+            ERP_SENT.labels("sent" if ok else ("retry" if retryable else "failed")).inc(len(batch))
+            sent += len(batch) if ok else 0
+            db.session.commit()
+        self._update_gauges()
+        return sent
+
+    def _update_gauges(self) -> None:
+        site = current_site()
+        pending = ErpOutbox.query.filter(ErpOutbox.status == "pending")
+        ERP_PENDING.labels(site).set(pending.count())
+        oldest = pending.order_by(ErpOutbox.id).first()
+        ERP_OLDEST.labels(site).set((datetime.utcnow() - oldest.created_at).total_seconds() if oldest else 0)
+
+    def start(self) -> None:
+        scheduler.every(
+            "erp.dispatch", self.dispatch_once, self.poll_interval, "ERP: envio do outbox",
+            per_site=True, executor="io", run_now=True,
+        )
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Unschedule; waits up to ``timeout`` seconds for the batch in flight."""
+        scheduler.remove("erp.dispatch", timeout)
+
+
+def start_erp_dispatcher(app: Flask) -> None:
+    global _dispatcher
+    if not app.config.get("ERP_WEBHOOK_URL"):
+        return
+    if _dispatcher is None:
+        _dispatcher = ErpDispatcher(app)
+    _dispatcher.start()
+
+
+def stop_erp_dispatcher(timeout: Optional[float] = None) -> None:
+    if _dispatcher is not None:
+        _dispatcher.stop(timeout)
@@ -0,0 +1,413 @@
+"""Bulk import of historical spreadsheets (CSV) into the active site.
+
+Files are read as a stream and written in chunks of ``IMPORT_CHUNK_SIZE``
+rows, each chunk one Core ``executemany`` INSERT in its own transaction, so
+memory stays flat and other writers get the database between chunks.
+Material names are resolved from an in-memory map loaded once. Historical
+rows skip the policy and anomaly checks, alerts and the ERP outbox; what they
+do touch is handled in bulk: checkpoints after the oldest imported event of
+each material are dropped in the same transaction as the chunk, and the data
+version and sparklines are refreshed at the end.
+
+Kinds and columns (headers are case/accent-insensitive, ``;``, ``,`` or tab
+separated; dates ``AAAA-MM-DD[ HH:MM[:SS]]`` or ``DD/MM/AAAA[ HH:MM[:SS]]``):
+
+- ``materials``: name, category, unit, [price], [date]
+- ``prices``: material, value, date
+- ``stock``: material, qty (signed), date, [price], [source]
+
+Stock rows without a price take the material's price in effect at the event
+date. Importing the same file twice inserts its rows twice.
+"""
+
+import bisect
+import csv
+import io
+import time
+import unicodedata
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+
+from sqlalchemy import insert, select
+
+from . import db, sse_broker
+from .checkpoints import invalidate_many
+from .models import Material, Price, StockEvent
+from .series import series_store
+from .versioning import data_version
+
+
+KINDS = ("materials", "prices", "stock")
+_MAX_ERRORS = 20
+
+_ALIASES = {
+    "material": ("material", "item", "nome", "name", "produto"),
+    "name": ("name", "nome", "material", "item"),
+    "category": ("category", "categoria"),
+    "unit": ("unit", "unidade", "un"),
+    "price": ("price", "preco", "valor", "value", "price_at_event"),
+    "value": ("value", "valor", "price", "preco"),
+    "qty": ("qty", "quantidade", "quantity", "qtd"),
+    "date": ("date", "data", "created_at", "timestamp", "data_hora"),
+    "source": ("source", "origem"),
+}
+_REQUIRED = {
+    "materials": ("name",),
+    "prices": ("material", "value", "date"),
+    "stock": ("material", "qty", "date"),
+}
+_OPTIONAL = {
+    "materials": ("category", "unit", "price", "date"),
+    "prices": (),
+    "stock": ("price", "source"),
+}
+
+
+class ImportFileError(ValueError):
+    """The file can't be imported at all (unknown kind, missing columns)."""
+
+
+@dataclass
+class ImportResult:
+    kind: str
+    rows: int = 0
+    inserted: int = 0
+    skipped: int = 0
+    errors: List[str] = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def error(self, line: int, msg: str) -> None:
+        self.skipped += 1
+        if len(self.errors) < _MAX_ERRORS:
+            self.errors.append(f"linha {line}: {msg}")
+
+
+def _norm(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.strip().lower())
+    return "".join(c for c in text if not unicodedata.combining(c)).replace(" ", "_")
+
+
+def _num(text: str) -> float:
+    text = text.strip().replace("R$", "").strip()
+    if "," in text:
+        # pt-BR spreadsheets: "1.234,56"
+        text = text.replace(".", "").replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError(f"número inválido: {text!r}") from None
+
+
+@lru_cache(maxsize=8192)
+def _parse_dt(text: str) -> datetime:
+    # Spreadsheets repeat dates a lot; the cache makes most rows a dict hit
+    try:
+        return _parse_dt_uncached(text.strip())
+    except ValueError:
+        raise ValueError(f"data inválida: {text!r}") from None
+
+
+def _parse_dt_uncached(text: str) -> datetime:
+    if "/" in text:
+        day, _, clock = text.partition(" ")
+        d, m, y = day.split("/")
+        dt = datetime(int(y), int(m), int(d))
+        if clock:
+            parts = [int(p) for p in clock.split(":")]
+            dt = dt.replace(hour=parts[0], minute=parts[1] if len(parts) > 1 else 0, second=parts[2] if len(parts) > 2 else 0)
+        return dt
+    dt = datetime.fromisoformat(text)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _columns(header: List[str], kind: str) -> Dict[str, int]:
+    names = [_norm(h) for h in header]
+    cols: Dict[str, int] = {}
+    for key in _REQUIRED[kind] + _OPTIONAL[kind]:
+        for alias in _ALIASES[key]:
+            if alias in names and names.index(alias) not in cols.values():
+                cols[key] = names.index(alias)
+                break
+    missing = [k for k in _REQUIRED[kind] if k not in cols]
+    if missing:
+        raise ImportFileError(f"colunas obrigatórias ausentes: {', '.join(missing)}")
+    return cols
+
+
+def _reader(stream: TextIO) -> Iterator[List[str]]:
+    first = stream.readline()
+    delimiter = max((";", ",", "\t"), key=first.count)
+    return csv.reader(_chain_first(first, stream), delimiter=delimiter)
+
+
+def _chain_first(first: str, stream: TextIO) -> Iterator[str]:
+    yield first
+    yield from stream
+
+
+class _Names:
+    """Material name -> id for the active site (case-insensitive)."""
+
+    def __init__(self) -> None:
+        self.ids: Dict[str, int] = {
+            name.strip().lower(): mid for mid, name in db.session.execute(select(Material.id, Material.name))
+        }
+
+    def get(self, name: str) -> Optional[int]:
+        return self.ids.get(name.strip().lower())
+
+
+class _PriceBook:
+    """Price in effect at a date, per material, loaded on first use."""
+
+    def __init__(self) -> None:
+        self._ts: Optional[Dict[int, List[datetime]]] = None
+        self._val: Dict[int, List[float]] = {}
+
+    def _load(self) -> None:
+        self._ts = {}
+        rows = db.session.execute(
+            select(Price.material_id, Price.created_at, Price.value).order_by(Price.material_id, Price.created_at)
+        )
+        for mid, at, value in rows:
+            self._ts.setdefault(mid, []).append(at)
+            self._val.setdefault(mid, []).append(float(value))
+
+    def at(self, material_id: int, when: datetime) -> float:
+        if self._ts is None:
+            self._load()
+        ts = self._ts.get(material_id)
+        if not ts:
+            return 0.0
+        i = bisect.bisect_right(ts, when) - 1
+        return self._val[material_id][max(i, 0)]  # before the first price: the oldest known
+
+
+def _chunks(rows: Iterable[Tuple[int, List[str]]], size: int) -> Iterator[List[Tuple[int, List[str]]]]:
+    chunk: List[Tuple[int, List[str]]] = []
+    for item in rows:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_csv(
+    stream: TextIO,
+    kind: str,
+    chunk_size: int = 20_000,
+    source: str = "import",
+    progress: Optional[Callable[[ImportResult], None]] = None,
+) -> ImportResult:
+    """Import one CSV stream of ``kind`` into the active site's shard."""
+    if kind not in KINDS:
+        raise ImportFileError(f"tipo desconhecido: {kind}")
+    reader = _reader(stream)
+    header = next(reader, None)
+    if not header:
+        raise ImportFileError("arquivo vazio")
+    cols = _columns(header, kind)
+    result = ImportResult(kind)
+    names = _Names()
+    started = time.perf_counter()
+    touched: Dict[int, datetime] = {}  # material -> oldest imported timestamp
+    months: Set[Tuple[int, int]] = set()
+
+    numbered = ((n, row) for n, row in enumerate(reader, start=2) if any(c.strip() for c in row))
+    chunks = _chunks(numbered, chunk_size)
+    # Parsing stays on this thread: a parser thread would hold the GIL the
+    # SQLite driver needs to bind each row, which measured slower
+    if kind == "materials":
+        parsed: Iterator = ((len(c), _material_rows(c, cols, names, result)) for c in chunks)
+    else:
+        model = Price if kind == "prices" else StockEvent
+        raw = db.session.get_bind(mapper=model).dialect.name == "sqlite"
+        book = _PriceBook()
+        if kind == "prices":
+            parsed = (_price_rows(c, cols, names, raw, result) for c in chunks)
+        else:
+            parsed = (_stock_rows(c, cols, names, book, source, raw, result) for c in chunks)
+
+    for item in parsed:
+        try:
+            if kind == "materials":
+                result.rows += item[0]
+                result.inserted += _insert_materials(item[1], names, touched)
+            else:
+                result.rows += item.count
+                if item.rows:
+                    _insert_rows(model, item.rows, raw)
+                if kind == "stock":
+                    # Same transaction as the rows: no checkpoint can outlive them
+                    invalidate_many(item.oldest)
+                    months |= item.months
+                for mid, at in item.oldest.items():
+                    _touch(touched, mid, at)
+                result.inserted += len(item.rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            result.seconds = time.perf_counter() - started
+            _finish(kind, touched, months, result)
+            raise
+        result.seconds = time.perf_counter() - started
+        if progress:
+            progress(result)
+    _finish(kind, touched, months, result)
+    return result
+
+
+_PRICE_COLUMNS = ("material_id", "value", "created_at")
+_STOCK_COLUMNS = ("material_id", "qty", "price_at_event", "source", "created_at")
+
+
+@dataclass
+class _Batch:
+    count: int  # CSV rows read, valid or not
+    rows: List[tuple] = field(default_factory=list)
+    oldest: Dict[int, datetime] = field(default_factory=dict)
+    months: Set[Tuple[int, int]] = field(default_factory=set)
+
+    def add(self, row: tuple, material_id: int, at: datetime) -> None:
+        self.rows.append(row)
+        _touch(self.oldest, material_id, at)
+        self.months.add((at.year, at.month))
+
+
+def _insert_rows(model, rows: List[tuple], raw: bool) -> None:
+    columns = _PRICE_COLUMNS if model is Price else _STOCK_COLUMNS
+    conn = db.session.connection(bind_arguments={"mapper": model})
+    stmt = insert(model.__table__)
+    if raw:
+        # Plain DBAPI executemany: SQLAlchemy's per-row parameter processing
+        # costs as much as SQLite's own insert work at this volume
+        conn.exec_driver_sql(str(stmt.compile(dialect=conn.dialect, column_keys=list(columns))), rows)
+    else:
+        conn.execute(stmt, [dict(zip(columns, r)) for r in rows])
+
+
+@lru_cache(maxsize=8192)
+def _stamp(text: str) -> str:
+    """``_parse_dt`` in SQLAlchemy's SQLite DateTime storage format."""
+    return _parse_dt(text).isoformat(" ", "microseconds")
+
+
+def _touch(oldest: Dict[int, datetime], mid: int, at: datetime) -> None:
+    if mid not in oldest or at < oldest[mid]:
+        oldest[mid] = at
+
+
+def _material_rows(chunk, cols, names: _Names, result: ImportResult) -> List[dict]:
+    out: Dict[str, dict] = {}
+    now = datetime.utcnow()
+    for line, row in chunk:
+        try:
+            name = row[cols["name"]].strip()
+            if not name:
+                raise ValueError("nome vazio")
+            if names.get(name) is not None or name.lower() in out:
+                result.skipped += 1  # already registered
+                continue
+            out[name.lower()] = {
+                "name": name,
+                "category": (row[cols["category"]].strip() if "category" in cols else "") or "EPI",
+                "unit": (row[cols["unit"]].strip() if "unit" in cols else "") or "un",
+                "price": _num(row[cols["price"]]) if "price" in cols and row[cols["price"]].strip() else None,
+                "created_at": _parse_dt(row[cols["date"]]) if "date" in cols and row[cols["date"]].strip() else now,
+            }
+        except (IndexError, ValueError) as e:
+            result.error(line, str(e) or "valor inválido")
+    return list(out.values())
+
+
+def _insert_materials(batch: List[dict], names: _Names, touched: Dict[int, datetime]) -> int:
+    if not batch:
+        return 0
+    conn = db.session.connection(bind_arguments={"mapper": Material})
+    ids = conn.execute(
+        insert(Material.__table__).returning(Material.__table__.c.id, sort_by_parameter_order=True),
+        [{k: r[k] for k in ("name", "category", "unit", "created_at")} for r in batch],
+    ).scalars().all()
+    prices = []
+    for mid, r in zip(ids, batch):
+        names.ids[r["name"].lower()] = mid
+        touched[mid] = r["created_at"]
+        if r["price"] is not None:
+            prices.append({"material_id": mid, "value": r["price"], "created_at": r["created_at"]})
+    if prices:
+        conn.execute(insert(Price.__table__), prices)
+    return len(batch)
+
+
+def _price_rows(chunk, cols, names: _Names, raw: bool, result: ImportResult) -> _Batch:
+    out = _Batch(len(chunk))
+    c_mat, c_val, c_date = cols["material"], cols["value"], cols["date"]
+    for line, row in chunk:
+        try:
+            mid = names.get(row[c_mat])
+            if mid is None:
+                result.error(line, f"material desconhecido: {row[c_mat].strip()}")
+                continue
+            value = _num(row[c_val])
+            if value <= 0:
+                raise ValueError("preço deve ser positivo")
+            at = _parse_dt(row[c_date])
+            out.add((mid, round(value, 2), _stamp(row[c_date]) if raw else at), mid, at)
+        except (IndexError, ValueError) as e:
+            result.error(line, str(e) or "valor inválido")
+    return out
+
+
+def _stock_rows(
+    chunk, cols, names: _Names, book: _PriceBook, source: str, raw: bool, result: ImportResult
+) -> _Batch:
+    out = _Batch(len(chunk))
+    c_mat, c_qty, c_date = cols["material"], cols["qty"], cols["date"]
+    c_price, c_source = cols.get("price"), cols.get("source")
+    for line, row in chunk:
+        try:
+            mid = names.get(row[c_mat])
+            if mid is None:
+                result.error(line, f"material desconhecido: {row[c_mat].strip()}")
+                continue
+            qty = round(_num(row[c_qty]), 2)
+            if qty == 0:
+                raise ValueError("quantidade zero")
+            at = _parse_dt(row[c_date])
+            price_text = row[c_price].strip() if c_price is not None else ""
+            price = _num(price_text) if price_text else book.at(mid, at)
+            src = (row[c_source].strip() if c_source is not None else "") or source
+            out.add((mid, qty, price, src, _stamp(row[c_date]) if raw else at), mid, at)
+        except (IndexError, ValueError) as e:
+            result.error(line, str(e) or "valor inválido")
+    return out
+
+
+def _finish(kind: str, touched: Dict[int, datetime], months: Set[Tuple[int, int]], result: ImportResult) -> None:
+    """Bulk inserts skip the flush hooks: bump versions and refresh the sparklines once."""
+    if not touched:
+        return
+    scopes = {("material", mid) for mid in touched}
+    if kind == "materials":
+        scopes.add("catalog")
+    if kind == "stock":
+        scopes |= {("month", f"{y:04d}-{m:02d}") for y, m in months}
+        scopes.add("history")  # closing balances of later months moved
+    data_version.bump(scopes)
+    series_store.invalidate()
+    sse_broker.publish({"type": "refresh"})
+
+
+def text_stream(binary, encoding: str = "utf-8-sig") -> TextIO:
+    """Wrap an uploaded/opened binary file for ``import_csv`` (BOM-tolerant)."""
+    return io.TextIOWrapper(binary, encoding=encoding, newline="")
@@ -1,98 +1,128 @@
-import random
-import threading
-import time
-from typing import Optional
+from datetime import datetime
+from functools import partial
+from typing import Iterable, Optional
 
+import numpy as np
 from flask import Flask
-from sqlalchemy import func
+from sqlalchemy import insert
 
 from . import db, sse_broker
-from .models import Material, Price, StockEvent
-
-
-_sim_thread: Optional[threading.Thread] = None
-_sim_running = False
-
-
-def _jitter_price(material: Material) -> None:
-    last_price = (
-        Price.query.filter_by(material_id=material.id)
-        .order_by(Price.created_at.desc())
-        .first()
-    )
-    base = last_price.value if last_price else 100.0
-    # +/- up to 5%
-    new_price = max(0.01, base * (1 + random.uniform(-0.05, 0.05)))
-    db.session.add(Price(material_id=material.id, value=float(f"{new_price:.2f}")))
+from .checkpoints import material_snapshot
+from .models import Price, StockEvent
+from .scheduler import scheduler
+from .series import series_store
+from .stock_ops import commit_removal, material_lock
+from .versioning import bump_for_bulk
+
+
+_rng = np.random.default_rng()
+
+
+def _snapshot_arrays():
+    """Current state of all materials as parallel NumPy arrays (one query)."""
+    rows = material_snapshot()
+    if not rows:
+        return None
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    is_kg = np.fromiter((r[1] == "kg" for r in rows), dtype=bool, count=len(rows))
+    prices = np.fromiter((r[2] if r[2] is not None else 100.0 for r in rows), dtype=np.float64, count=len(rows))
+    balances = np.fromiter((r[3] or 0.0 for r in rows), dtype=np.float64, count=len(rows))
+    return ids, is_kg, prices, balances
+
+
+def price_tick() -> int:
+    """Jitter every material's price by up to +/-5% in one bulk insert."""
+    snap = _snapshot_arrays()
+    if snap is None:
+        return 0
+    ids, _, prices, _ = snap
+    new_prices = np.round(np.maximum(0.01, prices * (1 + _rng.uniform(-0.05, 0.05, ids.size))), 2)
+    now = datetime.utcnow()
+    new_ids = db.session.scalars(
+        insert(Price).returning(Price.id, sort_by_parameter_order=True),
+        [{"material_id": int(m), "value": float(v), "created_at": now} for m, v in zip(ids, new_prices)],
+    ).all()
     db.session.commit()
-    sse_broker.publish({"type": "price", "material_id": material.id})
+    bump_for_bulk(ids.tolist())
+    series_store.record_prices(zip(new_ids, ids.tolist(), new_prices.tolist(), [now] * ids.size))
+    sse_broker.publish({"type": "price", "material_ids": ids.tolist()})
+    return int(ids.size)
+
+
+def stock_tick(count: int = 1, material_ids: Optional[Iterable[int]] = None) -> int:
+    """Random add/remove events for ``count`` materials, never driving stock negative.
+
+    Additions go out in one bulk insert. Removals are only decided from the
+    snapshot; each one is written by ``commit_removal`` under the material lock,
+    like the web and MQTT paths, and is dropped if a concurrent writer took the
+    stock first. ``material_ids`` limits the pick (``manage.py stress-remove``).
+    """
+    snap = _snapshot_arrays()
+    if snap is None:
+        return 0
+    ids, is_kg, prices, balances = snap
+    if material_ids is not None:
+        keep = np.isin(ids, list(material_ids))
+        ids, is_kg, prices, balances = ids[keep], is_kg[keep], prices[keep], balances[keep]
+        if not ids.size:
+            return 0
+    pick = _rng.choice(ids.size, size=min(count, ids.size), replace=False)
+    kg = is_kg[pick]
+    qty = np.where(kg, _rng.uniform(0.5, 5.0, pick.size), _rng.uniform(1, 10, pick.size)).round(2)
+    add = _rng.random(pick.size) < 0.5
+    add |= qty > balances[pick]  # removing more than we have becomes an add
+    touched = []
+    if add.any():
+        now = datetime.utcnow()
+        added = pick[add]
+        new_ids = db.session.scalars(
+            insert(StockEvent).returning(StockEvent.id, sort_by_parameter_order=True),
+            [
+                {
+                    "material_id": int(ids[i]),
+                    "qty": float(q),
+                    "price_at_event": float(prices[i]),
+                    "source": "simulator",
+                    "created_at": now,
+                }
+                for i, q in zip(added, qty[add])
+            ],
+        ).all()
+        db.session.commit()
+        touched = ids[added].tolist()
+        bump_for_bulk(touched, [now.strftime("%Y-%m")])
+        series_store.record_events(zip(new_ids, touched, qty[add].tolist(), [now] * added.size))
+    for i, q in zip(pick[~add], qty[~add]):
+        mid = int(ids[i])
+        with material_lock(mid):
+            if commit_removal(mid, float(q), float(prices[i]), "simulator"):
+                touched.append(mid)
+    if touched:
+        sse_broker.publish({"type": "stock", "material_ids": touched})
+    return len(touched)
 
 
-def _random_stock_event(material: Material) -> None:
-    # Randomly add or remove small qty
-    add = random.choice([True, False])
-    qty = round(random.uniform(1, 10), 2)
-    if material.unit == "kg":
-        qty = round(random.uniform(0.5, 5.0), 2)
-
-    # Ensure not to go negative when removing
-    total = (
-        db.session.query(func.coalesce(func.sum(StockEvent.qty), 0))
-        .filter_by(material_id=material.id)
-        .scalar()
-        or 0
-    )
-    if not add and qty > float(total):
-        add = True
-
-    last_price = (
-        Price.query.filter_by(material_id=material.id)
-        .order_by(Price.created_at.desc())
-        .first()
+def start_simulator(app: Flask) -> None:
+    """Schedule the price and stock ticks (every site, first run right away)."""
+    stock_batch = int(app.config.get("SIM_STOCK_BATCH", 1))
+    scheduler.every(
+        "simulator.price",
+        price_tick,
+        int(app.config.get("SIM_PRICE_JITTER_SEC", 10)),
+        "Simulador: variação de preços",
+        per_site=True,
+        run_now=True,
     )
-    price = last_price.value if last_price else 100.0
-    signed_qty = qty if add else -qty
-    db.session.add(
-        StockEvent(material_id=material.id, qty=signed_qty, price_at_event=price, source="simulator")
+    scheduler.every(
+        "simulator.stock",
+        partial(stock_tick, stock_batch),
+        int(app.config.get("SIM_STOCK_EVENT_SEC", 8)),
+        "Simulador: movimentações de estoque",
+        per_site=True,
+        run_now=True,
     )
-    db.session.commit()
-    sse_broker.publish({"type": "stock", "material_id": material.id})
-
-
-def simulator_loop(app: Flask) -> None:
-    global _sim_running
-    with app.app_context():
-        price_interval = int(app.config.get("SIM_PRICE_JITTER_SEC", 10))
-        stock_interval = int(app.config.get("SIM_STOCK_EVENT_SEC", 8))
-        last_price_tick = 0
-        last_stock_tick = 0
-        while _sim_running:
-            now = time.time()
-            # price updates
-            if now - last_price_tick >= price_interval:
-                for m in Material.query.all():
-                    _jitter_price(m)
-                last_price_tick = now
-            # stock events
-            if now - last_stock_tick >= stock_interval:
-                mats = Material.query.all()
-                if mats:
-                    _random_stock_event(random.choice(mats))
-                last_stock_tick = now
-            time.sleep(1)
-
-
-def start_simulator(app: Flask) -> None:
-    global _sim_thread, _sim_running
-    if _sim_thread and _sim_thread.is_alive():
-        return
-    _sim_running = True
-    _sim_thread = threading.Thread(target=simulator_loop, args=(app,), daemon=True)
-    _sim_thread.start()
-
-
-def stop_simulator():
-    global _sim_running
-    _sim_running = False
 
 
+def stop_simulator(timeout: Optional[float] = None):
+    scheduler.remove("simulator.price", timeout)
+    scheduler.remove("simulator.stock", timeout)
@@ -2,9 +2,12 @@ from datetime import datetime
 from typing import Optional
 
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from . import db, login_manager
+from .cache import TTLCache
 
 
 class User(UserMixin, db.Model):
@@ -12,6 +15,7 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(255), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), nullable=False, default="user")  # 'user' | 'admin'
+    site = db.Column(db.String(40), nullable=False, default="default")  # shard with this user's stock
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
     def set_password(self, password: str) -> None:
@@ -21,20 +25,63 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     @staticmethod
-    def create_user(email: str, password: str, role: str = "user") -> "User":
-        user = User(email=email, role=role)
+    def create_user(email: str, password: str, role: str = "user", site: str = "default") -> "User":
+        user = User(email=email, role=role, site=site)
         user.set_password(password)
         db.session.add(user)
         db.session.commit()
         return user
 
 
+# Session users are cached detached from the DB session for a short TTL so that
+# authenticated requests don't each pay a SELECT on the user table. Commits that
+# touch a User evict it in this process right away; other `serve` workers pick
+# the change up when the TTL runs out.
+_user_cache = TTLCache(ttl=5, maxsize=4096)
+
+
 @login_manager.user_loader
 def load_user(user_id: str) -> Optional[User]:
     try:
-        return User.query.get(int(user_id))
+        uid = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    user = _user_cache.get(uid)
+    if user is not None:
+        return user
+    try:
+        user = db.session.get(User, uid)
     except Exception:
         return None
+    if user is not None:
+        db.session.expunge(user)
+        _user_cache.set(uid, user)
+    return user
+
+
+def forget_user(user_id) -> None:
+    try:
+        _user_cache.pop(int(user_id))
+    except (TypeError, ValueError):
+        pass
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_writes(sess, flush_context) -> None:
+    for obj in list(sess.dirty) + list(sess.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            sess.info.setdefault("_user_writes", set()).add(obj.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_written_users(sess) -> None:
+    for uid in sess.info.pop("_user_writes", ()):
+        forget_user(uid)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_user_writes(sess) -> None:
+    sess.info.pop("_user_writes", None)
 
 
 class Material(db.Model):
@@ -46,9 +93,12 @@ class Material(db.Model):
 
     prices = db.relationship("Price", backref="material", lazy=True, cascade="all, delete-orphan")
     events = db.relationship("StockEvent", backref="material", lazy=True, cascade="all, delete-orphan")
+    checkpoints = db.relationship("StockCheckpoint", lazy=True, cascade="all, delete-orphan")
 
 
 class Price(db.Model):
+    __table_args__ = (db.Index("ix_price_material_created", "material_id", "created_at"),)
+
     id = db.Column(db.Integer, primary_key=True)
     material_id = db.Column(db.Integer, db.ForeignKey("material.id"), nullable=False, index=True)
     value = db.Column(db.Float, nullable=False)
@@ -56,6 +106,8 @@ class Price(db.Model):
 
 
 class StockEvent(db.Model):
+    __table_args__ = (db.Index("ix_stock_event_material_created", "material_id", "created_at"),)
+
     id = db.Column(db.Integer, primary_key=True)
     material_id = db.Column(db.Integer, db.ForeignKey("material.id"), nullable=False, index=True)
     qty = db.Column(db.Float, nullable=False)  # positive for add, negative for remove
@@ -78,12 +130,43 @@ class MaterialPolicy(db.Model):
 
 
 class Alert(db.Model):
+    __table_args__ = (db.Index("ix_alert_material_type_resolved", "material_id", "type", "resolved"),)
+
     id = db.Column(db.Integer, primary_key=True)
     level = db.Column(db.String(20), nullable=False, default="warning")  # info|warning|critical
     type = db.Column(db.String(50), nullable=False)  # policy|anomaly|threshold
     message = db.Column(db.String(500), nullable=False)
     material_id = db.Column(db.Integer, db.ForeignKey("material.id"), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    resolved = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    # Deduplication: repeated (material_id, type) alerts fold into one row
+    occurrences = db.Column(db.Integer, nullable=False, default=1)
+    last_seen_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    resolved_at = db.Column(db.DateTime, nullable=True)
+
+    material = db.relationship("Material", lazy="joined")
+
+
+class StockCheckpoint(db.Model):
+    """Per-material balance of all events with created_at < as_of."""
+
+    __table_args__ = (db.UniqueConstraint("material_id", "as_of", name="uq_checkpoint_material_as_of"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    material_id = db.Column(db.Integer, db.ForeignKey("material.id"), nullable=False)
+    as_of = db.Column(db.DateTime, nullable=False, index=True)
+    balance = db.Column(db.Float, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    resolved = db.Column(db.Boolean, nullable=False, default=False)
 
 
+class ErpOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    material_id = db.Column(db.Integer, db.ForeignKey("material.id"), nullable=True)
+    payload = db.Column(db.Text, nullable=False)  # JSON body sent to the ERP
+    idempotency_key = db.Column(db.String(64), unique=True, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="pending", index=True)  # pending|sent|failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,129 @@
+"""Batched MQTT payloads: many readings per message on ``factory/stock/batch``
+and ``factory/price/batch`` (optionally under a ``<site>/`` prefix).
+
+Two encodings, told apart by the binary magic:
+
+- JSON array: ``[{"materialId": 1, "qty": 2.5, "action": "add", "eventId": "..."}]``
+  for stock (without ``action`` the sign of ``qty`` decides; negative = removal)
+  and ``[{"materialId": 1, "value": 12.3}]`` for prices.
+- Binary: an 8-byte header ``<4sBBH`` (``IOTB``, version 1, kind 1 = stock /
+  2 = price, record count) followed by fixed-width little-endian records:
+  stock ``<Id16s`` (material id, signed qty, raw event UUID or 16 zero bytes)
+  and price ``<Id`` (material id, value). 28 and 12 bytes per reading.
+
+Binary records are unpacked straight from a ``memoryview`` of the payload
+(``struct.iter_unpack``), without slicing copies.
+"""
+
+import json
+import struct
+import uuid
+from typing import Iterable, List, Optional, Tuple
+
+StockReading = Tuple[int, float, Optional[str]]  # (material_id, signed qty, event id)
+PriceReading = Tuple[int, float]  # (material_id, value)
+
+MAGIC = b"IOTB"
+VERSION = 1
+KIND_STOCK = 1
+KIND_PRICE = 2
+# Readings per message are capped by the header's u16 count
+MAX_RECORDS = 0xFFFF
+
+_HEADER = struct.Struct("<4sBBH")
+_STOCK = struct.Struct("<Id16s")
+_PRICE = struct.Struct("<Id")
+_NO_EVENT = bytes(16)
+
+
+class BatchFormatError(ValueError):
+    """The payload isn't a valid batch; the whole message is dropped."""
+
+
+def _records(payload: bytes, kind: int, record: struct.Struct) -> Iterable[tuple]:
+    view = memoryview(payload)
+    if len(view) < _HEADER.size:
+        raise BatchFormatError("lote binário truncado")
+    magic, version, got_kind, count = _HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise BatchFormatError("cabeçalho binário inválido")
+    if got_kind != kind:
+        raise BatchFormatError("tipo de lote não corresponde ao tópico")
+    if len(view) != _HEADER.size + count * record.size:
+        raise BatchFormatError(f"tamanho inválido: {count} registros de {record.size} bytes esperados")
+    return record.iter_unpack(view[_HEADER.size:])
+
+
+def _event_id(raw: bytes) -> Optional[str]:
+    # Canonical UUID text, same as str(uuid.UUID(bytes=raw)) at a fraction of the cost
+    if raw == _NO_EVENT:
+        return None
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def _json_items(payload: bytes) -> list:
+    try:
+        items = json.loads(payload)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise BatchFormatError(f"JSON inválido: {e}") from None
+    if not isinstance(items, list):
+        raise BatchFormatError("lote JSON deve ser uma lista")
+    if len(items) > MAX_RECORDS:
+        raise BatchFormatError(f"lote com mais de {MAX_RECORDS} leituras")
+    return items
+
+
+def decode_stock(payload: bytes) -> List[StockReading]:
+    if not payload.startswith(MAGIC):
+        out = []
+        try:
+            for item in _json_items(payload):
+                qty = float(item["qty"])
+                action = item.get("action")
+                if action == "add":
+                    qty = abs(qty)
+                elif action == "remove":
+                    qty = -abs(qty)
+                elif action is not None:
+                    raise BatchFormatError(f"ação inválida: {action}")
+                eid = item.get("eventId")
+                out.append((int(item["materialId"]), qty, str(eid) if eid else None))
+        except BatchFormatError:
+            raise
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise BatchFormatError(f"leitura de estoque inválida: {e!r}") from None
+        return out
+    return [(mid, qty, _event_id(eid)) for mid, qty, eid in _records(payload, KIND_STOCK, _STOCK)]
+
+
+def decode_price(payload: bytes) -> List[PriceReading]:
+    if not payload.startswith(MAGIC):
+        try:
+            return [(int(item["materialId"]), float(item["value"])) for item in _json_items(payload)]
+        except BatchFormatError:
+            raise
+        except (KeyError, TypeError, ValueError) as e:
+            raise BatchFormatError(f"leitura de preço inválida: {e!r}") from None
+    return list(_records(payload, KIND_PRICE, _PRICE))
+
+
+def encode_stock(readings: List[StockReading]) -> bytes:
+    """Binary stock batch (for gateways, the benchmark and manual tests)."""
+    if len(readings) > MAX_RECORDS:
+        raise BatchFormatError(f"lote com mais de {MAX_RECORDS} leituras")
+    buf = bytearray(_HEADER.size + len(readings) * _STOCK.size)
+    _HEADER.pack_into(buf, 0, MAGIC, VERSION, KIND_STOCK, len(readings))
+    for i, (mid, qty, eid) in enumerate(readings):
+        _STOCK.pack_into(buf, _HEADER.size + i * _STOCK.size, mid, qty, uuid.UUID(eid).bytes if eid else _NO_EVENT)
+    return bytes(buf)
+
+
+def encode_price(readings: List[PriceReading]) -> bytes:
+    if len(readings) > MAX_RECORDS:
+        raise BatchFormatError(f"lote com mais de {MAX_RECORDS} leituras")
+    buf = bytearray(_HEADER.size + len(readings) * _PRICE.size)
+    _HEADER.pack_into(buf, 0, MAGIC, VERSION, KIND_PRICE, len(readings))
+    for i, (mid, value) in enumerate(readings):
+        _PRICE.pack_into(buf, _HEADER.size + i * _PRICE.size, mid, value)
+    return bytes(buf)
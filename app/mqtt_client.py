@@ -1,17 +1,27 @@
 import json
-import threading
-import time
-from typing import Optional
+import math
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
 from flask import Flask, current_app
+from sqlalchemy import func, insert
+from sqlalchemy.exc import IntegrityError
 
 from . import db, sse_broker
-from .models import Material, Price, StockEvent, Alert
+from .alerting import alert_engine
+from .models import Material, Price, StockEvent
+from .mqtt_batch import PriceReading, StockReading, decode_price, decode_stock
+from .series import series_store
+from .sharding import site_names, split_topic, use_site
+from .stock_ops import commit_removal, material_lock
+from .versioning import bump_for_bulk
 
 
 _client = None
-_thread: Optional[threading.Thread] = None
-_running = False
+
+# _write_stock result when another writer committed the same eventId first:
+# nothing was written, and it is not an error to report or alert on
+DUPLICATE = "duplicate"
 
 
 def _safe_import_mqtt():
@@ -22,41 +32,74 @@ def _safe_import_mqtt():
         return None
 
 
+def _write_stock(
+    m: Material,
+    qty: float,
+    event_uuid: Optional[str],
+    source: str,
+    policy=None,
+    price: Optional[float] = None,
+) -> Optional[str]:
+    """Validate and commit one reading under the material lock.
+
+    Returns None once written, ``DUPLICATE`` if the eventId lost a race with
+    another writer, otherwise the error message.
+    """
+    from .routes import _validate_qty, _anomaly_check, _latest_price
+
+    with material_lock(m.id):
+        err = _validate_qty(m, abs(qty), removing=(qty < 0), policy=policy)
+        if not err and qty < 0:
+            err = _anomaly_check(m, abs(qty))
+        if not err:
+            price = _latest_price(m.id) if price is None else price
+            try:
+                if qty < 0:
+                    if not commit_removal(m.id, abs(qty), price, source, event_uuid):
+                        err = "Estoque insuficiente"
+                else:
+                    ev = StockEvent(
+                        material_id=m.id,
+                        qty=qty,
+                        price_at_event=price,
+                        source=source,
+                        event_uuid=event_uuid,
+                        created_at=datetime.utcnow(),
+                    )
+                    db.session.add(ev)
+                    db.session.flush()
+                    row = (ev.id, m.id, qty, ev.created_at)
+                    db.session.commit()
+                    series_store.record_events([row])
+            except IntegrityError:
+                # Same eventId delivered twice concurrently
+                db.session.rollback()
+                return DUPLICATE
+    if err:
+        alert_engine.raise_alert(m.id, "policy", f"MQTT bloqueado: {err}")
+    return err
+
+
 def _handle_stock(material_id: int, qty: float, event_uuid: Optional[str], source: str) -> Optional[str]:
     # Import validation helpers lazily to avoid circular issues
-    from .routes import _validate_qty, _anomaly_check, _latest_price, _current_stock, _policy_for
+    from .routes import _current_stock, _policy_for
 
     m = Material.query.get(material_id)
     if not m:
         return "Material não encontrado"
-    err = _validate_qty(m, abs(qty), removing=(qty < 0))
-    if not err and qty < 0:
-        err = _anomaly_check(m, abs(qty))
-    if err:
-        db.session.add(Alert(level="warning", type="policy", message=f"MQTT bloqueado: {err}", material_id=material_id))
-        db.session.commit()
-        return err
-    price = _latest_price(material_id)
-    ev = StockEvent(
-        material_id=material_id,
-        qty=qty,
-        price_at_event=price,
-        source=source,
-        event_uuid=event_uuid,
-    )
     # idempotência
     if event_uuid and StockEvent.query.filter_by(event_uuid=event_uuid).first():
         return None
-    db.session.add(ev)
-    db.session.commit()
+    err = _write_stock(m, qty, event_uuid, source)
+    if err == DUPLICATE:
+        return None  # idempotência: outro escritor gravou este eventId
+    if err:
+        return err
     sse_broker.publish({"type": "stock", "material_id": material_id})
 
     # alerta de threshold
     pol = _policy_for(m)
-    if _current_stock(material_id) < pol.min_stock_threshold:
-        db.session.add(Alert(level="warning", type="threshold", message=f"Estoque baixo: {m.name}", material_id=material_id))
-        db.session.commit()
-        sse_broker.publish({"type": "alert"})
+    alert_engine.check_threshold(m, _current_stock(material_id), pol.min_stock_threshold)
     return None
 
 
@@ -65,79 +108,238 @@ def _handle_price(material_id: int, value: float) -> None:
         return
     if not Material.query.get(material_id):
         return
-    db.session.add(Price(material_id=material_id, value=float(f"{value:.2f}")))
+    p = Price(material_id=material_id, value=float(f"{value:.2f}"), created_at=datetime.utcnow())
+    db.session.add(p)
+    db.session.flush()
+    row = (p.id, material_id, p.value, p.created_at)
     db.session.commit()
+    series_store.record_prices([row])
     sse_broker.publish({"type": "price", "material_id": material_id})
 
 
+def _in_batches(values: Iterable, size: int = 500) -> Iterator[list]:
+    # Keeps IN (...) lists under SQLite's bound-parameter limit
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
+
+def _handle_stock_batch(readings: List[StockReading], source: str = "iot") -> int:
+    """Write a batch of stock readings; returns how many were written.
+
+    Materials, known event ids, policies and prices are loaded once per batch
+    and every valid addition goes out in one INSERT and one commit. Additions
+    are written before removals. Removals keep the single-reading path
+    (checked against the balance left by the previous one, conditional insert
+    under the material lock) minus the lookups. Threshold alerts and the SSE
+    event are emitted once per batch.
+    """
+    from .routes import _latest_price, _policy_for, _validate_qty
+
+    materials: Dict[int, Material] = {}
+    for ids in _in_batches({mid for mid, _, _ in readings}):
+        materials.update((m.id, m) for m in Material.query.filter(Material.id.in_(ids)))
+    seen: Set[str] = set()
+    for eids in _in_batches({eid for _, _, eid in readings if eid}):
+        seen.update(e for (e,) in db.session.query(StockEvent.event_uuid).filter(StockEvent.event_uuid.in_(eids)))
+
+    policies: Dict[int, object] = {}
+    prices: Dict[int, float] = {}
+    adds: List[StockReading] = []
+    removals: List[StockReading] = []
+    for mid, qty, eid in readings:
+        m = materials.get(mid)
+        if m is None or not math.isfinite(qty) or (eid and eid in seen):
+            continue  # unknown material, garbage or a replayed eventId
+        if eid:
+            seen.add(eid)
+        if mid not in policies:
+            policies[mid] = _policy_for(m)
+            prices[mid] = _latest_price(mid)
+        if qty < 0:
+            removals.append((mid, qty, eid))
+            continue
+        err = _validate_qty(m, qty, removing=False, policy=policies[mid])
+        if err:
+            alert_engine.raise_alert(mid, "policy", f"MQTT bloqueado: {err}")
+        else:
+            adds.append((mid, qty, eid))
+
+    touched: Set[int] = set()
+    written = 0
+    if adds:
+        now = datetime.utcnow()
+        try:
+            new_ids = db.session.scalars(
+                insert(StockEvent).returning(StockEvent.id, sort_by_parameter_order=True),
+                [
+                    {
+                        "material_id": mid,
+                        "qty": qty,
+                        "price_at_event": prices[mid],
+                        "source": source,
+                        "event_uuid": eid,
+                        "created_at": now,
+                    }
+                    for mid, qty, eid in adds
+                ],
+            ).all()
+            db.session.commit()
+        except IntegrityError:
+            # An eventId raced in from another writer: fall back to one by one
+            db.session.rollback()
+            for mid, qty, eid in adds:
+                if _write_stock(materials[mid], qty, eid, source, policies[mid], prices[mid]) is None:
+                    touched.add(mid)
+                    written += 1
+        else:
+            ids = [mid for mid, _, _ in adds]
+            bump_for_bulk(ids, [now.strftime("%Y-%m")])
+            series_store.record_events(zip(new_ids, ids, [qty for _, qty, _ in adds], [now] * len(adds)))
+            touched.update(ids)
+            written = len(adds)
+
+    for mid, qty, eid in removals:
+        if _write_stock(materials[mid], qty, eid, source, policies[mid], prices[mid]) is None:
+            touched.add(mid)
+            written += 1
+    if not touched:
+        return written
+
+    sse_broker.publish({"type": "stock", "material_ids": sorted(touched)})
+    balances: Dict[int, float] = {}
+    for ids in _in_batches(touched):
+        balances.update(
+            db.session.query(StockEvent.material_id, func.coalesce(func.sum(StockEvent.qty), 0.0))
+            .filter(StockEvent.material_id.in_(ids))
+            .group_by(StockEvent.material_id)
+        )
+    for mid in touched:
+        alert_engine.check_threshold(materials[mid], float(balances.get(mid, 0.0)), policies[mid].min_stock_threshold)
+    return written
+
+
+def _handle_price_batch(readings: List[PriceReading]) -> int:
+    """Write a batch of prices in one INSERT and one commit; returns how many were written."""
+    known: Set[int] = set()
+    for ids in _in_batches({mid for mid, _ in readings}):
+        known.update(mid for (mid,) in db.session.query(Material.id).filter(Material.id.in_(ids)))
+    rows = [
+        (mid, float(f"{value:.2f}"))
+        for mid, value in readings
+        if mid in known and math.isfinite(value) and value > 0
+    ]
+    if not rows:
+        return 0
+    now = datetime.utcnow()
+    new_ids = db.session.scalars(
+        insert(Price).returning(Price.id, sort_by_parameter_order=True),
+        [{"material_id": mid, "value": value, "created_at": now} for mid, value in rows],
+    ).all()
+    db.session.commit()
+    ids = [mid for mid, _ in rows]
+    bump_for_bulk(ids)
+    series_store.record_prices(zip(new_ids, ids, [value for _, value in rows], [now] * len(rows)))
+    sse_broker.publish({"type": "price", "material_ids": sorted(set(ids))})
+    return len(rows)
+
+
+def _handle_batch(parts: list, payload: bytes) -> None:
+    """Dispatch ``factory/<kind>/batch`` (site prefix already stripped)."""
+    if len(parts) != 3 or parts[0] != "factory":
+        return
+    if parts[1] == "stock":
+        _handle_stock_batch(decode_stock(payload))
+    elif parts[1] == "price":
+        _handle_price_batch(decode_price(payload))
+
+
+def _handle_topic(parts: list, payload: dict) -> None:
+    """Dispatch ``factory/<kind>/<id>/<action>`` (site prefix already stripped)."""
+    if len(parts) < 4 or parts[0] != "factory":
+        return
+    kind, mat_id_str, action = parts[1], parts[2], parts[3]
+    material_id = int(mat_id_str)
+    if kind == "stock":
+        qty = float(payload.get("qty", 0))
+        eid = payload.get("eventId")
+        if action == "add":
+            _handle_stock(material_id, abs(qty), eid, source="iot")
+        elif action == "remove":
+            _handle_stock(material_id, -abs(qty), eid, source="iot")
+    elif kind == "price" and action == "set":
+        value = float(payload.get("value", 0))
+        _handle_price(material_id, value)
+
+
 def start_mqtt(app: Flask) -> None:
-    global _client, _thread, _running
+    """Connect in paho's network thread; it also reconnects after broker outages."""
+    global _client
     if not app.config.get("MQTT_ENABLED", False):
         return
     mqtt = _safe_import_mqtt()
     if mqtt is None:
         app.logger.warning("MQTT_ENABLED=1, mas paho-mqtt não está instalado. Ignorando.")
         return
-
-    if _thread and _thread.is_alive():
+    if _client is not None:
         return
 
-    def run():  # pragma: no cover
-        nonlocal mqtt
-        with app.app_context():
-            try:
-                client = mqtt.Client(client_id=app.config.get("MQTT_CLIENT_ID", "iot-sheet-client"), callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-                _authu = app.config.get("MQTT_USERNAME")
-                _authp = app.config.get("MQTT_PASSWORD")
-                if _authu and _authp:
-                    client.username_pw_set(_authu, _authp)
-
-                def on_connect(c, userdata, flags, reason_code, properties=None):
-                    app.logger.info(f"MQTT conectado: {reason_code}")
-                    # Subscriptions
-                    c.subscribe("factory/stock/+/add")
-                    c.subscribe("factory/stock/+/remove")
-                    c.subscribe("factory/price/+/set")
-
-                def on_message(c, userdata, msg):
-                    try:
-                        topic = msg.topic
-                        payload = json.loads(msg.payload.decode("utf-8") or "{}")
-                        parts = topic.split("/")
-                        if len(parts) >= 4 and parts[0] == "factory":
-                            kind, mat_id_str, action = parts[1], parts[2], parts[3]
-                            material_id = int(mat_id_str)
-                            if kind == "stock":
-                                qty = float(payload.get("qty", 0))
-                                eid = payload.get("eventId")
-                                if action == "add":
-                                    _handle_stock(material_id, abs(qty), eid, source="iot")
-                                elif action == "remove":
-                                    _handle_stock(material_id, -abs(qty), eid, source="iot")
-                            elif kind == "price" and action == "set":
-                                value = float(payload.get("value", 0))
-                                _handle_price(material_id, value)
-                    except Exception as e:
-                        app.logger.warning(f"Erro ao processar mensagem MQTT: {e}")
-
-                client.on_connect = on_connect
-                client.on_message = on_message
-
-                host = app.config.get("MQTT_BROKER")
-                port = int(app.config.get("MQTT_PORT", 1883))
-                try:
-                    client.connect(host, port, keepalive=60)
-                except Exception as e:
-                    app.logger.warning(f"Não foi possível conectar ao broker MQTT ({host}:{port}): {e}")
-                    return  # Saímos silenciosamente sem derrubar o app
-
-                client.loop_start()
-                while True:
-                    time.sleep(2)
-            except Exception as e:
-                app.logger.warning(f"MQTT thread finalizada: {e}")
-
-    _thread = threading.Thread(target=run, daemon=True)
-    _thread.start()
+    client = mqtt.Client(client_id=app.config.get("MQTT_CLIENT_ID", "iot-sheet-client"), callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    _authu = app.config.get("MQTT_USERNAME")
+    _authp = app.config.get("MQTT_PASSWORD")
+    if _authu and _authp:
+        client.username_pw_set(_authu, _authp)
+
+    def on_connect(c, userdata, flags, reason_code, properties=None):
+        app.logger.info(f"MQTT conectado: {reason_code}")
+        # Subscriptions: plain topics go to the default site,
+        # "<site>/factory/..." to that site's shard
+        for prefix in ("", "+/"):
+            c.subscribe(f"{prefix}factory/stock/+/add")
+            c.subscribe(f"{prefix}factory/stock/+/remove")
+            c.subscribe(f"{prefix}factory/price/+/set")
+            c.subscribe(f"{prefix}factory/stock/batch")
+            c.subscribe(f"{prefix}factory/price/batch")
+
+    def on_connect_fail(c, userdata):
+        app.logger.warning(f"Não foi possível conectar ao broker MQTT ({host}:{port}); nova tentativa em breve")
+
+    def on_message(c, userdata, msg):
+        try:
+            site, parts = split_topic(msg.topic)
+            # paho's network thread has no app context: check against the app directly
+            if site is not None and site not in site_names(app):
+                app.logger.warning(f"MQTT: site desconhecido em {msg.topic}")
+                return
+            if parts[-1:] == ["batch"]:
+                # Many readings per message: one app context and transaction for all
+                with app.app_context(), use_site(site):
+                    _handle_batch(parts, msg.payload)
+                return
+            payload = json.loads(msg.payload.decode("utf-8") or "{}")
+            with app.app_context(), use_site(site):
+                _handle_topic(parts, payload)
+        except Exception as e:
+            app.logger.warning(f"Erro ao processar mensagem MQTT: {e}")
+
+    client.on_connect = on_connect
+    client.on_connect_fail = on_connect_fail
+    client.on_message = on_message
+
+    host = app.config.get("MQTT_BROKER")
+    port = int(app.config.get("MQTT_PORT", 1883))
+    try:
+        client.connect_async(host, port, keepalive=60)
+        client.loop_start()
+    except Exception as e:
+        app.logger.warning(f"Não foi possível iniciar o cliente MQTT ({host}:{port}): {e}")
+        return  # Saímos silenciosamente sem derrubar o app
+    _client = client
 
 
+def stop_mqtt(timeout: Optional[float] = None) -> None:
+    global _client
+    client, _client = _client, None
+    if client is not None:
+        client.disconnect()
+        client.loop_stop()  # joins paho's network thread
@@ -1,15 +1,21 @@
 import json
 import random
 from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
 from typing import Dict
 
 from flask import (
     Blueprint,
     Response,
+    current_app,
     flash,
+    g,
+    jsonify,
     redirect,
     render_template,
     request,
+    session,
     stream_with_context,
     url_for,
 )
@@ -17,10 +23,20 @@ from flask_login import login_required, current_user
 from sqlalchemy import func
 
 from . import db, sse_broker
+from .alerting import alert_engine
 from .auth import role_required
+from .erp_outbox import enqueue_suggestion, wake_dispatcher
+from .business_metrics import unresolved_alert_count
+from .checkpoints import stock_as_of
+from .scheduler import scheduler
+from .series import series_store
+from .sharding import current_site, is_site, map_sites, site_names, use_site
+from .stock_ops import commit_removal, material_lock
+from .tokens import token_required
+from .xlsx import XLSX_MIMETYPE, Column, stream_workbook
+from .versioning import data_version, fragment_cache, month_scope, versioned_view
 from .models import Material, Price, StockEvent, User, MaterialPolicy, Alert
 import math
-import requests
 
 
 main_bp = Blueprint("main", __name__)
@@ -61,22 +77,35 @@ def _policy_for(material: Material) -> MaterialPolicy:
     return pol
 
 
+def _nav_version() -> int:
+    """Part of cached page keys that tracks the alert badge in the nav."""
+    if current_user.is_authenticated and current_user.role == "admin":
+        return unresolved_alert_count()
+    return 0
+
+
+def _material_row(m: Material) -> dict:
+    key = ("row", current_site(), m.id, data_version.get(("material", m.id)))
+    row = fragment_cache.get(key)
+    if row is None:
+        row = {
+            "id": m.id,
+            "name": m.name,
+            "category": m.category,
+            "unit": m.unit,
+            "stock": _current_stock(m.id),
+            "price": _latest_price(m.id),
+        }
+        fragment_cache.set(key, row)
+    return row
+
+
 @main_bp.route("/")
 @login_required
+@versioned_view(lambda: (data_version.get(), _nav_version()))
 def dashboard():
     materials = Material.query.order_by(Material.category, Material.name).all()
-    rows = []
-    for m in materials:
-        rows.append(
-            {
-                "id": m.id,
-                "name": m.name,
-                "category": m.category,
-                "unit": m.unit,
-                "stock": _current_stock(m.id),
-                "price": _latest_price(m.id),
-            }
-        )
+    rows = [_material_row(m) for m in materials]
     return render_template("dashboard.html", rows=rows, user=current_user)
 
 
@@ -88,6 +117,18 @@ def users():
     return render_template("users.html", users=users)
 
 
+@main_bp.route("/site", methods=["POST"])
+@login_required
+@role_required("admin")
+def switch_site():
+    site = request.form.get("site", "")
+    if not is_site(site):
+        flash("Site inválido", "error")
+    else:
+        session["site"] = site
+    return redirect(request.referrer or url_for("main.dashboard"))
+
+
 @main_bp.route("/materials", methods=["GET", "POST"])
 @login_required
 @role_required("admin")
@@ -103,14 +144,67 @@ def materials():
             m = Material(name=name, category=category, unit=unit)
             db.session.add(m)
             db.session.flush()
-            db.session.add(Price(material_id=m.id, value=price))
+            p = Price(material_id=m.id, value=price, created_at=datetime.utcnow())
+            db.session.add(p)
+            db.session.flush()
+            row = (p.id, m.id, price, p.created_at)
             db.session.commit()
+            series_store.record_prices([row])
             flash("Material criado", "success")
             sse_broker.publish({"type": "material_created"})
         return redirect(url_for("main.materials"))
 
     mats = Material.query.order_by(Material.category, Material.name).all()
     return render_template("materials.html", materials=mats)
+@main_bp.route("/import", methods=["GET", "POST"])
+@login_required
+@role_required("admin")
+def import_upload():
+    """Upload a historical CSV into the current site (see ``importer``)."""
+    from .importer import KINDS, ImportFileError, import_csv, text_stream
+
+    result = None
+    if request.method == "POST":
+        upload = request.files.get("file")
+        kind = request.form.get("kind", "")
+        encoding = request.form.get("encoding", "utf-8-sig")
+        if not upload or not upload.filename:
+            flash("Selecione um arquivo CSV", "error")
+        elif kind not in KINDS or encoding not in ("utf-8-sig", "cp1252"):
+            flash("Tipo de importação inválido", "error")
+        else:
+            # Werkzeug spools large uploads to disk; rows are streamed from there
+            try:
+                result = import_csv(
+                    text_stream(upload.stream, encoding),
+                    kind,
+                    int(current_app.config.get("IMPORT_CHUNK_SIZE", 20000)),
+                    progress=lambda r: current_app.logger.info(
+                        f"Importação {kind}: {r.rows} linhas ({r.rate:.0f} linhas/s)"
+                    ),
+                )
+            except (ImportFileError, UnicodeDecodeError) as e:
+                flash(f"Arquivo inválido: {e}", "error")
+            else:
+                flash(f"Importação concluída: {result.inserted} linhas gravadas", "success")
+    return render_template("import.html", result=result)
+
+
+@main_bp.route("/jobs")
+@login_required
+@role_required("admin")
+def jobs():
+    """Background job status of every process (see ``scheduler``)."""
+    return render_template("jobs.html", processes=scheduler.processes())
+
+
+@main_bp.route("/api/jobs")
+@login_required
+@role_required("admin")
+def api_jobs():
+    return jsonify(processes=scheduler.processes())
+
+
 @main_bp.route("/materials/<int:mid>/policy", methods=["GET", "POST"])
 @login_required
 @role_required("admin")
@@ -128,12 +222,173 @@ def policies(mid: int):
         return redirect(url_for("main.policies", mid=mid))
     return render_template("policy.html", m=m, pol=pol)
 
+
+def _parse_day(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def _page_args() -> tuple[int | None, int]:
+    """Return (cursor, limit) from the query string."""
+    try:
+        cursor = int(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError:
+        cursor = None
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        limit = 50
+    return cursor, max(1, min(limit, 500))
+
+
+def _keyset_page(query, id_col, cursor: int | None, limit: int) -> tuple[list, int | None]:
+    """Newest-first page using ``id < cursor`` instead of OFFSET."""
+    if cursor is not None:
+        query = query.filter(id_col < cursor)
+    items = query.order_by(id_col.desc()).limit(limit + 1).all()
+    next_cursor = items[limit - 1].id if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+@main_bp.app_context_processor
+def _inject_alert_count():
+    if current_user.is_authenticated and current_user.role == "admin":
+        return {"unresolved_alerts": unresolved_alert_count()}
+    return {}
+
+
+def _filtered_events():
+    args = request.args
+    material_id = args.get("material_id", type=int)
+    source = args.get("source") or None
+    sign = args.get("sign")
+    start, end = _parse_day(args.get("start")), _parse_day(args.get("end"))
+    q = StockEvent.query
+    if material_id:
+        q = q.filter(StockEvent.material_id == material_id)
+    if source:
+        q = q.filter(StockEvent.source == source)
+    if sign == "in":
+        q = q.filter(StockEvent.qty > 0)
+    elif sign == "out":
+        q = q.filter(StockEvent.qty < 0)
+    if start:
+        q = q.filter(StockEvent.created_at >= start)
+    if end:
+        q = q.filter(StockEvent.created_at < end + timedelta(days=1))
+    return q
+
+
+def _filtered_alerts():
+    args = request.args
+    material_id = args.get("material_id", type=int)
+    type_ = args.get("type") or None
+    resolved = {"0": False, "1": True}.get(args.get("resolved", ""))
+    start, end = _parse_day(args.get("start")), _parse_day(args.get("end"))
+    q = Alert.query
+    if material_id:
+        q = q.filter(Alert.material_id == material_id)
+    if type_:
+        q = q.filter(Alert.type == type_)
+    if resolved is not None:
+        q = q.filter(Alert.resolved.is_(resolved))
+    if start:
+        q = q.filter(Alert.created_at >= start)
+    if end:
+        q = q.filter(Alert.created_at < end + timedelta(days=1))
+    return q
+
+
+def _event_to_dict(e: StockEvent) -> dict:
+    return {
+        "id": e.id,
+        "material_id": e.material_id,
+        "qty": e.qty,
+        "price_at_event": e.price_at_event,
+        "source": e.source,
+        "created_at": e.created_at.isoformat() + "Z",
+        "event_uuid": e.event_uuid,
+    }
+
+
+def _alert_to_dict(a: Alert) -> dict:
+    return {
+        "id": a.id,
+        "level": a.level,
+        "type": a.type,
+        "message": a.message,
+        "material_id": a.material_id,
+        "occurrences": a.occurrences,
+        "created_at": a.created_at.isoformat() + "Z",
+        "last_seen_at": a.last_seen_at.isoformat() + "Z",
+        "resolved": a.resolved,
+    }
+
+
+@main_bp.route("/api/stock-events")
+@login_required
+@role_required("admin")
+def api_stock_events():
+    cursor, limit = _page_args()
+    q = _filtered_events()
+    items, next_cursor = _keyset_page(q, StockEvent.id, cursor, limit)
+    return jsonify(
+        items=[_event_to_dict(e) for e in items],
+        next_cursor=next_cursor,
+        has_more=next_cursor is not None,
+    )
+
+
+@main_bp.route("/api/alerts")
+@login_required
+@role_required("admin")
+def api_alerts():
+    cursor, limit = _page_args()
+    q = _filtered_alerts()
+    items, next_cursor = _keyset_page(q, Alert.id, cursor, limit)
+    return jsonify(
+        items=[_alert_to_dict(a) for a in items],
+        next_cursor=next_cursor,
+        has_more=next_cursor is not None,
+    )
+
+
+@main_bp.route("/ledger")
+@login_required
+@role_required("admin")
+def ledger():
+    cursor, limit = _page_args()
+    q = _filtered_events()
+    events, next_cursor = _keyset_page(q, StockEvent.id, cursor, limit)
+    ids = {e.material_id for e in events}
+    names = dict(db.session.query(Material.id, Material.name).filter(Material.id.in_(ids)).all())
+    return render_template(
+        "ledger.html",
+        events=events,
+        names=names,
+        next_cursor=next_cursor,
+        args=request.args.to_dict(),
+    )
+
+
 @main_bp.route("/alerts")
 @login_required
 @role_required("admin")
 def alerts():
-    alerts = Alert.query.order_by(Alert.created_at.desc()).limit(200).all()
-    return render_template("alerts.html", alerts=alerts)
+    cursor, limit = _page_args()
+    q = _filtered_alerts()
+    alerts, next_cursor = _keyset_page(q, Alert.id, cursor, limit)
+    return render_template(
+        "alerts.html",
+        alerts=alerts,
+        next_cursor=next_cursor,
+        args=request.args.to_dict(),
+    )
+
 
 @main_bp.route("/alerts/<int:aid>/resolve", methods=["POST"])
 @login_required
@@ -141,6 +396,7 @@ def alerts():
 def resolve_alert(aid: int):
     a = Alert.query.get_or_404(aid)
     a.resolved = True
+    a.resolved_at = datetime.utcnow()
     db.session.commit()
     flash("Alerta resolvido", "success")
     return redirect(url_for("main.alerts"))
@@ -153,16 +409,17 @@ def delete_material(mid: int):
     m = Material.query.get_or_404(mid)
     db.session.delete(m)
     db.session.commit()
+    series_store.forget(mid)
     flash("Material removido", "success")
     sse_broker.publish({"type": "material_deleted"})
     return redirect(url_for("main.materials"))
 
 
-def _validate_qty(material: Material, qty: float, removing: bool) -> str | None:
-    """Return error message if invalid, otherwise None."""
+def _validate_qty(material: Material, qty: float, removing: bool, policy: MaterialPolicy | None = None) -> str | None:
+    """Return error message if invalid, otherwise None (``policy`` skips the lookup)."""
     if qty <= 0:
         return "Quantidade deve ser positiva"
-    pol = _policy_for(material)
+    pol = policy or _policy_for(material)
     # integer rule
     if pol.require_integer_units:
         if abs(qty - round(qty)) > 1e-9:
@@ -218,16 +475,12 @@ def _anomaly_check(material: Material, qty: float) -> str | None:
         return None
     z = (qty - mean) / std
     if z > zcut:
-        # Log alert
-        db.session.add(
-            Alert(
-                level="critical",
-                type="anomaly",
-                message=f"Remoção anômala detectada: {qty:.2f} {material.unit} em {material.name} (z={z:.2f})",
-                material_id=material.id,
-            )
+        alert_engine.raise_alert(
+            material.id,
+            "anomaly",
+            f"Remoção anômala detectada: {qty:.2f} {material.unit} em {material.name} (z={z:.2f})",
+            level="critical",
         )
-        db.session.commit()
         return "Remoção anômala detectada; operação bloqueada. Contate o admin."
     return None
 
@@ -244,16 +497,16 @@ def stock_add():
         return redirect(url_for("main.dashboard"))
     price = _latest_price(material_id)
     qty = round(qty, 2)
-    event = StockEvent(material_id=material_id, qty=qty, price_at_event=price, source="manual")
+    event = StockEvent(material_id=material_id, qty=qty, price_at_event=price, source="manual", created_at=datetime.utcnow())
     db.session.add(event)
+    db.session.flush()
+    row = (event.id, material_id, qty, event.created_at)
     db.session.commit()
+    series_store.record_events([row])
     sse_broker.publish({"type": "stock", "material_id": material_id})
     # Threshold alert for low stock
     pol = _policy_for(material)
-    if _current_stock(material_id) < pol.min_stock_threshold:
-        db.session.add(Alert(level="warning", type="threshold", message=f"Estoque baixo: {material.name}", material_id=material_id))
-        db.session.commit()
-        sse_broker.publish({"type": "alert"})
+    alert_engine.check_threshold(material, _current_stock(material_id), pol.min_stock_threshold)
     return redirect(url_for("main.dashboard"))
 
 
@@ -263,34 +516,70 @@ def stock_remove():
     material_id = int(request.form.get("material_id"))
     qty = float(request.form.get("qty", "0") or 0)
     material = Material.query.get_or_404(material_id)
-    err = _validate_qty(material, qty, removing=True) or _anomaly_check(material, qty)
+    # Validate and write under the material's lock; the insert re-checks the balance
+    with material_lock(material_id):
+        err = _validate_qty(material, qty, removing=True) or _anomaly_check(material, qty)
+        if not err:
+            price = _latest_price(material_id)
+            if not commit_removal(material_id, round(qty, 2), price, "manual"):
+                err = "Estoque insuficiente"
     if err:
         flash(err, "error")
         return redirect(url_for("main.dashboard"))
-    price = _latest_price(material_id)
-    qty = round(qty, 2)
-    event = StockEvent(material_id=material_id, qty=-qty, price_at_event=price, source="manual")
-    db.session.add(event)
-    db.session.commit()
     sse_broker.publish({"type": "stock", "material_id": material_id})
     # Threshold alert for low stock after removal
     pol = _policy_for(material)
-    if _current_stock(material_id) < pol.min_stock_threshold:
-        db.session.add(Alert(level="warning", type="threshold", message=f"Estoque baixo: {material.name}", material_id=material_id))
-        db.session.commit()
-        sse_broker.publish({"type": "alert"})
+    alert_engine.check_threshold(material, _current_stock(material_id), pol.min_stock_threshold)
     return redirect(url_for("main.dashboard"))
 
 
+@main_bp.route("/api/stock/<int:mid>/<action>", methods=["POST"])
+@token_required("stock:write")
+def api_device_stock(mid: int, action: str):
+    """Device/gateway counterpart of the MQTT ``factory/stock/<id>/add|remove`` topics."""
+    from .mqtt_client import _handle_stock
+
+    if action not in ("add", "remove"):
+        return jsonify(error="ação inválida"), 404
+    payload = request.get_json(silent=True) or {}
+    try:
+        qty = abs(float(payload.get("qty", 0)))
+    except (TypeError, ValueError):
+        return jsonify(error="qty inválido"), 400
+    err = _handle_stock(mid, qty if action == "add" else -qty, payload.get("eventId"), source="iot")
+    if err:
+        return jsonify(error=err), 422
+    return jsonify(ok=True, device=g.device["sub"])
+
+
+@main_bp.route("/api/price/<int:mid>/set", methods=["POST"])
+@token_required("price:write")
+def api_device_price(mid: int):
+    from .mqtt_client import _handle_price
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        value = float(payload.get("value", 0))
+    except (TypeError, ValueError):
+        return jsonify(error="value inválido"), 400
+    if value <= 0 or not db.session.get(Material, mid):
+        return jsonify(error="preço ou material inválido"), 422
+    _handle_price(mid, value)
+    return jsonify(ok=True, device=g.device["sub"])
+
+
 @main_bp.route("/sse")
 @login_required
 def sse_stream():
     q = sse_broker.register()
+    site = current_site()
 
     def event_stream():
         try:
             while True:
                 data: Dict = q.get()
+                if data.get("site", site) != site:
+                    continue
                 yield f"data: {json.dumps(data)}\n\n"
         finally:
             sse_broker.unregister(q)
@@ -316,51 +605,148 @@ def _month_bounds(ym: str | None) -> tuple[datetime, datetime]:
     return start, end
 
 
+def _report_month() -> str:
+    return _month_bounds(request.args.get("ym"))[0].strftime("%Y-%m")
+
+
+def _report_rows(start: datetime, end: datetime) -> list:
+    """Monthly spend per (category, item), cached until that month's data changes."""
+    ym = start.strftime("%Y-%m")
+    key = ("report", current_site(), ym, month_scope(ym))
+    rows = fragment_cache.get(key)
+    if rows is None:
+        rows = [
+            tuple(r)
+            for r in db.session.query(
+                Material.category,
+                Material.name,
+                func.sum(func.abs(StockEvent.qty) * StockEvent.price_at_event),
+            )
+            .join(Material, Material.id == StockEvent.material_id)
+            .filter(StockEvent.qty < 0)
+            .filter(StockEvent.created_at >= start, StockEvent.created_at < end)
+            .group_by(Material.category, Material.name)
+            .order_by(Material.category, Material.name)
+            .all()
+        ]
+        fragment_cache.set(key, rows)
+    return rows
+
+
+def _closing_stock(start: datetime, end: datetime) -> Dict[str, float]:
+    """Stock per material name at the end of the month (checkpoint + deltas)."""
+    ym = start.strftime("%Y-%m")
+    key = ("closing", current_site(), ym, month_scope(ym))
+    closing = fragment_cache.get(key)
+    if closing is None:
+        balances = stock_as_of(end)
+        names = dict(db.session.query(Material.id, Material.name).all())
+        closing = {names[mid]: bal for mid, bal in balances.items() if mid in names}
+        fragment_cache.set(key, closing)
+    return closing
+
+
+def _report_sites() -> list | None:
+    """All shards for ``?site=all``, otherwise None (the active site only)."""
+    return site_names() if request.args.get("site") == "all" else None
+
+
+def _report_version() -> tuple:
+    ym = _report_month()
+    sites = _report_sites()
+    if sites is None:
+        return month_scope(ym)
+    versions = []
+    for site in sites:
+        with use_site(site):
+            versions.append(month_scope(ym))
+    return tuple(versions)
+
+
+def _merged_report(start: datetime, end: datetime) -> tuple[list, Dict[str, float]]:
+    """(rows, closing stock) for the report, merged across shards for ``?site=all``.
+
+    Each shard is queried in its own thread; rows are summed by (category, item)
+    and closing stock by item name.
+    """
+    sites = _report_sites()
+    if sites is None:
+        return _report_rows(start, end), _closing_stock(start, end)
+    parts = map_sites(lambda: (_report_rows(start, end), _closing_stock(start, end)), sites)
+    spend: Dict[tuple, float] = {}
+    closing: Dict[str, float] = {}
+    for rows, stock in parts.values():
+        for cat, name, value in rows:
+            spend[(cat, name)] = spend.get((cat, name), 0.0) + (value or 0.0)
+        for name, bal in stock.items():
+            closing[name] = closing.get(name, 0.0) + bal
+    return [(cat, name, value) for (cat, name), value in sorted(spend.items())], closing
+
+
+@main_bp.route("/api/stock-as-of")
+@login_required
+@role_required("admin")
+def api_stock_as_of():
+    """Stock at the end of ``date`` (YYYY-MM-DD), optionally for one material."""
+    day = _parse_day(request.args.get("date"))
+    if day is None:
+        return jsonify(error="informe date=AAAA-MM-DD"), 400
+    material_id = request.args.get("material_id", type=int)
+    at = day + timedelta(days=1)
+    balances = stock_as_of(at, [material_id] if material_id else None)
+    return jsonify(
+        date=day.date().isoformat(),
+        items=[{"material_id": mid, "stock": round(bal, 6)} for mid, bal in sorted(balances.items())],
+    )
+
+
+@main_bp.route("/api/series")
+@login_required
+def api_series():
+    """Recent price/stock points per material from the in-memory rings.
+
+    ``ids`` is a comma-separated list (default: all), ``points`` caps each
+    series (downsampled), ``kind`` is ``price``, ``stock`` or ``both``.
+    """
+    kind = request.args.get("kind", "both")
+    if kind not in ("price", "stock", "both"):
+        return jsonify(error="kind deve ser price, stock ou both"), 400
+    try:
+        ids = [int(x) for x in request.args.get("ids", "").split(",") if x.strip()] or None
+    except ValueError:
+        return jsonify(error="ids inválidos"), 400
+    points = max(2, min(request.args.get("points", 60, type=int), series_store.capacity))
+    series_store.ensure_warm()  # no-op once the startup warm-up has run
+    kinds = ("price", "stock") if kind == "both" else (kind,)
+    data = series_store.series(ids, points, kinds)
+    return jsonify(points=points, series={str(mid): s for mid, s in data.items()})
+
+
 @main_bp.route("/reports")
 @login_required
 @role_required("admin")
+@versioned_view(lambda: (_report_version(), _nav_version()))
 def reports():
     ym = request.args.get("ym")  # YYYY-MM
     start, end = _month_bounds(ym)
 
-    rows = (
-        db.session.query(
-            Material.category,
-            Material.name,
-            func.sum(func.abs(StockEvent.qty) * StockEvent.price_at_event),
-        )
-        .join(Material, Material.id == StockEvent.material_id)
-        .filter(StockEvent.qty < 0)
-        .filter(StockEvent.created_at >= start, StockEvent.created_at < end)
-        .group_by(Material.category, Material.name)
-        .order_by(Material.category, Material.name)
-        .all()
-    )
+    rows, as_of = _merged_report(start, end)
 
     total = sum(r[2] or 0 for r in rows)
-    return render_template("reports.html", rows=rows, total=total, start=start, end=end)
+    return render_template(
+        "reports.html", rows=rows, total=total, start=start, end=end, as_of=as_of, closing=end - timedelta(days=1)
+    )
 
 
 @main_bp.route("/reports.csv")
 @login_required
 @role_required("admin")
+@versioned_view(_report_version)
 def reports_csv():
     ym = request.args.get("ym")
     start, end = _month_bounds(ym)
 
-    rows = (
-        db.session.query(
-            Material.category,
-            Material.name,
-            func.sum(func.abs(StockEvent.qty) * StockEvent.price_at_event),
-        )
-        .join(Material, Material.id == StockEvent.material_id)
-        .filter(StockEvent.qty < 0)
-        .filter(StockEvent.created_at >= start, StockEvent.created_at < end)
-        .group_by(Material.category, Material.name)
-        .order_by(Material.category, Material.name)
-        .all()
-    )
+    rows, _ = _merged_report(start, end)
 
     def generate():
         yield "categoria,item,valor\n"
@@ -374,14 +760,11 @@ def reports_csv():
     return Response(generate(), headers=headers)
 
 
-@main_bp.route("/analytics")
-@login_required
-@role_required("admin")
-def analytics():
-    # Simple monthly consumption average over last 3 months; suggest reorder when stock < avg
-    suggestions = []
-    materials = Material.query.order_by(Material.name).all()
-    for m in materials:
+def _suggestion_for(m: Material, today: str) -> tuple[float, float, float]:
+    """(monthly, stock, need) for one material, cached per material version and day."""
+    key = ("suggest", current_site(), m.id, data_version.get(("material", m.id)), today)
+    hit = fragment_cache.get(key)
+    if hit is None:
         # last 90 days removals
         start = datetime.utcnow() - timedelta(days=90)
         removes = (
@@ -394,6 +777,102 @@ def analytics():
         stock = _current_stock(m.id)
         pol = _policy_for(m)
         need = max(0.0, (monthly + pol.min_stock_threshold) - stock)
+        hit = (monthly, stock, need)
+        fragment_cache.set(key, hit)
+    return hit
+
+
+def _xlsx_response(chunks, filename: str) -> Response:
+    headers = {
+        "Content-Type": XLSX_MIMETYPE,
+        "Content-Disposition": f"attachment; filename={filename}",
+    }
+    return Response(stream_with_context(chunks), headers=headers)
+
+
+def _by_category(rows):
+    """Split rows ordered by category (first column) into (category, rows) sheets."""
+    for category, group in groupby(rows, key=itemgetter(0)):
+        yield category, (r[1:] for r in group)
+
+
+@main_bp.route("/reports.xlsx")
+@login_required
+@role_required("admin")
+def reports_xlsx():
+    start, end = _month_bounds(request.args.get("ym"))
+    rows, _ = _merged_report(start, end)
+    columns = [Column("Item", width=40), Column("Gasto (R$)", "number", total="sum")]
+    chunks = stream_workbook(_by_category((cat, name, value or 0.0) for cat, name, value in rows), columns)
+    return _xlsx_response(chunks, f"relatorio_{start.strftime('%Y-%m')}.xlsx")
+
+
+@main_bp.route("/ledger.xlsx")
+@login_required
+@role_required("admin")
+def ledger_xlsx():
+    q = _filtered_events()
+    rows = (
+        q.join(Material, Material.id == StockEvent.material_id)
+        .with_entities(
+            Material.category,
+            StockEvent.created_at,
+            Material.name,
+            StockEvent.qty,
+            StockEvent.price_at_event,
+            func.abs(StockEvent.qty) * StockEvent.price_at_event,
+            StockEvent.source,
+        )
+        .order_by(Material.category, StockEvent.id)
+        .yield_per(2000)
+    )
+    columns = [
+        Column("Data", "datetime", width=18),
+        Column("Item", width=32),
+        Column("Qtd", "number", total="sum"),
+        Column("Preço (R$)", "number"),
+        Column("Valor (R$)", "number", total="sum"),
+        Column("Origem", width=12),
+    ]
+    return _xlsx_response(stream_workbook(_by_category(rows), columns), "movimentacoes.xlsx")
+
+
+@main_bp.route("/prices.xlsx")
+@login_required
+@role_required("admin")
+def prices_xlsx():
+    q = (
+        db.session.query(Material.category, Price.created_at, Material.name, Price.value)
+        .join(Material, Material.id == Price.material_id)
+    )
+    material_id = request.args.get("material_id", type=int)
+    start, end = _parse_day(request.args.get("start")), _parse_day(request.args.get("end"))
+    if material_id:
+        q = q.filter(Price.material_id == material_id)
+    if start:
+        q = q.filter(Price.created_at >= start)
+    if end:
+        q = q.filter(Price.created_at < end + timedelta(days=1))
+    rows = q.order_by(Material.category, Price.id).yield_per(2000)
+    columns = [
+        Column("Data", "datetime", width=18),
+        Column("Item", width=32),
+        Column("Preço (R$)", "number", total="average"),
+    ]
+    return _xlsx_response(stream_workbook(_by_category(rows), columns), "precos.xlsx")
+
+
+@main_bp.route("/analytics")
+@login_required
+@role_required("admin")
+@versioned_view(lambda: (data_version.get(), datetime.utcnow().date(), _nav_version()))
+def analytics():
+    # Simple monthly consumption average over last 3 months; suggest reorder when stock < avg
+    suggestions = []
+    today = datetime.utcnow().date().isoformat()
+    materials = Material.query.order_by(Material.name).all()
+    for m in materials:
+        monthly, stock, need = _suggestion_for(m, today)
         if need > 0:
             suggestions.append({
                 'material': m,
@@ -409,24 +888,35 @@ def analytics():
 @role_required("admin")
 def analytics_suggest(mid: int):
     m = Material.query.get_or_404(mid)
-    url = current_app.config.get('ERP_WEBHOOK_URL')
-    payload = {
-        'materialId': m.id,
-        'materialName': m.name,
-        'unit': m.unit,
-        'ts': datetime.utcnow().isoformat() + 'Z',
-    }
-    if not url:
-        db.session.add(Alert(level='info', type='policy', message=f"Sugestão ERP (mock): {m.name}", material_id=m.id))
-        db.session.commit()
+    _, _, need = _suggestion_for(m, datetime.utcnow().date().isoformat())
+    if not current_app.config.get('ERP_WEBHOOK_URL'):
+        alert_engine.raise_alert(m.id, 'erp', f"Sugestão ERP (mock): {m.name}", level='info')
         flash("Sugestão enviada (mock)", "success")
-        sse_broker.publish({"type": "alert"})
         return redirect(url_for('main.analytics'))
-    try:
-        requests.post(url, json=payload, timeout=5)
-        flash("Sugestão enviada ao ERP", "success")
-    except Exception:
-        flash("Falha ao enviar ao ERP (ver logs)", "error")
+    enqueue_suggestion(m, round(need, 2))
+    db.session.commit()
+    wake_dispatcher()
+    flash("Sugestão na fila de envio ao ERP", "success")
     return redirect(url_for('main.analytics'))
 
 
+@main_bp.route("/analytics/suggest-all", methods=["POST"])
+@login_required
+@role_required("admin")
+def analytics_suggest_all():
+    today = datetime.utcnow().date().isoformat()
+    queued = 0
+    mock = not current_app.config.get('ERP_WEBHOOK_URL')
+    for m in Material.query.order_by(Material.name).all():
+        _, _, need = _suggestion_for(m, today)
+        if need <= 0:
+            continue
+        if mock:
+            alert_engine.raise_alert(m.id, 'erp', f"Sugestão ERP (mock): {m.name}", level='info')
+        else:
+            enqueue_suggestion(m, round(need, 2))
+        queued += 1
+    db.session.commit()
+    wake_dispatcher()
+    flash(f"{queued} sugestão(ões) na fila de envio ao ERP", "success")
+    return redirect(url_for('main.analytics'))
@@ -0,0 +1,145 @@
+"""Process runtime: background job ownership and leader election.
+
+Under ``manage.py serve`` every worker process serves requests, but the
+simulator, the MQTT subscription, the ERP dispatcher and the checkpointer
+must run exactly once. Workers compete for an exclusive ``flock`` on
+``RUNTIME_DIR/leader.lock``; the holder schedules the jobs and the others keep
+retrying every ``LEADER_POLL_SEC`` (a scheduler job), so if the leader dies
+the kernel drops its lock and another worker takes over. ``serve`` (gunicorn)
+is POSIX only; ``fcntl`` is imported lazily so that ``manage.py run`` and the
+rest of the app still import on Windows.
+"""
+
+import os
+from functools import partial
+from typing import Dict, List, Optional
+
+from flask import Flask, current_app
+
+from . import db, sse_broker
+from .scheduler import scheduler
+
+
+_election: Optional["LeaderElection"] = None
+
+
+def start_background(app: Flask) -> None:
+    """Start every singleton background job in this process."""
+    from .checkpoints import start_checkpointer
+    from .erp_outbox import start_erp_dispatcher
+    from .iot_simulator import start_simulator
+    from .mqtt_client import start_mqtt
+
+    start_simulator(app)
+    start_mqtt(app)
+    start_erp_dispatcher(app)
+    start_checkpointer(app)
+
+
+def stop_background(timeout: float = 5.0) -> None:
+    """Stop the jobs, letting each finish the tick or batch in flight."""
+    from .checkpoints import stop_checkpointer
+    from .erp_outbox import stop_erp_dispatcher
+    from .iot_simulator import stop_simulator
+    from .mqtt_client import stop_mqtt
+
+    stop_simulator(timeout)
+    stop_mqtt(timeout)
+    stop_erp_dispatcher(timeout)
+    stop_checkpointer(timeout)
+
+
+class LeaderElection:
+    def __init__(self, app: Flask, path: str, poll: float) -> None:
+        self.app = app
+        self.path = path
+        self.poll = poll
+        self.is_leader = False
+        self._fd: Optional[int] = None
+
+    def _try_acquire(self) -> bool:
+        import fcntl
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode("ascii"))
+        self._fd = fd
+        return True
+
+    def _poll(self) -> None:
+        if self.is_leader or not self._try_acquire():
+            return
+        self.is_leader = True
+        scheduler.remove("leader.election")
+        self.app.logger.info(f"Processo {os.getpid()} é o líder: iniciando jobs em background")
+        start_background(self.app)
+
+    def start(self) -> None:
+        scheduler.every("leader.election", self._poll, self.poll, "Eleição do líder (jobs únicos)", run_now=True)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        scheduler.remove("leader.election", timeout)
+        if self.is_leader:
+            stop_background(timeout)
+            self.is_leader = False
+        if self._fd is not None:
+            os.close(self._fd)  # releases the flock
+            self._fd = None
+
+
+def start_election(app: Flask) -> LeaderElection:
+    global _election
+    os.makedirs(app.config["RUNTIME_DIR"], exist_ok=True)
+    path = os.path.join(app.config["RUNTIME_DIR"], "leader.lock")
+    _election = LeaderElection(app, path, float(app.config.get("LEADER_POLL_SEC", 5)))
+    _election.start()
+    return _election
+
+
+def stop_election(timeout: float = 5.0) -> None:
+    if _election is not None:
+        _election.stop(timeout)
+
+
+def is_leader() -> bool:
+    return _election is not None and _election.is_leader
+
+
+def _relay(sites: List[str], seen: Dict[str, int]) -> None:
+    from .series import series_store
+    from .sharding import use_site
+    from .versioning import data_version
+
+    for site in sites:
+        n = data_version.foreign_writes(site)
+        if n == seen[site]:
+            continue
+        seen[site] = n
+        with use_site(site):
+            # Pull the other workers' rows into this worker's sparklines
+            try:
+                series_store.catch_up()
+            except Exception as e:
+                current_app.logger.warning(f"Falha ao atualizar séries ({site}): {e}")
+            finally:
+                db.session.remove()
+            sse_broker.publish({"type": "refresh"})
+
+
+def start_sse_relay(app: Flask) -> None:
+    """Forward other workers' writes to this worker's SSE clients as ``refresh`` events."""
+    from .sharding import site_names
+    from .versioning import data_version
+
+    sites = site_names(app)
+    seen = {site: data_version.foreign_writes(site) for site in sites}
+    scheduler.every("sse.relay", partial(_relay, sites, seen), 1.0, "Relay SSE de outros workers")
+
+
+def stop_sse_relay() -> None:
+    scheduler.remove("sse.relay")
@@ -0,0 +1,379 @@
+"""One scheduler for every background job of the process (APScheduler).
+
+Jobs run on bounded thread pools: ``default`` (``SCHEDULER_WORKERS``) for
+database work and ``io`` (``SCHEDULER_IO_WORKERS``) for outbound HTTP. Each
+job has at most one run in flight: a run that comes due while the previous
+one is still going is dropped and replaced by a single catch-up run right
+after it, and runs missed while the process was busy are coalesced into one,
+so slow jobs never pile up. Interval jobs get up to ``SCHEDULER_JITTER_SEC``
+of random delay so sites and workers don't line up. Between runs no thread
+wakes up.
+
+Every run goes through ``_timed``, which records its lag (start minus the
+scheduled time, i.e. time spent waiting for a pool slot), its duration and its
+outcome as Prometheus metrics and in the status shown on ``/jobs``. Under
+``serve`` each worker has its own scheduler; with ``SCHEDULER_STATUS_DIR`` set
+they publish their status there so any worker can show all of them.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Set
+
+from apscheduler.events import (
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+    EVENT_JOB_SUBMITTED,
+    JobEvent,
+)
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from flask import Flask
+from prometheus_client import Counter, Histogram
+
+from . import db
+from .sharding import site_names, use_site
+
+
+JOB_DURATION = Histogram("scheduler_job_duration_seconds", "Background job run time", ["job"])
+JOB_LAG = Histogram(
+    "scheduler_job_lag_seconds",
+    "Delay between a job's scheduled time and its start",
+    ["job"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60),
+)
+JOB_RUNS = Counter("scheduler_job_runs_total", "Background job runs by outcome", ["job", "outcome"])
+
+
+@dataclass
+class JobStatus:
+    id: str
+    description: str
+    executor: str
+    runs: int = 0
+    failures: int = 0
+    missed: int = 0  # runs dropped past the misfire grace time
+    skipped: int = 0  # runs dropped because the previous one was still going
+    running: bool = False
+    rerun: bool = False
+    scheduled_at: Optional[datetime] = None
+    last_start: Optional[datetime] = None
+    last_duration: Optional[float] = None
+    last_lag: Optional[float] = None
+    last_error: Optional[str] = None
+
+
+def _iso(dt: Optional[datetime]) -> Optional[str]:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S") if dt else None
+
+
+class JobScheduler:
+    def __init__(self) -> None:
+        self._app: Optional[Flask] = None
+        self._sched: Optional[BackgroundScheduler] = None
+        self._status: Dict[str, JobStatus] = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.jitter = 1.0
+        self._oneshot: Set[str] = set()
+        self._queued: Set[str] = set()  # one-shot jobs waiting to start
+        self.status_dir: Optional[str] = None
+        self._published = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._sched is not None and self._sched.running
+
+    def start(self, app: Flask) -> None:
+        if self.running:
+            return
+        cfg = app.config
+        self._app = app
+        self.jitter = float(cfg.get("SCHEDULER_JITTER_SEC", 1.0))
+        self.status_dir = cfg.get("SCHEDULER_STATUS_DIR")
+        if self.status_dir:
+            os.makedirs(self.status_dir, exist_ok=True)
+        self._sched = BackgroundScheduler(
+            executors={
+                "default": ThreadPoolExecutor(int(cfg.get("SCHEDULER_WORKERS", 4))),
+                "io": ThreadPoolExecutor(int(cfg.get("SCHEDULER_IO_WORKERS", 2))),
+            },
+            job_defaults={
+                "coalesce": True,
+                "max_instances": 1,
+                "misfire_grace_time": int(cfg.get("SCHEDULER_MISFIRE_GRACE_SEC", 60)),
+            },
+            timezone=timezone.utc,
+        )
+        # Skipped runs are counted in the job status; don't log each one
+        logging.getLogger("apscheduler.scheduler").setLevel(logging.ERROR)
+        self._sched.add_listener(self._on_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+        self._sched.start()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop scheduling; with ``wait``, let the runs in flight finish."""
+        if self.running:
+            self._sched.shutdown(wait=wait)
+        if self.status_dir:
+            try:
+                os.unlink(os.path.join(self.status_dir, f"{os.getpid()}.json"))
+            except OSError:
+                pass
+
+    # -- jobs ----------------------------------------------------------------
+
+    def every(
+        self,
+        job_id: str,
+        fn: Callable[[], object],
+        seconds: float,
+        description: str,
+        per_site: bool = False,
+        executor: str = "default",
+        run_now: bool = False,
+    ) -> None:
+        """Run ``fn`` every ``seconds`` (plus jitter), replacing any job with the same id."""
+        jitter = min(self.jitter, seconds / 4) or None
+        self.add(job_id, fn, IntervalTrigger(seconds=seconds, jitter=jitter, timezone=timezone.utc),
+                 description, per_site, executor, run_now)
+
+    def add(
+        self,
+        job_id: str,
+        fn: Callable[[], object],
+        trigger: BaseTrigger,
+        description: str,
+        per_site: bool = False,
+        executor: str = "default",
+        run_now: bool = False,
+    ) -> None:
+        """Schedule ``fn`` in an app context; ``per_site`` runs it once per site shard."""
+        if not self.running:
+            raise RuntimeError("scheduler não iniciado")
+        self._track(job_id, description, executor)
+        self._oneshot.discard(job_id)
+        extra = {"next_run_time": datetime.now(timezone.utc)} if run_now else {}
+        self._sched.add_job(
+            self._timed,
+            trigger,
+            args=(job_id, fn, per_site),
+            id=job_id,
+            name=description,
+            executor=executor,
+            replace_existing=True,
+            **extra,
+        )
+
+    def once(self, job_id: str, fn: Callable[[], object], delay: float, description: str) -> bool:
+        """Run ``fn`` once after ``delay`` seconds unless a run is already pending.
+
+        Returns False when the scheduler isn't running, so callers can fall back.
+        """
+        if not self.running:
+            return False
+        with self._lock:
+            if job_id in self._queued:
+                return True  # hot path: called on every alert write
+            self._queued.add(job_id)
+        self._track(job_id, description, "default")
+        self._oneshot.add(job_id)
+        try:
+            self._sched.add_job(
+                self._timed,
+                "date",
+                args=(job_id, fn, False),
+                id=job_id,
+                name=description,
+                run_date=datetime.now(timezone.utc) + timedelta(seconds=delay),
+            )
+        except ConflictingIdError:
+            pass  # the pending run will pick this up too
+        return True
+
+    def run_soon(self, job_id: str) -> None:
+        """Move a job's next run to now (e.g. new work arrived)."""
+        if not self.running:
+            return
+        try:
+            self._sched.modify_job(job_id, next_run_time=datetime.now(timezone.utc))
+        except JobLookupError:
+            pass
+
+    def remove(self, job_id: str, timeout: Optional[float] = None) -> None:
+        """Unschedule a job; waits up to ``timeout`` seconds for a run in flight."""
+        self._oneshot.discard(job_id)
+        with self._lock:
+            self._queued.discard(job_id)
+        if self.running:
+            try:
+                self._sched.remove_job(job_id)
+            except JobLookupError:
+                pass
+        if not timeout:
+            return
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while job_id in self._status and self._status[job_id].running:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._idle.wait(left)
+
+    def _track(self, job_id: str, description: str, executor: str) -> None:
+        with self._lock:
+            if job_id not in self._status:
+                self._status[job_id] = JobStatus(job_id, description, executor)
+
+    # -- instrumentation -----------------------------------------------------
+
+    def _on_event(self, event: JobEvent) -> None:
+        with self._lock:
+            st = self._status.get(event.job_id)
+            if st is None:
+                return
+            if event.code == EVENT_JOB_SUBMITTED:
+                st.scheduled_at = event.scheduled_run_times[-1]
+                return
+            if event.code == EVENT_JOB_MISSED:
+                st.missed += 1
+                self._queued.discard(event.job_id)  # the next once() schedules it again
+                outcome = "missed"
+            else:
+                st.skipped += 1
+                st.rerun = True
+                outcome = "skipped"
+        JOB_RUNS.labels(event.job_id, outcome).inc()
+
+    def _timed(self, job_id: str, fn: Callable[[], object], per_site: bool) -> None:
+        app = self._app
+        started = datetime.now(timezone.utc)
+        t0 = time.perf_counter()
+        with self._lock:
+            st = self._status[job_id]
+            st.running, st.rerun, st.last_start = True, False, started
+            self._queued.discard(job_id)
+            lag = max(0.0, (started - st.scheduled_at).total_seconds()) if st.scheduled_at else 0.0
+        JOB_LAG.labels(job_id).observe(lag)
+        errors: List[str] = []
+        try:
+            for site in site_names(app) if per_site else [None]:
+                with app.app_context(), use_site(site):
+                    try:
+                        fn()
+                    except Exception as e:
+                        db.session.rollback()
+                        label = f" ({site})" if site else ""
+                        app.logger.warning(f"Falha no job {job_id}{label}: {e}")
+                        errors.append(f"{site}: {e}" if site else str(e))
+                    finally:
+                        db.session.remove()
+        finally:
+            duration = time.perf_counter() - t0
+            JOB_DURATION.labels(job_id).observe(duration)
+            JOB_RUNS.labels(job_id, "error" if errors else "ok").inc()
+            with self._idle:
+                st.running = False
+                st.runs += 1
+                st.failures += bool(errors)
+                st.last_duration, st.last_lag = duration, lag
+                st.last_error = "; ".join(errors)[:500] or None
+                rerun, st.rerun = st.rerun, False
+                self._idle.notify_all()
+            if rerun and self.running:
+                self._catch_up(job_id, fn, per_site)
+            self._publish()
+
+    def _catch_up(self, job_id: str, fn: Callable[[], object], per_site: bool) -> None:
+        # One run for everything that came due while this one was going
+        now = datetime.now(timezone.utc)
+        try:
+            self._sched.modify_job(job_id, next_run_time=now)
+        except JobLookupError:
+            # One-shot jobs leave the store once submitted; anything else was removed
+            if job_id not in self._oneshot:
+                return
+            with self._lock:
+                self._queued.add(job_id)
+            try:
+                self._sched.add_job(self._timed, "date", args=(job_id, fn, per_site), id=job_id, run_date=now)
+            except ConflictingIdError:
+                pass
+
+    # -- status --------------------------------------------------------------
+
+    def status(self) -> List[dict]:
+        """This process's jobs, JSON-ready; ``next_run`` is None when unscheduled."""
+        jobs = {}
+        if self.running:
+            jobs = {j.id: j for j in self._sched.get_jobs()}
+        with self._lock:
+            out = []
+            for st in sorted(self._status.values(), key=lambda s: s.id):
+                row = asdict(st)
+                del row["rerun"]
+                job = jobs.get(st.id)
+                row.update(
+                    scheduled_at=_iso(st.scheduled_at),
+                    last_start=_iso(st.last_start),
+                    next_run=_iso(job.next_run_time) if job else None,
+                    trigger=str(job.trigger) if job else None,
+                )
+                out.append(row)
+        return out
+
+    def _publish(self, force: bool = False) -> None:
+        # At most one write per second per process: the SSE relay runs that often
+        if not self.status_dir or (not force and time.monotonic() - self._published < 1.0):
+            return
+        self._published = time.monotonic()
+        path = os.path.join(self.status_dir, f"{os.getpid()}.json")
+        from .runtime import is_leader
+
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "leader": is_leader(), "jobs": self.status()}, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            self._app.logger.warning(f"Falha ao publicar estado dos jobs: {e}")
+
+    def processes(self) -> List[dict]:
+        """Status of every live process sharing ``SCHEDULER_STATUS_DIR`` (this one first)."""
+        from .runtime import is_leader
+
+        me = {"pid": os.getpid(), "leader": is_leader(), "jobs": self.status()}
+        if not self.status_dir or not os.path.isdir(self.status_dir):
+            return [me]
+        self._publish(force=True)
+        out = [me]
+        for name in sorted(os.listdir(self.status_dir)):
+            if not name.endswith(".json") or name == f"{os.getpid()}.json":
+                continue
+            path = os.path.join(self.status_dir, name)
+            try:
+                os.kill(int(name[:-5]), 0)
+            except (ValueError, ProcessLookupError):
+                try:
+                    os.unlink(path)  # worker died without cleaning up
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path, encoding="utf-8") as f:
+                    out.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        out.sort(key=lambda p: (not p["leader"], p["pid"] != os.getpid(), p["pid"]))
+        return out
+
+
+scheduler = JobScheduler()
@@ -0,0 +1,64 @@
+"""In-place upgrades for databases created by older versions.
+
+``db.create_all()`` creates missing tables but never touches existing ones,
+so columns and indexes added to existing models must be applied here. Every
+step is idempotent (columns are added only when missing, indexes are created
+with ``checkfirst``) and runs at startup on the main database and on every
+site shard, right after ``create_all``.
+
+New NOT NULL columns carry a server default so they can be added to tables
+that already have rows; an optional backfill then fills them from existing
+data.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy as sa
+
+from .sharding import DEFAULT_SITE, GLOBAL_TABLES, engine_for, site_names
+
+# table -> [(column, DDL type and default, backfill UPDATE or None)]
+COLUMNS: Dict[str, List[Tuple[str, str, Optional[str]]]] = {
+    "alert": [
+        ("occurrences", "INTEGER NOT NULL DEFAULT 1", None),
+        ("last_seen_at", "DATETIME", "UPDATE alert SET last_seen_at = created_at WHERE last_seen_at IS NULL"),
+        ("resolved_at", "DATETIME", None),
+    ],
+    "user": [
+        ("site", "VARCHAR(40) NOT NULL DEFAULT 'default'", None),
+    ],
+}
+
+
+def _upgrade_engine(engine, tables: List[sa.Table]) -> List[str]:
+    applied = []
+    existing = set(sa.inspect(engine).get_table_names())
+    with engine.begin() as conn:
+        quote = conn.dialect.identifier_preparer.quote
+        for table in tables:
+            if table.name not in existing:
+                continue
+            have = {c["name"] for c in sa.inspect(conn).get_columns(table.name)}
+            for name, ddl, backfill in COLUMNS.get(table.name, ()):
+                if name in have:
+                    continue
+                conn.execute(sa.text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(name)} {ddl}"))
+                if backfill:
+                    conn.execute(sa.text(backfill))
+                applied.append(f"{table.name}.{name}")
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    return applied
+
+
+def upgrade(db) -> List[str]:
+    """Bring the main database and every shard up to the current models.
+
+    Returns the columns that were added (``table.column``), for logging.
+    """
+    tables = db.metadata.sorted_tables
+    applied = _upgrade_engine(engine_for(db, DEFAULT_SITE), tables)
+    sharded = [t for t in tables if t.name not in GLOBAL_TABLES]
+    for site in site_names()[1:]:
+        applied += [f"{site}:{c}" for c in _upgrade_engine(engine_for(db, site), sharded)]
+    return applied
@@ -0,0 +1,375 @@
+"""In-memory recent history per material for dashboard sparklines.
+
+Each material keeps two fixed-size ring buffers (price and stock balance),
+each a pair of preallocated float64 NumPy arrays (timestamp, value), so
+memory per material is fixed: ``SERIES_POINTS * 2 series * 16 bytes`` of
+array data (8 KiB at the default 256 points) plus about 0.5 KiB of Python
+object overhead. Nothing is allocated per point.
+
+The write paths (dashboard forms, MQTT/device API, simulator) append the
+rows they commit, tagged with their primary keys. Rows committed elsewhere
+(another ``serve`` worker, CLI imports) are pulled by ``catch_up``, which
+reads only ids above the site's watermark; ids are tracked so a row is never
+applied twice. Rings are warmed from the DB at server startup (or on first
+use of a site).
+
+The same feed keeps each material's current balance, latest price and
+today's (UTC) removals, which the business metrics export.
+"""
+
+import threading
+from datetime import datetime
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from flask import Flask, current_app
+from sqlalchemy import func, select
+
+from . import db
+from .scheduler import scheduler
+from .sharding import current_site, site_names, use_site
+
+
+_EPOCH = datetime(1970, 1, 1)
+# Own ids kept for de-duplication before a catch-up; past this, older gaps are given up
+_MAX_PENDING_IDS = 100_000
+
+# (id, material_id, value, created_at); value is a price or a stock delta
+Row = Tuple[int, int, float, datetime]
+
+
+def _epoch(dt: datetime) -> float:
+    return (dt - _EPOCH).total_seconds()
+
+
+def _day_start() -> datetime:
+    return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class _Ring:
+    __slots__ = ("ts", "val", "head", "size")
+
+    def __init__(self, capacity: int) -> None:
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.val = np.zeros(capacity, dtype=np.float64)
+        self.head = 0  # next slot to write
+        self.size = 0
+
+    def push(self, ts: float, value: float) -> None:
+        self.ts[self.head] = ts
+        self.val[self.head] = value
+        self.head = (self.head + 1) % self.ts.shape[0]
+        self.size = min(self.size + 1, self.ts.shape[0])
+
+    def fill(self, ts: np.ndarray, values: np.ndarray) -> None:
+        """Replace the contents with the last ``capacity`` of (ts, values)."""
+        cap = self.ts.shape[0]
+        n = min(cap, ts.shape[0])
+        self.ts[:n] = ts[-n:]
+        self.val[:n] = values[-n:]
+        self.size = n
+        self.head = n % cap
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Oldest-first copies of the stored points."""
+        if self.size < self.ts.shape[0]:
+            return self.ts[: self.size].copy(), self.val[: self.size].copy()
+        order = np.r_[self.head : self.ts.shape[0], 0 : self.head]
+        return self.ts[order], self.val[order]
+
+    def last(self) -> Optional[float]:
+        return float(self.val[self.head - 1]) if self.size else None
+
+    def last_ts(self) -> float:
+        return float(self.ts[self.head - 1])
+
+
+class _Feed:
+    """Id watermark for one table of one site."""
+
+    def __init__(self) -> None:
+        self.watermark = 0
+        self.pending: Set[int] = set()  # applied ids above the watermark
+
+    def accept(self, row_id: int) -> bool:
+        if row_id <= self.watermark or row_id in self.pending:
+            return False
+        if row_id == self.watermark + 1:
+            self.watermark = row_id
+            while self.watermark + 1 in self.pending:
+                self.watermark += 1
+                self.pending.discard(self.watermark)
+        else:
+            self.pending.add(row_id)
+            if len(self.pending) > _MAX_PENDING_IDS:
+                self.watermark = max(self.pending)
+                self.pending.clear()
+        return True
+
+
+class _SiteSeries:
+    def __init__(self) -> None:
+        self.price: Dict[int, _Ring] = {}
+        self.stock: Dict[int, _Ring] = {}
+        self.balance: Dict[int, float] = {}
+        self.prices = _Feed()
+        self.events = _Feed()
+        self.ready = False
+        self.stale = False  # out-of-order rows arrived: re-warm on next read
+        self.day = _epoch(_day_start())
+        self.removed: Dict[int, float] = {}  # today's removed quantity
+        self.removals = 0  # today's removal events
+
+    def roll_day(self) -> None:
+        day = _epoch(_day_start())
+        if day > self.day:
+            self.day, self.removed, self.removals = day, {}, 0
+
+
+class SeriesStore:
+    def __init__(self, capacity: int = 256) -> None:
+        self.capacity = capacity
+        self._sites: Dict[str, _SiteSeries] = {}
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:
+        self.capacity = int(app.config.get("SERIES_POINTS", 256))
+        app.extensions["series"] = self
+
+    def _site(self, site: str) -> _SiteSeries:
+        s = self._sites.get(site)
+        if s is None:
+            s = self._sites[site] = _SiteSeries()
+        return s
+
+    def _ring(self, rings: Dict[int, _Ring], material_id: int) -> _Ring:
+        ring = rings.get(material_id)
+        if ring is None:
+            ring = rings[material_id] = _Ring(self.capacity)
+        return ring
+
+    # -- write paths -------------------------------------------------------
+
+    def record_prices(self, rows: Iterable[Row]) -> None:
+        """Append committed Price rows of the active site."""
+        with self._lock:
+            s = self._site(current_site())
+            if not s.ready:
+                return  # warm-up / catch-up will read them from the DB
+            for row_id, mid, value, at in rows:
+                if s.prices.accept(row_id):
+                    self._push(s, s.price, mid, _epoch(at), value)
+
+    def record_events(self, rows: Iterable[Row]) -> None:
+        """Append committed StockEvent rows (qty deltas) of the active site."""
+        with self._lock:
+            s = self._site(current_site())
+            if not s.ready:
+                return
+            for row_id, mid, qty, at in rows:
+                if s.events.accept(row_id):
+                    bal = s.balance.get(mid, 0.0) + qty
+                    s.balance[mid] = bal
+                    ts = _epoch(at)
+                    self._push(s, s.stock, mid, ts, bal)
+                    if qty < 0:
+                        s.roll_day()
+                        if ts >= s.day:
+                            s.removed[mid] = s.removed.get(mid, 0.0) - qty
+                            s.removals += 1
+
+    def _push(self, s: _SiteSeries, rings: Dict[int, _Ring], mid: int, ts: float, value: float) -> None:
+        ring = self._ring(rings, mid)
+        if ring.size and ts < ring.last_ts():
+            s.stale = True  # back-dated (e.g. an import): the window has to be re-read
+        ring.push(ts, value)
+
+    def invalidate(self) -> None:
+        """Re-warm the active site on its next read (after bulk or back-dated writes)."""
+        with self._lock:
+            s = self._sites.get(current_site())
+            if s is not None:
+                s.stale = True
+
+    def forget(self, material_id: int) -> None:
+        with self._lock:
+            s = self._site(current_site())
+            s.price.pop(material_id, None)
+            s.stock.pop(material_id, None)
+            s.balance.pop(material_id, None)
+            s.removed.pop(material_id, None)
+
+    # -- loading -----------------------------------------------------------
+
+    def warm(self) -> None:
+        """Load the last ``capacity`` points of every material of the active site.
+
+        A fixed handful of queries whatever the number of materials: one
+        windowed query per series and the balances from the daily checkpoints.
+        """
+        from .checkpoints import stock_through
+        from .models import Material, Price, StockEvent
+
+        site = current_site()
+        with self._warm_lock:
+            cap = self.capacity
+            snap = _SiteSeries()
+            # Watermarks first: rows committed while we read are picked up by catch_up
+            snap.prices.watermark = db.session.query(func.coalesce(func.max(Price.id), 0)).scalar()
+            snap.events.watermark = db.session.query(func.coalesce(func.max(StockEvent.id), 0)).scalar()
+            prices = _latest_per_material(Price, Price.value, snap.prices.watermark, cap)
+            events = _latest_per_material(StockEvent, StockEvent.qty, snap.events.watermark, cap)
+            # Balance at the watermark from the newest checkpoints plus the events after them
+            snap.balance = {mid: 0.0 for (mid,) in db.session.query(Material.id)}
+            snap.balance.update(stock_through(snap.events.watermark))
+            for mid, rows in groupby(prices, key=itemgetter(0)):
+                rows = list(rows)[::-1]  # oldest first
+                ts = np.array([_epoch(r[1]) for r in rows])
+                self._ring(snap.price, mid).fill(ts, np.array([r[2] for r in rows], dtype=np.float64))
+            for mid, rows in groupby(events, key=itemgetter(0)):
+                # Walk back from the balance: balance after event i =
+                # balance - sum(qty of the newer events in the window)
+                rows = list(rows)  # newest first
+                bal = snap.balance.get(mid, 0.0)
+                qty = np.array([r[2] for r in rows], dtype=np.float64)
+                after = bal - np.concatenate(([0.0], np.cumsum(qty)[:-1]))
+                ts = np.array([_epoch(r[1]) for r in rows])
+                self._ring(snap.stock, mid).fill(ts[::-1], after[::-1])
+            today = select(
+                StockEvent.material_id, func.sum(-StockEvent.qty), func.count(StockEvent.id)
+            ).where(
+                StockEvent.qty < 0,
+                StockEvent.created_at >= _day_start(),
+                StockEvent.id <= snap.events.watermark,
+            ).group_by(StockEvent.material_id)
+            for mid, removed, n in db.session.execute(today):
+                snap.removed[mid] = float(removed)
+                snap.removals += n
+            snap.ready = True
+            with self._lock:
+                self._sites[site] = snap
+        self.catch_up()
+
+    def catch_up(self, limit: int = 50_000) -> int:
+        """Apply rows of the active site committed by other processes; returns rows read."""
+        from .models import Price, StockEvent
+
+        with self._lock:
+            s = self._sites.get(current_site())
+            if s is None or not s.ready:
+                return 0
+            price_wm, event_wm = s.prices.watermark, s.events.watermark
+        prices = db.session.execute(
+            select(Price.id, Price.material_id, Price.value, Price.created_at)
+            .where(Price.id > price_wm)
+            .order_by(Price.id)
+            .limit(limit)
+        ).all()
+        events = db.session.execute(
+            select(StockEvent.id, StockEvent.material_id, StockEvent.qty, StockEvent.created_at)
+            .where(StockEvent.id > event_wm)
+            .order_by(StockEvent.id)
+            .limit(limit)
+        ).all()
+        self.record_prices(prices)
+        self.record_events(events)
+        if len(prices) == limit or len(events) == limit:
+            self.invalidate()  # a bulk load: re-warming beats replaying it
+        return len(prices) + len(events)
+
+    def ensure_warm(self) -> None:
+        """Warm a cold site inline; a stale one is re-warmed in the background
+        while readers keep the current buffers."""
+        site = current_site()
+        s = self._sites.get(site)
+        if s is None or not s.ready:
+            self.warm()
+        elif s.stale:
+            app = current_app._get_current_object()
+            job = partial(warm_all, app, [site])
+            if not scheduler.once(f"series.rewarm.{site}", job, 0, f"Séries: recarga após escrita retroativa ({site})"):
+                self.warm()
+
+    # -- reads -------------------------------------------------------------
+
+    def totals(self) -> Tuple[Dict[int, Tuple[float, Optional[float], float]], int]:
+        """``({material_id: (balance, latest price, removed today)}, removal events today)``."""
+        with self._lock:
+            s = self._sites.get(current_site())
+            if s is None:
+                return {}, 0
+            s.roll_day()
+            ids = set(s.balance) | set(s.price)
+            return {
+                mid: (
+                    s.balance.get(mid, 0.0),
+                    s.price[mid].last() if mid in s.price else None,
+                    s.removed.get(mid, 0.0),
+                )
+                for mid in ids
+            }, s.removals
+
+    def series(self, material_ids: Optional[List[int]], points: int, kinds: Iterable[str]) -> Dict[int, dict]:
+        """Downsampled ``{"t": [...], "v": [...]}`` per kind for each material (no DB access)."""
+        out: Dict[int, dict] = {}
+        with self._lock:
+            s = self._sites.get(current_site())
+            if s is None:
+                return out
+            ids = material_ids if material_ids is not None else sorted(set(s.price) | set(s.stock))
+            snaps = {
+                mid: {k: (getattr(s, k)[mid].snapshot() if mid in getattr(s, k) else None) for k in kinds}
+                for mid in ids
+            }
+        for mid, by_kind in snaps.items():
+            out[mid] = {k: _downsample(*snap, points) if snap else {"t": [], "v": []} for k, snap in by_kind.items()}
+        return out
+
+
+def _latest_per_material(model, value_col, watermark: int, limit: int) -> list:
+    """``(material_id, created_at, value)`` of each material's newest ``limit`` rows
+    up to ``watermark``, grouped by material, newest first."""
+    rn = func.row_number().over(
+        partition_by=model.material_id, order_by=(model.created_at.desc(), model.id.desc())
+    ).label("rn")
+    ranked = (
+        select(model.material_id, model.created_at, value_col.label("value"), rn)
+        .where(model.id <= watermark)
+        .subquery()
+    )
+    q = (
+        select(ranked.c.material_id, ranked.c.created_at, ranked.c.value)
+        .where(ranked.c.rn <= limit)
+        .order_by(ranked.c.material_id, ranked.c.rn)
+    )
+    return db.session.execute(q).all()
+
+
+def _downsample(ts: np.ndarray, values: np.ndarray, points: int) -> dict:
+    """Evenly spaced sample of ``points`` points, always keeping the first and last."""
+    n = ts.shape[0]
+    if n > points:
+        idx = np.linspace(0, n - 1, points).round().astype(np.int64)
+        ts, values = ts[idx], values[idx]
+    return {"t": np.round(ts).astype(np.int64).tolist(), "v": np.round(values, 4).tolist()}
+
+
+series_store = SeriesStore()
+
+
+def warm_all(app: Flask, sites: Optional[List[str]] = None) -> None:
+    """Warm every site's rings (run as a one-shot job at server start)."""
+    for site in sites or site_names(app):
+        with app.app_context(), use_site(site):
+            try:
+                series_store.warm()
+            except Exception as e:
+                app.logger.warning(f"Falha ao carregar séries ({site}): {e}")
+
+
+def start_warmup(app: Flask) -> None:
+    scheduler.once("series.warmup", partial(warm_all, app), 0, "Séries: carga inicial dos sparklines")
@@ -0,0 +1,67 @@
+"""Gunicorn settings and hooks for ``manage.py serve`` (loaded as ``python:app.serve_conf``).
+
+Workers use the ``gthread`` class: each process serves SERVE_THREADS requests
+concurrently, which suits this I/O-bound app (SQLite, templates, SSE) better
+than one request per process. The app is loaded after fork
+(``preload_app = False``) so every worker opens its own DB connections.
+"""
+
+import os
+import shutil
+
+from app.config import Config
+
+
+bind = os.environ.get("SERVE_BIND", "0.0.0.0:5000")
+workers = Config.SERVE_WORKERS
+threads = Config.SERVE_THREADS
+worker_class = "gthread"
+graceful_timeout = Config.SERVE_GRACEFUL_SEC
+timeout = max(60, Config.SERVE_GRACEFUL_SEC * 2)
+keepalive = 5
+max_requests = Config.SERVE_MAX_REQUESTS
+max_requests_jitter = max(1, Config.SERVE_MAX_REQUESTS // 10) if Config.SERVE_MAX_REQUESTS else 0
+preload_app = False
+accesslog = os.environ.get("SERVE_ACCESS_LOG") or None
+errorlog = "-"
+proc_name = "iot-sheet"
+
+
+def on_starting(server):
+    # Per-run state: stale Prometheus files from dead workers would be summed in
+    prom_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if prom_dir:
+        shutil.rmtree(prom_dir, ignore_errors=True)
+        os.makedirs(prom_dir, exist_ok=True)
+    os.makedirs(Config.RUNTIME_DIR, exist_ok=True)
+    if Config.SCHEDULER_STATUS_DIR:
+        shutil.rmtree(Config.SCHEDULER_STATUS_DIR, ignore_errors=True)
+
+
+def post_worker_init(worker):
+    from app.runtime import start_election, start_sse_relay
+    from app.scheduler import scheduler
+    from app.series import start_warmup
+
+    scheduler.start(worker.wsgi)
+    start_election(worker.wsgi)
+    start_sse_relay(worker.wsgi)
+    start_warmup(worker.wsgi)
+
+
+def worker_exit(server, worker):
+    from app.alerting import alert_engine
+    from app.runtime import stop_election, stop_sse_relay
+    from app.scheduler import scheduler
+
+    stop_sse_relay()
+    stop_election(timeout=Config.SERVE_GRACEFUL_SEC / 2)
+    scheduler.shutdown(wait=True)
+    alert_engine.shutdown()
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,192 @@
+"""Per-site database shards.
+
+Each plant ("site") keeps its materials, prices, stock events, policies,
+alerts and checkpoints in its own database, so sites no longer share one
+SQLite writer lock. Users stay in the main database. The default site *is*
+the main database, so a deployment without ``SITES`` behaves exactly as a
+single-database one.
+
+The active site lives in a context variable set per request (from the
+logged-in user, an admin's site switcher or a device token), per MQTT
+message (topic prefix ``<site>/factory/...``) or explicitly with
+``use_site`` in background jobs. ``RoutingSession.get_bind`` sends every
+sharded table to that site's engine.
+"""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import sqlalchemy as sa
+from flask import Flask, current_app
+from flask_sqlalchemy.session import Session as _FlaskSession
+
+
+DEFAULT_SITE = "default"
+GLOBAL_TABLES = {"user"}
+_SITE_RE = re.compile(r"^[a-z0-9_-]{1,40}$")
+
+_current_site: ContextVar[Optional[str]] = ContextVar("current_site", default=None)
+
+T = TypeVar("T")
+
+
+def bind_key(site: str) -> str:
+    return f"site:{site}"
+
+
+def configure(app: Flask) -> None:
+    """Register one SQLAlchemy bind per extra site; call before ``db.init_app``."""
+    raw = app.config.get("SITES") or ""
+    sites = [s.strip().lower() for s in raw.split(",") if s.strip()]
+    for s in sites:
+        if not _SITE_RE.match(s):
+            raise ValueError(f"Nome de site inválido: {s!r}")
+    extra = [s for s in dict.fromkeys(sites) if s != DEFAULT_SITE]
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    shard_dir = app.config.get("SHARD_DIR")
+    for s in extra:
+        url = os.environ.get(f"SITE_{s.upper().replace('-', '_')}_DATABASE_URL")
+        if not url:
+            url = f"sqlite:///{os.path.join(shard_dir, f'data_{s}.db')}"
+        binds.setdefault(bind_key(s), url)
+    app.config["SQLALCHEMY_BINDS"] = binds
+    app.config["SITE_NAMES"] = [DEFAULT_SITE] + extra
+
+
+def site_names(app: Optional[Flask] = None) -> List[str]:
+    return list((app or current_app).config.get("SITE_NAMES") or [DEFAULT_SITE])
+
+
+def is_site(name: Optional[str]) -> bool:
+    return bool(name) and name in site_names()
+
+
+def current_site() -> str:
+    return _current_site.get() or DEFAULT_SITE
+
+
+def set_site(site: Optional[str]):
+    """Set the active site; returns a token for ``reset_site``."""
+    return _current_site.set(site or DEFAULT_SITE)
+
+
+def reset_site(token) -> None:
+    _current_site.reset(token)
+
+
+@contextmanager
+def use_site(site: Optional[str]) -> Iterator[None]:
+    token = set_site(site)
+    try:
+        yield
+    finally:
+        reset_site(token)
+
+
+def _is_sharded(table) -> bool:
+    return getattr(table, "name", None) not in GLOBAL_TABLES
+
+
+class RoutingSession(_FlaskSession):
+    """Flask-SQLAlchemy session that routes sharded tables to the active site."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            site = current_site()
+            if site != DEFAULT_SITE:
+                tables = []
+                if mapper is not None:
+                    tables = [sa.inspect(mapper).local_table]
+                elif clause is not None:
+                    tables = sa.sql.util.find_tables(clause, include_crud=True)
+                if tables and all(_is_sharded(t) for t in tables):
+                    return self._db.engines[bind_key(site)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def sharded_tables(metadata) -> list:
+    return [t for t in metadata.sorted_tables if _is_sharded(t)]
+
+
+def create_shards(db) -> None:
+    for site in site_names()[1:]:
+        db.metadata.create_all(db.engines[bind_key(site)], tables=sharded_tables(db.metadata))
+
+
+def drop_shards(db) -> None:
+    for site in site_names()[1:]:
+        db.metadata.drop_all(db.engines[bind_key(site)], tables=sharded_tables(db.metadata))
+
+
+def engine_for(db, site: str):
+    return db.engines[None] if site == DEFAULT_SITE else db.engines[bind_key(site)]
+
+
+def run_per_site(fn: Callable[[], T], sites: Optional[List[str]] = None) -> Dict[str, T]:
+    """Run ``fn`` once per site sequentially in the current app context.
+
+    The session is removed after each site so identity maps never mix rows
+    from different shards that share primary keys.
+    """
+    from . import db
+
+    results: Dict[str, T] = {}
+    for site in sites or site_names():
+        with use_site(site):
+            try:
+                results[site] = fn()
+            finally:
+                db.session.remove()
+    return results
+
+
+def map_sites(fn: Callable[[], T], sites: Optional[List[str]] = None) -> Dict[str, T]:
+    """Run ``fn`` once per site in parallel, each in its own app context and session."""
+    app = current_app._get_current_object()
+    sites = sites or site_names(app)
+
+    def run(site: str) -> T:
+        with app.app_context(), use_site(site):
+            return fn()
+
+    if len(sites) == 1:
+        return {sites[0]: run(sites[0])}
+    with ThreadPoolExecutor(max_workers=min(8, len(sites)), thread_name_prefix="shard") as pool:
+        return dict(zip(sites, pool.map(run, sites)))
+
+
+def _site_for_request() -> str:
+    from flask import session
+    from flask_login import current_user
+
+    if not current_user.is_authenticated:
+        return DEFAULT_SITE
+    if current_user.role == "admin" and is_site(session.get("site")):
+        return session["site"]
+    return current_user.site if is_site(getattr(current_user, "site", None)) else DEFAULT_SITE
+
+
+def init_app(app: Flask) -> None:
+    @app.before_request
+    def _route_request():
+        set_site(_site_for_request())
+
+    @app.teardown_request
+    def _reset_site(exc=None):
+        set_site(DEFAULT_SITE)
+
+    @app.context_processor
+    def _inject_sites():
+        return {"sites": site_names(), "current_site": current_site()}
+
+
+def split_topic(topic: str) -> Tuple[Optional[str], List[str]]:
+    """``<site>/factory/...`` -> (site, ["factory", ...]); plain topics -> (None, parts)."""
+    parts = topic.split("/")
+    if len(parts) >= 2 and parts[0] != "factory" and parts[1] == "factory":
+        return parts[0], parts[1:]
+    return None, parts
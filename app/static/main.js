@@ -5,7 +5,7 @@
     es.onmessage = (ev) => {
       try {
         const data = JSON.parse(ev.data || '{}');
-        if (data.type === 'stock' || data.type === 'price' || data.type === 'material_created' || data.type === 'material_deleted' || data.type === 'alert') {
+        if (data.type === 'stock' || data.type === 'price' || data.type === 'material_created' || data.type === 'material_deleted' || data.type === 'alert' || data.type === 'refresh') {
           // Simple strategy: reload to keep code small and reliable
           // In a real app, update the specific row.
           if (location.pathname === '/' || location.pathname.startsWith('/materials')) {
@@ -25,6 +25,35 @@
     };
   }
 
+  function drawSpark(svg, series) {
+    const v = (series && series.v) || [];
+    if (v.length < 2) return;
+    const min = Math.min(...v), max = Math.max(...v), span = max - min || 1;
+    const pts = v.map((y, i) => `${(i * 80 / (v.length - 1)).toFixed(1)},${(19 - (y - min) * 18 / span).toFixed(1)}`);
+    svg.innerHTML = `<polyline points="${pts.join(' ')}" />`;
+  }
+
+  function loadSparklines(url) {
+    const rows = document.querySelectorAll('#materials-table tr[data-id]');
+    if (!rows.length) return;
+    const ids = Array.from(rows, (tr) => tr.dataset.id).join(',');
+    // One request for the whole table, served from the server's memory
+    fetch(`${url}?ids=${ids}&points=40`, { credentials: 'same-origin' })
+      .then((r) => (r.ok ? r.json() : null))
+      .then((data) => {
+        if (!data) return;
+        rows.forEach((tr) => {
+          const s = data.series[tr.dataset.id] || {};
+          tr.querySelectorAll('svg.spark').forEach((svg) => drawSpark(svg, s[svg.dataset.kind]));
+        });
+      })
+      .catch(() => {});
+  }
+
+  if (window.IOT_SERIES_URL) {
+    loadSparklines(window.IOT_SERIES_URL);
+  }
+
   if (window.IOT_SSE_URL) {
     connectSSE(window.IOT_SSE_URL);
   }
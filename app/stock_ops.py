@@ -0,0 +1,89 @@
+"""Atomic stock removals.
+
+Validation (policy, anomaly guard) and the insert of a removal run under a
+per-material lock taken from a fixed set of stripes, so removals of the same
+material serialize inside a process while unrelated materials proceed in
+parallel. The insert itself is conditional (``INSERT ... SELECT ... WHERE
+balance >= qty``), so writers in other processes or hosts can't oversell
+either: the database re-checks the balance while holding its write lock.
+The balance starts from the material's newest daily checkpoint, so the check
+only sums the events since then.
+"""
+
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Hashable, Iterator, Optional
+
+from sqlalchemy import insert, literal, select
+
+from . import db
+from .checkpoints import balance_of
+from .models import Material, StockEvent
+from .series import series_store
+from .sharding import current_site
+from .versioning import bump_for_bulk
+
+
+# Rounding slack when comparing float balances
+_EPSILON = 1e-9
+
+
+class StripedLocks:
+    """Fixed pool of locks; a key always maps to the same stripe."""
+
+    def __init__(self, stripes: int = 64) -> None:
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def __call__(self, key: Hashable) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+
+stock_locks = StripedLocks()
+
+
+@contextmanager
+def material_lock(material_id: int) -> Iterator[None]:
+    """Serialize validate-and-write for one material of the active site."""
+    with stock_locks((current_site(), material_id)):
+        yield
+
+
+def commit_removal(
+    material_id: int,
+    qty: float,
+    price: float,
+    source: str,
+    event_uuid: Optional[str] = None,
+) -> bool:
+    """Insert and commit a removal of ``qty`` (> 0) only if the balance covers it.
+
+    Returns False, with the session rolled back, when the balance is short.
+    """
+    # Row lock for servers that have one (no-op on SQLite, whose single writer
+    # lock already serializes the conditional insert below)
+    db.session.query(Material.id).filter(Material.id == material_id).with_for_update().first()
+    # Newest checkpoint plus the events since: bounded work, re-checked atomically
+    balance = balance_of(material_id)
+    now = datetime.utcnow()
+    row = select(
+        literal(material_id),
+        literal(-qty),
+        literal(price),
+        literal(source),
+        literal(now),
+        literal(event_uuid),
+    ).where(balance - qty >= -_EPSILON)
+    new_id = db.session.execute(
+        insert(StockEvent)
+        .from_select(["material_id", "qty", "price_at_event", "source", "created_at", "event_uuid"], row)
+        .returning(StockEvent.id)
+    ).scalar()
+    if new_id is None:
+        db.session.rollback()
+        return False
+    db.session.commit()
+    # Core insert: no flush hooks, so bump the cached views by hand
+    bump_for_bulk([material_id], [now.strftime("%Y-%m")])
+    series_store.record_events([(new_id, material_id, -qty, now)])
+    return True
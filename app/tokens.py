@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+import uuid
+from functools import wraps
+from typing import Dict, Iterable, Optional
+
+from flask import Flask, current_app, g, jsonify, request
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+from .sharding import DEFAULT_SITE, is_site, set_site
+
+
+SCOPES = ("stock:write", "price:write")
+
+
+class DenyList:
+    """In-memory set of revoked token ids, pruned once tokens would expire anyway.
+
+    With ``path`` set, revocations are also appended to a file that every
+    worker process tails, so a token revoked in one worker is refused by all.
+    The file is only set under ``serve`` (POSIX), hence the local ``fcntl`` import.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._revoked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.path = path
+        self._offset = 0
+
+    def add(self, jti: str, max_age: int) -> None:
+        expires = time.time() + max_age
+        with self._lock:
+            self._revoked[jti] = expires
+            self._prune()
+            if self.path:
+                import fcntl
+
+                with open(self.path, "a", encoding="utf-8") as fh:
+                    fcntl.flock(fh, fcntl.LOCK_EX)
+                    fh.write(f"{jti} {expires:.0f}\n")
+
+    def __contains__(self, jti: str) -> bool:
+        with self._lock:
+            self._sync()
+            return jti in self._revoked
+
+    def _sync(self) -> None:
+        if not self.path:
+            return
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size <= self._offset:
+            return
+        with open(self.path, "r", encoding="utf-8") as fh:
+            fh.seek(self._offset)
+            for line in fh:
+                if not line.endswith("\n"):
+                    break  # partial write; re-read next time
+                self._offset += len(line.encode("utf-8"))
+                jti, _, expires = line.strip().partition(" ")
+                if jti and float(expires or 0) > time.time():
+                    self._revoked[jti] = float(expires)
+
+    def _prune(self) -> None:
+        now = time.time()
+        for k in [k for k, exp in self._revoked.items() if exp < now]:
+            del self._revoked[k]
+
+
+deny_list = DenyList()
+
+
+def init_app(app: Flask) -> None:
+    deny_list.path = app.config.get("TOKEN_DENYLIST_FILE")
+
+
+def _serializer() -> URLSafeTimedSerializer:
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"], salt="device-token")
+
+
+def issue_token(device_id: str, scopes: Iterable[str], site: str = "default") -> str:
+    scopes = sorted(set(scopes))
+    unknown = [s for s in scopes if s not in SCOPES]
+    if unknown:
+        raise ValueError(f"Escopo inválido: {', '.join(unknown)}")
+    return _serializer().dumps({"sub": device_id, "scp": scopes, "site": site, "jti": uuid.uuid4().hex})
+
+
+def verify_token(token: str) -> Optional[Dict]:
+    """Return the token claims if signature, age and deny list all check out."""
+    try:
+        claims = _serializer().loads(token, max_age=current_app.config.get("DEVICE_TOKEN_MAX_AGE", 31536000))
+    except (BadSignature, SignatureExpired):
+        return None
+    if claims.get("jti") in deny_list:
+        return None
+    return claims
+
+
+def revoke_token(token_or_jti: str) -> Optional[str]:
+    """Revoke by token or raw jti; returns the revoked jti."""
+    jti = token_or_jti
+    try:
+        jti = _serializer().loads(token_or_jti).get("jti")
+    except BadSignature:
+        pass
+    if not jti:
+        return None
+    deny_list.add(jti, current_app.config.get("DEVICE_TOKEN_MAX_AGE", 31536000))
+    return jti
+
+
+def token_required(scope: str):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            header = request.headers.get("Authorization", "")
+            if not header.startswith("Bearer "):
+                return jsonify(error="token ausente"), 401
+            claims = verify_token(header[7:].strip())
+            if claims is None:
+                return jsonify(error="token inválido"), 401
+            if scope not in claims.get("scp", []):
+                return jsonify(error=f"escopo {scope} necessário"), 403
+            site = claims.get("site", DEFAULT_SITE)
+            if not is_site(site):
+                return jsonify(error=f"site {site} desconhecido"), 403
+            g.device = claims
+            set_site(site)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
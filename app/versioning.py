@@ -0,0 +1,246 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Dict, Hashable, Iterable, Optional, Set
+
+from flask import Flask, Response, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .sharding import current_site
+
+
+GLOBAL = "global"
+
+
+class SharedEpochs:
+    """Per-site write counters in a memory-mapped file shared by worker processes.
+
+    Sites hash into a fixed number of 8-byte slots (a collision only costs an
+    extra invalidation). Increments take an ``flock``; reads are lock-free.
+    POSIX only: it is attached only under ``serve`` (``VERSION_SYNC_FILE``), so
+    ``fcntl`` is imported in ``bump`` rather than at module level.
+    """
+
+    SLOTS = 256
+
+    def __init__(self, path: str) -> None:
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < self.SLOTS * 8:
+            os.ftruncate(self._fd, self.SLOTS * 8)
+        self._map = mmap.mmap(self._fd, self.SLOTS * 8)
+
+    def _offset(self, site: str) -> int:
+        return (zlib.crc32(site.encode("utf-8")) % self.SLOTS) * 8
+
+    def read(self, site: str) -> int:
+        off = self._offset(site)
+        return int.from_bytes(self._map[off : off + 8], "little")
+
+    def bump(self, site: str) -> int:
+        import fcntl
+
+        off = self._offset(site)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            value = int.from_bytes(self._map[off : off + 8], "little") + 1
+            self._map[off : off + 8] = value.to_bytes(8, "little")
+            return value
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class DataVersion:
+    """Monotonic write watermark with optional per-scope granularity.
+
+    Every committed stock/price/material/policy write bumps the counter and
+    stamps the scopes it touched (``("material", id)``, ``("month", "YYYY-MM")``,
+    ``"catalog"``) with the new value, so a reader can key caches on just the
+    scopes it depends on. Scopes belong to the active site: material ids repeat
+    across shards and one site's writes must not invalidate another's pages.
+
+    With several worker processes, ``attach_shared`` links the workers through
+    ``SharedEpochs``: a write committed by another process can't say which
+    scopes it touched, so it raises a per-site floor under every scope.
+    """
+
+    def __init__(self) -> None:
+        self._counter = 0
+        self._scopes: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._shared: Optional[SharedEpochs] = None
+        self._seen: Dict[str, int] = {}
+        self._floor: Dict[str, int] = {}
+        self._foreign: Dict[str, int] = {}
+
+    def attach_shared(self, path: str) -> None:
+        self._shared = SharedEpochs(path)
+
+    def _sync(self, site: str) -> None:
+        # Caller holds self._lock
+        if self._shared is None:
+            return
+        epoch = self._shared.read(site)
+        if epoch != self._seen.get(site, 0):
+            self._seen[site] = epoch
+            self._counter += 1
+            self._floor[site] = self._counter
+            self._foreign[site] = self._foreign.get(site, 0) + 1
+
+    def foreign_writes(self, site: str) -> int:
+        """How many times another process's writes to ``site`` were observed."""
+        with self._lock:
+            self._sync(site)
+            return self._foreign.get(site, 0)
+
+    def bump(self, scopes: Iterable[Hashable] = ()) -> int:
+        site = current_site()
+        with self._lock:
+            self._sync(site)
+            self._counter += 1
+            self._scopes[(site, GLOBAL)] = self._counter
+            for s in scopes:
+                self._scopes[(site, s)] = self._counter
+            if self._shared is not None:
+                epoch = self._shared.bump(site)
+                if epoch == self._seen.get(site, 0) + 1:
+                    # Nobody else wrote since the last sync: our own bump is already applied
+                    self._seen[site] = epoch
+            return self._counter
+
+    def get(self, *scopes: Hashable):
+        """Site-wide version, or a tuple of per-scope versions when scopes are given."""
+        site = current_site()
+        with self._lock:
+            self._sync(site)
+            floor = self._floor.get(site, 0)
+            if not scopes:
+                return max(self._scopes.get((site, GLOBAL), 0), floor)
+            return tuple(max(self._scopes.get((site, s), 0), floor) for s in scopes)
+
+
+data_version = DataVersion()
+# Versions are counted per process and restart from zero, so ETags also carry
+# the process identity: a worker never answers 304 to another worker's (or an
+# earlier run's) ETag for what may be different content.
+_etag_nonce = f"{os.getpid()}-{time.time_ns()}"
+response_cache = TTLCache(ttl=3600, maxsize=256)
+fragment_cache = TTLCache(ttl=3600, maxsize=4096)
+
+
+def _scopes_for(obj) -> Set[Hashable]:
+    from .models import Material, MaterialPolicy, Price, StockEvent
+
+    if isinstance(obj, StockEvent):
+        scopes: Set[Hashable] = {("material", obj.material_id)}
+        if obj.created_at is not None:
+            scopes.add(("month", obj.created_at.strftime("%Y-%m")))
+            if obj.created_at < datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0):
+                # Back-dated: changes closing balances of every later month
+                scopes.add("history")
+        else:
+            # created_at default is applied at INSERT; be conservative
+            scopes.add(("month", "*"))
+        return scopes
+    if isinstance(obj, Price):
+        return {("material", obj.material_id)}
+    if isinstance(obj, Material):
+        return {("material", obj.id), "catalog"}
+    if isinstance(obj, MaterialPolicy):
+        return {("material", obj.material_id), "policy"}
+    return set()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_scopes(sess, flush_context) -> None:
+    touched: Set[Hashable] = sess.info.setdefault("_dv_scopes", set())
+    for obj in list(sess.new) + list(sess.dirty) + list(sess.deleted):
+        touched |= _scopes_for(obj)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_on_commit(sess) -> None:
+    touched = sess.info.pop("_dv_scopes", None)
+    if touched:
+        data_version.bump(touched)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(sess) -> None:
+    sess.info.pop("_dv_scopes", None)
+
+
+def bump_for_bulk(material_ids: Iterable[int], months: Iterable[str] = ()) -> int:
+    """Bump versions for writes done with bulk INSERTs, which skip the flush hooks."""
+    scopes: Set[Hashable] = {("material", mid) for mid in material_ids}
+    scopes |= {("month", ym) for ym in months}
+    return data_version.bump(scopes)
+
+
+def month_scope(ym: str) -> tuple:
+    """Version for a monthly report: its own month, back-dated inserts and the catalog."""
+    return data_version.get(("month", ym), ("month", "*"), "history", "catalog")
+
+
+def versioned_view(version_fn: Optional[Callable[[], Hashable]] = None):
+    """Serve GET responses from memory while their data version is unchanged.
+
+    The cache key is (endpoint, query args, role, site, version); the same key plus
+    this process's nonce, hashed, is sent as ``ETag`` so browsers can revalidate
+    with ``If-None-Match``.
+    Requests carrying flash messages bypass the cache.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or session.get("_flashes"):
+                return fn(*args, **kwargs)
+            version = version_fn() if version_fn else data_version.get()
+            key = (
+                request.endpoint,
+                tuple(sorted(kwargs.items())),
+                tuple(sorted(request.args.items(multi=True))),
+                getattr(current_user, "role", None),
+                current_site(),
+                version,
+            )
+            etag = hashlib.sha1(repr((_etag_nonce, key)).encode("utf-8")).hexdigest()[:20]
+            if etag in request.if_none_match:
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                return resp
+
+            cached = response_cache.get(key)
+            if cached is None:
+                resp = make_response(fn(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+                cached = (resp.get_data(), resp.status_code, list(resp.headers.items()))
+                response_cache.set(key, cached)
+            body, status, headers = cached
+            resp = Response(body, status=status, headers=headers)
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "private, no-cache"
+            return resp
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app: Flask) -> None:
+    global _etag_nonce
+    _etag_nonce = f"{os.getpid()}-{time.time_ns()}"
+    if app.config.get("VERSION_SYNC_FILE"):
+        data_version.attach_shared(app.config["VERSION_SYNC_FILE"])
+    size = int(app.config.get("RESPONSE_CACHE_SIZE", 256))
+    response_cache.maxsize = size
+    fragment_cache.maxsize = max(size * 16, 1024)
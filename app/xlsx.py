@@ -0,0 +1,270 @@
+"""Minimal streaming XLSX ("planilha") writer.
+
+Rows are serialized straight into a deflated zip entry written to an
+unseekable sink, and the sink is drained as the caller iterates, so memory
+stays constant no matter how many rows come out of the DB cursor. Strings
+are written inline (no shared-strings table) for the same reason.
+"""
+
+import re
+import zipfile
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+_EPOCH = datetime(1899, 12, 30)
+_ILLEGAL_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_BAD_SHEET_CHARS = re.compile(r"[\[\]:*?/\\]")
+
+# cellXfs indexes in styles.xml
+STYLE_TEXT = 0
+STYLE_DATETIME = 1
+STYLE_NUMBER = 2
+STYLE_BOLD = 3
+STYLE_BOLD_NUMBER = 4
+
+
+@dataclass
+class Column:
+    title: str
+    kind: str = "text"  # text | number | datetime
+    width: float = 16
+    total: Optional[str] = None  # sum | average | None
+
+
+class _Sink:
+    """Write-only buffer handed to ZipFile; drained by the generator."""
+
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+        self.size = 0
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self.size += len(b)
+        return len(b)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def _col_letter(idx: int) -> str:
+    letters = ""
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _text(value) -> str:
+    return escape(_ILLEGAL_XML.sub("", str(value)))
+
+
+def _serial(value) -> float:
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return (value - _EPOCH).total_seconds() / 86400.0
+
+
+def _cell(ref: str, value, kind: str, bold: bool = False) -> str:
+    if value is None:
+        return ""
+    if kind == "number" and isinstance(value, (int, float)) and not isinstance(value, bool):
+        style = STYLE_BOLD_NUMBER if bold else STYLE_NUMBER
+        return f'<c r="{ref}" s="{style}"><v>{value!r}</v></c>'
+    if kind == "datetime" and isinstance(value, (datetime, date)):
+        return f'<c r="{ref}" s="{STYLE_DATETIME}"><v>{_serial(value)!r}</v></c>'
+    style = f' s="{STYLE_BOLD}"' if bold else ""
+    return f'<c r="{ref}" t="inlineStr"{style}><is><t xml:space="preserve">{_text(value)}</t></is></c>'
+
+
+def _sheet_name(name: str, used: set) -> str:
+    base = (_BAD_SHEET_CHARS.sub("_", str(name or "Sem categoria")).strip("'") or "Planilha")[:31]
+    candidate, n = base, 2
+    while candidate.lower() in used:
+        suffix = f" ({n})"
+        candidate = base[: 31 - len(suffix)] + suffix
+        n += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def _at_least_one(sheets):
+    # Excel refuses workbooks without sheets
+    empty = True
+    for sheet in sheets:
+        empty = False
+        yield sheet
+    if empty:
+        yield "Vazio", []
+
+
+def stream_workbook(
+    sheets: Iterable[Tuple[str, Iterable[Sequence]]],
+    columns: Sequence[Column],
+    chunk_size: int = 64 * 1024,
+) -> Iterator[bytes]:
+    """Yield the bytes of an .xlsx with one worksheet per ``(name, rows)`` pair.
+
+    Every worksheet shares ``columns``; a bold totals row is appended using
+    SUM/AVERAGE formulas with cached values accumulated while streaming.
+    """
+    sink = _Sink()
+    zf = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED)
+    used: set = set()
+    names: List[str] = []
+    ncols = len(columns)
+    last_col = _col_letter(ncols - 1)
+    header = "".join(_cell(f"{_col_letter(i)}1", c.title, "text", bold=True) for i, c in enumerate(columns))
+    cols_xml = "".join(
+        f'<col min="{i + 1}" max="{i + 1}" width="{c.width}" customWidth="1"/>' for i, c in enumerate(columns)
+    )
+    letters = [_col_letter(i) for i in range(ncols)]
+    kinds = [c.kind for c in columns]
+    totals = {i for i, c in enumerate(columns) if c.total}
+
+    for sheet_name, rows in _at_least_one(sheets):
+        names.append(_sheet_name(sheet_name, used))
+        sums = [0.0] * ncols
+        with zf.open(f"xl/worksheets/sheet{len(names)}.xml", "w", force_zip64=True) as out:
+            out.write(
+                (
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                    '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" '
+                    'activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>'
+                    f"<cols>{cols_xml}</cols><sheetData>"
+                    f'<row r="1">{header}</row>'
+                ).encode("utf-8")
+            )
+            r = 1
+            pending: List[str] = []
+            for row in rows:
+                r += 1
+                cells = []
+                for i in range(ncols):
+                    v = row[i]
+                    cells.append(_cell(f"{letters[i]}{r}", v, kinds[i]))
+                    if i in totals and isinstance(v, (int, float)):
+                        sums[i] += v
+                pending.append(f'<row r="{r}">{"".join(cells)}</row>')
+                if len(pending) >= 512:
+                    out.write("".join(pending).encode("utf-8"))
+                    pending.clear()
+                    if sink.size >= chunk_size:
+                        yield sink.drain()
+            out.write("".join(pending).encode("utf-8"))
+
+            n = r - 1
+            total_cells = [_cell(f"A{r + 1}", "Total", "text", bold=True)]
+            for i, c in enumerate(columns):
+                if i == 0 or not c.total:
+                    continue
+                ref = f"{letters[i]}{r + 1}"
+                if c.total == "average":
+                    fn, cached = "AVERAGE", (sums[i] / n if n else 0.0)
+                else:
+                    fn, cached = "SUM", sums[i]
+                if not n:
+                    total_cells.append(_cell(ref, 0.0, "number", bold=True))
+                    continue
+                formula = f"{fn}({letters[i]}2:{letters[i]}{r})"
+                total_cells.append(f'<c r="{ref}" s="{STYLE_BOLD_NUMBER}"><f>{formula}</f><v>{cached!r}</v></c>')
+            out.write(
+                (
+                    f'<row r="{r + 1}">{"".join(total_cells)}</row></sheetData>'
+                    f'<autoFilter ref="A1:{last_col}{max(r, 1)}"/></worksheet>'
+                ).encode("utf-8")
+            )
+        yield sink.drain()
+
+    _write_package(zf, names)
+    zf.close()
+    yield sink.drain()
+
+
+def _write_package(zf: zipfile.ZipFile, names: List[str]) -> None:
+    sheet_overrides = "".join(
+        f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for i in range(1, len(names) + 1)
+    )
+    zf.writestr(
+        "[Content_Types].xml",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        f"{sheet_overrides}</Types>",
+    )
+    zf.writestr(
+        "_rels/.rels",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>',
+    )
+    sheets_xml = "".join(
+        f'<sheet name="{_text(name)}" sheetId="{i}" r:id="rId{i}"/>' for i, name in enumerate(names, start=1)
+    )
+    zf.writestr(
+        "xl/workbook.xml",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f"<sheets>{sheets_xml}</sheets></workbook>",
+    )
+    rels = "".join(
+        f'<Relationship Id="rId{i}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        f'Target="worksheets/sheet{i}.xml"/>'
+        for i in range(1, len(names) + 1)
+    )
+    rels += (
+        f'<Relationship Id="rId{len(names) + 1}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+        'Target="styles.xml"/>'
+    )
+    zf.writestr(
+        "xl/_rels/workbook.xml.rels",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        f"{rels}</Relationships>",
+    )
+    zf.writestr(
+        "xl/styles.xml",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy hh:mm"/></numFmts>'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="5">'
+        '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="4" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+        '<xf numFmtId="4" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1" applyNumberFormat="1"/>'
+        "</cellXfs>"
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        "</styleSheet>",
+    )
@@ -12,17 +12,23 @@ app = create_app()
 
 @app.cli.command("init-db")
 def init_db_command():
-    """Initialize the database (drop + create tables)."""
+    """Initialize the database and site shards (drop + create tables)."""
     from app import db
+    from app.sharding import create_shards, drop_shards
     click.echo("Initializing database...")
+    drop_shards(db)
     db.drop_all()
     db.create_all()
+    create_shards(db)
     click.echo("Database initialized.")
 
 
 @app.cli.command("seed-demo")
-def seed_demo_command():
+@click.option("--site", "sites", multiple=True, help="Sites que recebem os materiais (padrão: todos)")
+def seed_demo_command(sites):
     """Seed demo data: users, materials, initial prices."""
+    from app.sharding import run_per_site
+
     click.echo("Seeding demo data...")
 
     if not User.query.filter_by(email="admin@local").first():
@@ -39,34 +45,592 @@ def seed_demo_command():
         {"name": "Latão", "category": "metal", "unit": "kg"},
     ]
 
-    for m in demo_materials:
-        material = Material.query.filter_by(name=m["name"]).first()
-        if not material:
-            material = Material(name=m["name"], category=m["category"], unit=m["unit"])
-            db.session.add(material)
-            db.session.flush()
+    def seed_materials():
+        for m in demo_materials:
+            material = Material.query.filter_by(name=m["name"]).first()
+            if not material:
+                material = Material(name=m["name"], category=m["category"], unit=m["unit"])
+                db.session.add(material)
+                db.session.flush()
+
+            if not Price.query.filter_by(material_id=material.id).first():
+                db.session.add(Price(material_id=material.id, value=100.0))
 
-        if not Price.query.filter_by(material_id=material.id).first():
-            db.session.add(Price(material_id=material.id, value=100.0))
+        db.session.commit()
 
-    db.session.commit()
+    run_per_site(seed_materials, list(sites) or None)
     click.echo("Demo data seeded.")
 
 
+@app.cli.command("issue-token")
+@click.argument("device_id")
+@click.option("--scope", "scopes", multiple=True, help="stock:write, price:write (padrão: todos)")
+@click.option("--site", default="default", help="Site (shard) em que o dispositivo grava")
+def issue_token_command(device_id, scopes, site):
+    """Issue a signed API token for a device or gateway."""
+    from app.sharding import is_site
+    from app.tokens import SCOPES, issue_token
+
+    if not is_site(site):
+        raise click.BadParameter(f"site desconhecido: {site}", param_hint="--site")
+    click.echo(issue_token(device_id, scopes or SCOPES, site))
+
+
+@app.cli.command("bench-xlsx")
+@click.option("--rows", default=1_000_000, type=int, help="Total de linhas geradas")
+@click.option("--categories", default=4, type=int, help="Número de abas")
+def bench_xlsx_command(rows, categories):
+    """Benchmark the streaming XLSX writer (rows/sec and peak memory)."""
+    import time
+    import tracemalloc
+    from app.xlsx import Column, stream_workbook
+
+    per_sheet = max(1, rows // max(1, categories))
+    now = datetime.utcnow()
+
+    def sheet_rows(c):
+        for i in range(per_sheet):
+            yield (now, f"Item {c}-{i % 500}", float(i % 17) - 8.0, 12.5, 100.0 + i % 97, "simulator")
+
+    columns = [
+        Column("Data", "datetime"),
+        Column("Item"),
+        Column("Qtd", "number", total="sum"),
+        Column("Preço (R$)", "number"),
+        Column("Valor (R$)", "number", total="sum"),
+        Column("Origem"),
+    ]
+    def run():
+        size = 0
+        for chunk in stream_workbook(((f"cat{c}", sheet_rows(c)) for c in range(categories)), columns):
+            size += len(chunk)
+        return size
+
+    # Throughput without tracing overhead, then a traced pass for peak memory
+    t0 = time.perf_counter()
+    size = run()
+    elapsed = time.perf_counter() - t0
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total = per_sheet * categories
+    click.echo(f"linhas: {total}  tempo: {elapsed:.2f}s  linhas/s: {total / elapsed:,.0f}")
+    click.echo(f"arquivo: {size / 1e6:.1f} MB  pico de memória: {peak / 1e6:.2f} MB")
+
+
+@app.cli.command("bench-mqtt-decode")
+@click.option("--kind", type=click.Choice(["stock", "price"]), default="stock")
+@click.option("--batch", default=500, type=int, help="Leituras por mensagem em lote")
+@click.option("--readings", default=200_000, type=int, help="Total de leituras decodificadas por formato")
+def bench_mqtt_decode_command(kind, batch, readings):
+    """Benchmark MQTT payload decoding: one JSON message per reading vs JSON and binary batches."""
+    import json
+    import random
+    import time
+    import uuid
+    from app.mqtt_batch import decode_price, decode_stock, encode_price, encode_stock
+    from app.sharding import split_topic
+
+    rng = random.Random(1)
+    batches = max(1, readings // batch)
+    total = batches * batch
+    if kind == "stock":
+        sample = [(rng.randint(1, 5000), round(rng.uniform(-10, 10), 2), str(uuid.uuid4())) for _ in range(batch)]
+        singles = [
+            (f"sp/factory/stock/{mid}/{'add' if qty >= 0 else 'remove'}",
+             json.dumps({"qty": abs(qty), "eventId": eid}).encode("utf-8"))
+            for mid, qty, eid in sample
+        ]
+        json_batch = json.dumps([{"materialId": mid, "qty": qty, "eventId": eid} for mid, qty, eid in sample])
+        binary_batch, decode, field = encode_stock(sample), decode_stock, "qty"
+    else:
+        sample = [(rng.randint(1, 5000), round(rng.uniform(1, 500), 2)) for _ in range(batch)]
+        singles = [(f"sp/factory/price/{mid}/set", json.dumps({"value": v}).encode("utf-8")) for mid, v in sample]
+        json_batch = json.dumps([{"materialId": mid, "value": v} for mid, v in sample])
+        binary_batch, decode, field = encode_price(sample), decode_price, "value"
+    json_batch = json_batch.encode("utf-8")
+
+    def per_reading():
+        # What on_message/_handle_topic do before touching the database
+        for _ in range(batches):
+            for topic, payload in singles:
+                _, parts = split_topic(topic)
+                body = json.loads(payload.decode("utf-8") or "{}")
+                int(parts[2]), float(body.get(field, 0)), body.get("eventId")
+
+    def batched(payload):
+        def run():
+            for _ in range(batches):
+                decode(payload)
+        return run
+
+    if decode(binary_batch) != decode(json_batch):
+        raise click.ClickException("codificações divergem")
+    single_bytes = sum(len(t) + len(p) for t, p in singles)
+    base = None
+    click.echo(f"{kind}: {total:,} leituras, lotes de {batch}")
+    for label, run, size in (
+        ("JSON por leitura", per_reading, single_bytes),
+        ("JSON em lote", batched(json_batch), len(json_batch)),
+        ("binário em lote", batched(binary_batch), len(binary_batch)),
+    ):
+        t0 = time.perf_counter()
+        run()
+        rate = total / (time.perf_counter() - t0)
+        base = base or rate
+        click.echo(f"  {label:<17} {rate:>12,.0f} leituras/s  {rate / base:5.1f}x  {size / batch:6.1f} bytes/leitura")
+
+
+@app.cli.command("erp-dispatch")
+def erp_dispatch_command():
+    """Deliver due ERP outbox rows once (uses ERP_WEBHOOK_URL)."""
+    from app.erp_outbox import ErpDispatcher
+    from app.sharding import run_per_site
+
+    dispatcher = ErpDispatcher(app)
+    sent = sum(run_per_site(dispatcher.dispatch_once).values())
+    click.echo(f"{sent} sugestão(ões) enviada(s) ao ERP.")
+
+
+@app.cli.command("erp-standin")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8099, type=int)
+@click.option("--fail-rate", default=0.0, type=float, help="Fração de requisições respondidas com 503")
+def erp_standin_command(host, port, fail_rate):
+    """Run a local stand-in ERP webhook that logs what it receives."""
+    import json
+    import random
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    seen = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            key = self.headers.get("Idempotency-Key")
+            if random.random() < fail_rate:
+                status = 503
+            else:
+                status = 200
+                items = json.loads(body or b"[]")
+                items = items if isinstance(items, list) else [items]
+                dup = " (duplicado)" if key in seen else ""
+                seen.add(key)
+                click.echo(f"ERP <- {len(items)} item(ns) key={key}{dup}")
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    click.echo(f"ERP stand-in em http://{host}:{port}/")
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+
+@app.cli.command("rescore-anomalies")
+@click.option("--window", type=int, default=None, help="Padrão: ANOMALY_WINDOW")
+@click.option("--zscore", type=float, default=None, help="Padrão: ANOMALY_ZSCORE")
+@click.option("--since", default=None, help="Só reporta remoções a partir de AAAA-MM-DD")
+@click.option("--workers", type=int, default=None, help="Processos (padrão: nº de CPUs)")
+@click.option("--chunk", type=int, default=50, help="Materiais por tarefa")
+@click.option("--out", default="anomalias.csv", help="Arquivo CSV do relatório")
+@click.option("--create-alerts", is_flag=True, help="Cria alertas de anomalia ausentes")
+@click.option("--site", default="default", help="Site (shard) reprocessado")
+def rescore_anomalies_command(window, zscore, since, workers, chunk, out, create_alerts, site):
+    """Re-score the whole removal history with the anomaly z-score rule."""
+    from app.sharding import engine_for, is_site, use_site
+
+    if not is_site(site):
+        raise click.BadParameter(f"site desconhecido: {site}", param_hint="--site")
+    with use_site(site):
+        _rescore_site(window, zscore, since, workers, chunk, out, create_alerts, engine_for(db, site))
+
+
+def _rescore_site(window, zscore, since, workers, chunk, out, create_alerts, engine):
+    import csv
+    import time
+    from app.anomaly import rescore
+    from app.models import Alert
+
+    window = window or app.config["ANOMALY_WINDOW"]
+    zscore = zscore or app.config["ANOMALY_ZSCORE"]
+    since_dt = datetime.strptime(since, "%Y-%m-%d") if since else None
+    materials = {m.id: m for m in Material.query.all()}
+
+    t0 = time.perf_counter()
+    flagged = rescore(
+        engine.url.render_as_string(hide_password=False),
+        materials.keys(),
+        window,
+        zscore,
+        since=since_dt,
+        workers=workers,
+        chunk=chunk,
+    )
+    elapsed = time.perf_counter() - t0
+
+    with open(out, "w", newline="", encoding="utf-8") as fh:
+        w = csv.writer(fh)
+        w.writerow(["evento", "material_id", "item", "data", "qtd", "media", "desvio", "z"])
+        for r in flagged:
+            name = materials[r.material_id].name if r.material_id in materials else ""
+            w.writerow([r.event_id, r.material_id, name, r.created_at.isoformat(sep=" "),
+                        f"{r.qty:.2f}", f"{r.mean:.2f}", f"{r.std:.2f}", f"{r.z:.2f}"])
+    click.echo(f"{len(flagged)} remoção(ões) anômala(s) (janela={window}, z>{zscore}) em {elapsed:.2f}s -> {out}")
+
+    if create_alerts and flagged:
+        by_material = {}
+        for r in flagged:
+            by_material.setdefault(r.material_id, []).append(r)
+        created = 0
+        for mid, rows in by_material.items():
+            exists = Alert.query.filter(
+                Alert.material_id == mid, Alert.type == "anomaly", Alert.last_seen_at >= rows[0].created_at
+            ).first()
+            if exists or mid not in materials:
+                continue
+            m = materials[mid]
+            worst = max(rows, key=lambda r: r.z)
+            db.session.add(
+                Alert(
+                    level="critical",
+                    type="anomaly",
+                    message=f"Reprocessamento: {len(rows)} remoção(ões) anômala(s) em {m.name} (maior z={worst.z:.2f})",
+                    material_id=mid,
+                    created_at=rows[0].created_at,
+                    last_seen_at=rows[-1].created_at,
+                    occurrences=len(rows),
+                )
+            )
+            created += 1
+        db.session.commit()
+        click.echo(f"{created} alerta(s) criado(s).")
+
+
+@app.cli.command("checkpoint")
+@click.option("--date", "day", default=None, help="Fronteira AAAA-MM-DD (padrão: hoje 00:00)")
+@click.option("--backfill", is_flag=True, help="Cria checkpoints diários desde o primeiro evento")
+def checkpoint_command(day, backfill):
+    """Snapshot per-material stock balances of every site (run daily, e.g. from cron)."""
+    from app.checkpoints import backfill as backfill_checkpoints, create_checkpoint, day_start
+    from app.sharding import run_per_site
+
+    if backfill:
+        written = run_per_site(backfill_checkpoints)
+    else:
+        at = datetime.strptime(day, "%Y-%m-%d") if day else day_start(datetime.utcnow())
+        written = run_per_site(lambda: create_checkpoint(at))
+    for site, n in written.items():
+        click.echo(f"{site}: {n} checkpoint(s) gravado(s).")
+
+
+@app.cli.command("import")
+@click.argument("kind", type=click.Choice(["materials", "prices", "stock"]))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--site", default="default", help="Site (shard) que recebe os dados")
+@click.option("--chunk-size", type=int, default=None, help="Linhas por transação (padrão: IMPORT_CHUNK_SIZE)")
+@click.option("--encoding", default="utf-8-sig", help="Codificação do arquivo (ex.: cp1252 para Excel antigo)")
+def import_command(kind, path, site, chunk_size, encoding):
+    """Bulk-load a historical CSV (materials, prices or stock movements)."""
+    import sys
+    from app.importer import ImportFileError, import_csv, text_stream
+    from app.sharding import is_site, use_site
+    from app.versioning import data_version
+
+    if not is_site(site):
+        raise click.BadParameter(f"site desconhecido: {site}", param_hint="--site")
+    # A `serve` running on the same database: let its workers see the new data
+    shared = os.path.join(app.config["RUNTIME_DIR"], "versions.bin")
+    if os.path.exists(shared):
+        data_version.attach_shared(shared)
+
+    def progress(r):
+        sys.stderr.write(f"\r{r.rows:,} linhas lidas, {r.inserted:,} gravadas, {r.rate:,.0f} linhas/s")
+        sys.stderr.flush()
+
+    chunk = chunk_size or app.config["IMPORT_CHUNK_SIZE"]
+    with open(path, "rb") as fh, use_site(site):
+        try:
+            result = import_csv(text_stream(fh, encoding), kind, chunk, progress=progress)
+        except ImportFileError as e:
+            raise click.ClickException(str(e))
+    sys.stderr.write("\n")
+    click.echo(
+        f"{result.inserted:,} linhas gravadas, {result.skipped:,} ignoradas "
+        f"em {result.seconds:.1f}s ({result.rate:,.0f} linhas/s)."
+    )
+    for err in result.errors:
+        click.echo(f"  {err}")
+
+
+def _stress_worker(material_id, threads, ops, qty, site, sim_threads=0):
+    """Hammer one material from ``threads`` threads while ``sim_threads`` run
+    simulator ticks on it; returns accepted removals (simulator ones excluded)."""
+    import threading
+    from app.iot_simulator import stock_tick
+    from app.mqtt_client import _handle_stock
+    from app.sharding import use_site
+
+    barrier = threading.Barrier(threads + sim_threads)
+    accepted = []
+    done = threading.Event()
+
+    def simulate():
+        with app.app_context(), use_site(site):
+            barrier.wait()
+            while not done.is_set():
+                stock_tick(1, [material_id])
+                db.session.remove()
+
+    def hammer():
+        ok = 0
+        with app.app_context(), use_site(site):
+            barrier.wait()
+            for _ in range(ops):
+                if _handle_stock(material_id, -qty, None, source="stress") is None:
+                    ok += 1
+        accepted.append(ok)
+
+    workers = [threading.Thread(target=hammer) for _ in range(threads)]
+    sims = [threading.Thread(target=simulate) for _ in range(sim_threads)]
+    for t in workers + sims:
+        t.start()
+    for t in workers:
+        t.join()
+    done.set()
+    for t in sims:
+        t.join()
+    return sum(accepted)
+
+
+def _stress_process(args):
+    # Fresh connections in the child; pooled SQLite handles don't survive fork
+    db.engines[None].dispose()
+    for engine in db.engines.values():
+        engine.dispose()
+    return _stress_worker(*args)
+
+
+@app.cli.command("stress-remove")
+@click.option("--threads", default=32, type=int, help="Threads por processo")
+@click.option("--processes", default=1, type=int, help="Processos concorrentes (testa a escrita condicional no banco)")
+@click.option("--ops", default=50, type=int, help="Remoções tentadas por thread")
+@click.option("--stock", default=500.0, type=float, help="Estoque inicial")
+@click.option("--qty", default=1.0, type=float, help="Quantidade por remoção")
+@click.option("--site", default="default", help="Site (shard) usado no teste")
+@click.option("--simulator", "sim_threads", default=1, type=int, help="Threads do simulador por processo (0 = sem simulador)")
+def stress_remove_command(threads, processes, ops, stock, qty, site, sim_threads):
+    """Hammer one material with concurrent removals and check it never oversells.
+
+    Web/MQTT-style removals race with simulator ticks on the same material.
+    Creates a scratch material "stress-<n>"; run it against a scratch DATABASE_URL.
+    """
+    import itertools
+    import multiprocessing
+    import time
+    from sqlalchemy import func
+    from app.models import MaterialPolicy
+    from app.routes import _current_stock
+    from app.sharding import is_site, use_site
+
+    if not is_site(site):
+        raise click.BadParameter(f"site desconhecido: {site}", param_hint="--site")
+    with use_site(site):
+        m = Material(name=f"stress-{int(time.time() * 1000)}", category="teste", unit="kg")
+        db.session.add(m)
+        db.session.flush()
+        db.session.add(MaterialPolicy(
+            material_id=m.id, min_stock_threshold=0.0, max_remove_percent=100.0,
+            max_qty_per_op=qty, max_qty_per_day=1e12, require_integer_units=False,
+        ))
+        db.session.add(Price(material_id=m.id, value=1.0))
+        db.session.add(StockEvent(material_id=m.id, qty=stock, price_at_event=1.0, source="stress"))
+        db.session.commit()
+        material_id = m.id
+        db.session.remove()
+
+    attempts = threads * ops * processes
+    args = (material_id, threads, ops, qty, site, sim_threads)
+    t0 = time.perf_counter()
+    if processes > 1:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            accepted = sum(pool.map(_stress_process, [args] * processes))
+    else:
+        accepted = _stress_worker(*args)
+    elapsed = time.perf_counter() - t0
+
+    with use_site(site):
+        balance = _current_stock(material_id)
+        simulated = db.session.query(func.coalesce(func.sum(StockEvent.qty), 0.0)).filter(
+            StockEvent.material_id == material_id, StockEvent.source == "simulator"
+        ).scalar()
+        # Running balance in commit (id) order: its low point must never go below zero
+        low = min(itertools.accumulate(
+            q for (q,) in db.session.query(StockEvent.qty)
+            .filter(StockEvent.material_id == material_id)
+            .order_by(StockEvent.id)
+        ))
+    expected = stock - accepted * qty + simulated
+    click.echo(f"material {material_id}: {attempts} tentativas, {accepted} aceitas em {elapsed:.2f}s "
+               f"({attempts / elapsed:,.0f} ops/s)")
+    click.echo(f"simulador: saldo líquido {simulated:+.2f}; menor saldo no histórico: {low:.2f}")
+    click.echo(f"saldo final: {balance:.2f} (esperado {expected:.2f})")
+    if balance < -1e-9 or low < -1e-9 or abs(balance - expected) > 1e-6:
+        raise click.ClickException("estoque vendido além do saldo")
+    click.echo("OK: saldo nunca negativo.")
+
+
 @app.cli.command("run")
 @click.option("--host", default="0.0.0.0")
 @click.option("--port", default=5000, type=int)
 def run_server(host, port):
     """Run the development server and start the simulator."""
-    from app.iot_simulator import start_simulator
-    from app.mqtt_client import start_mqtt
+    from app.runtime import start_background
+    from app.scheduler import scheduler
+    from app.series import start_warmup
 
-    start_simulator(app)
-
-    start_mqtt(app)
+    # With debug=True the reloader re-executes this command in a child process;
+    # start the jobs only there so they don't run twice
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        scheduler.start(app)
+        start_background(app)
+        start_warmup(app)
     app.run(host=host, port=port, debug=True)
 
 
+@app.cli.command("serve")
+@click.option("--host", default="0.0.0.0")
+@click.option("--port", default=5000, type=int)
+@click.option("--workers", type=int, default=None, help="Processos (padrão: SERVE_WORKERS = nº de CPUs)")
+@click.option("--threads", type=int, default=None, help="Threads por processo (padrão: SERVE_THREADS)")
+@click.option("--graceful-timeout", type=int, default=None, help="Segundos para drenar requisições no desligamento")
+@click.option("--max-requests", type=int, default=None, help="Recicla o worker após N requisições (0 = nunca)")
+def serve_command(host, port, workers, threads, graceful_timeout, max_requests):
+    """Run the production server (gunicorn, preforked gthread workers).
+
+    One worker is elected leader through a file lock and owns the simulator,
+    MQTT, ERP dispatcher and checkpoints. SIGTERM drains in-flight requests.
+    """
+    import sys
+
+    runtime_dir = app.config["RUNTIME_DIR"]
+    env = dict(os.environ)
+    env.update(
+        SERVE_BIND=f"{host}:{port}",
+        RUNTIME_DIR=runtime_dir,
+        VERSION_SYNC_FILE=os.path.join(runtime_dir, "versions.bin"),
+        TOKEN_DENYLIST_FILE=os.path.join(runtime_dir, "revoked_tokens"),
+        SCHEDULER_STATUS_DIR=os.path.join(runtime_dir, "jobs"),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(runtime_dir, "prometheus"),
+    )
+    for name, value in (
+        ("SERVE_WORKERS", workers),
+        ("SERVE_THREADS", threads),
+        ("SERVE_GRACEFUL_SEC", graceful_timeout),
+        ("SERVE_MAX_REQUESTS", max_requests),
+    ):
+        if value is not None:
+            env[name] = str(value)
+    os.makedirs(runtime_dir, exist_ok=True)
+    # Fresh interpreter: prometheus_client picks multiprocess mode at import time
+    os.execvpe(
+        sys.executable,
+        [sys.executable, "-m", "gunicorn", "-c", "python:app.serve_conf", "app:create_app()"],
+        env,
+    )
+
+
+@app.cli.command("bench-serve")
+@click.option("--workers", "worker_counts", default="1,2,4", help="Lista de nº de workers a medir")
+@click.option("--threads", default=8, type=int, help="Threads por worker")
+@click.option("--concurrency", default=32, type=int, help="Conexões simultâneas do gerador de carga")
+@click.option("--duration", default=10.0, type=float, help="Segundos de carga por rodada")
+@click.option("--path", default="/auth/login", help="Rota medida (sem login)")
+@click.option("--port", default=5077, type=int)
+def bench_serve_command(worker_counts, threads, concurrency, duration, path, port):
+    """Measure requests/sec of `serve` for each worker count."""
+    import multiprocessing
+    import signal
+    import subprocess
+    import sys
+    import time
+    import urllib.request
+
+    url = f"http://127.0.0.1:{port}{path}"
+    env = dict(os.environ, SIM_PRICE_JITTER_SEC="3600", SIM_STOCK_EVENT_SEC="3600", MQTT_ENABLED="0")
+    loaders = max(1, min(concurrency, (os.cpu_count() or 1) * 2))
+    results = []
+    for n in [int(x) for x in worker_counts.split(",") if x.strip()]:
+        proc = subprocess.Popen(
+            [sys.executable, "manage.py", "serve", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(n), "--threads", str(threads)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = time.time() + 30
+            while True:
+                try:
+                    urllib.request.urlopen(url, timeout=1).read()
+                    break
+                except Exception:
+                    if time.time() > deadline or proc.poll() is not None:
+                        raise click.ClickException(f"servidor com {n} worker(s) não respondeu")
+                    time.sleep(0.2)
+            per_loader = max(1, concurrency // loaders)
+            with multiprocessing.get_context("fork").Pool(loaders) as pool:
+                counts = pool.starmap(_bench_load, [(port, path, per_loader, duration)] * loaders)
+            ok = sum(c[0] for c in counts)
+            errors = sum(c[1] for c in counts)
+            results.append((n, ok / duration, errors))
+            click.echo(f"workers={n} threads={threads}: {ok / duration:,.0f} req/s ({errors} erros)")
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=60)
+    if results:
+        base = results[0][1] or 1
+        click.echo("escala: " + "  ".join(f"{n}w={rps / base:.2f}x" for n, rps, _ in results))
+
+
+def _bench_load(port, path, connections, duration):
+    """Load generator process: ``connections`` keep-alive clients in threads."""
+    import http.client
+    import threading
+    import time
+
+    stop_at = time.perf_counter() + duration
+    totals = []
+
+    def client():
+        ok = errors = 0
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        while time.perf_counter() < stop_at:
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status < 500:
+                    ok += 1
+                else:
+                    errors += 1
+            except Exception:
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.close()
+        totals.append((ok, errors))
+
+    workers = [threading.Thread(target=client) for _ in range(connections)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(t[0] for t in totals), sum(t[1] for t in totals)
+
+
 if __name__ == "__main__":
 
     cli = click.Group(commands=app.cli.commands)